@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Admission Control for AI Replies
+Caps concurrent OpenAI work per bot (and per managed account). Requests beyond
+AI_MAX_IN_FLIGHT wait in a bounded FIFO queue; when the queue is full or a request
+has waited longer than AI_QUEUE_TIMEOUT seconds it is shed, and the caller answers
+right away with the configured busy message instead of draining quota while every
+user waits.
+"""
+
+import os
+import asyncio
+import logging
+import contextlib
+
+logger = logging.getLogger(__name__)
+
+AI_MAX_IN_FLIGHT = int(os.getenv('AI_MAX_IN_FLIGHT', '8'))
+AI_MAX_QUEUE = int(os.getenv('AI_MAX_QUEUE', '32'))
+AI_QUEUE_TIMEOUT = float(os.getenv('AI_QUEUE_TIMEOUT', '15'))
+AI_MAX_IN_FLIGHT_PER_ACCOUNT = int(os.getenv('AI_MAX_IN_FLIGHT_PER_ACCOUNT', '3'))
+
+# Default answer for shed requests (the main bot's 'busy' automated message overrides it)
+DEFAULT_BUSY_MESSAGE = os.getenv(
+    'AUTO_REPLY_MESSAGE',
+    "Namaste! Main abhi busy hoon. Aap ka message dekha hai, jald hi reply karunga. 🙏"
+)
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request is shed; reason is 'queue_full' or 'deadline'"""
+
+    def __init__(self, reason: str):
+        super().__init__(f"AI request shed ({reason})")
+        self.reason = reason
+
+
+class AdmissionController:
+    """Bounded in-flight limit with a bounded, deadline-aware FIFO queue"""
+
+    def __init__(self, name: str = 'bot', max_in_flight: int = AI_MAX_IN_FLIGHT,
+                 max_queue: int = AI_MAX_QUEUE, queue_timeout: float = AI_QUEUE_TIMEOUT):
+        self.name = name
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self._waiters = []
+        self.admitted = 0
+        self.shed_queue_full = 0
+        self.shed_deadline = 0
+
+    def _shed(self, reason: str):
+        if reason == 'queue_full':
+            self.shed_queue_full += 1
+        else:
+            self.shed_deadline += 1
+        logger.warning(f"🚦 [{self.name}] Shedding AI request ({reason}): "
+                       f"{self.in_flight} in flight, {len(self._waiters)} queued")
+        raise AdmissionRejected(reason)
+
+    async def acquire(self):
+        """Wait for a slot; raises AdmissionRejected if the request is shed"""
+        if self.in_flight < self.max_in_flight and not self._waiters:
+            self.in_flight += 1
+            self.admitted += 1
+            return
+        if len(self._waiters) >= self.max_queue:
+            self._shed('queue_full')
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+        except asyncio.TimeoutError:
+            if not waiter.done():
+                waiter.cancel()
+                self._waiters.remove(waiter)
+                self._shed('deadline')
+            # The slot was handed over just as the deadline passed - take it
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            else:
+                waiter.cancel()
+                self._waiters.remove(waiter)
+            raise
+        self.admitted += 1
+
+    def release(self):
+        """Hand the slot to the oldest waiter, or free it"""
+        while self._waiters:
+            waiter = self._waiters.pop(0)
+            if not waiter.done():
+                waiter.set_result(True)
+                return
+        self.in_flight = max(0, self.in_flight - 1)
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    @property
+    def queue_depth(self):
+        return len(self._waiters)
+
+    def stats(self):
+        return {
+            'in_flight': self.in_flight,
+            'queue_depth': self.queue_depth,
+            'admitted': self.admitted,
+            'shed_queue_full': self.shed_queue_full,
+            'shed_deadline': self.shed_deadline
+        }
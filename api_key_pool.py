@@ -0,0 +1,466 @@
+#!/usr/bin/env python3
+"""
+OpenAI API Key Pool
+Spreads concurrent completions across all healthy API keys instead of hammering one
+key until it hits 429 and then rotating. Each key tracks its in-flight requests and the
+remaining request/token budget reported in OpenAI's x-ratelimit-* response headers,
+and every request goes to the least-loaded key that still has budget.
+"""
+
+import os
+import re
+import time
+import logging
+import importlib.util
+import httpx
+from openai import AsyncOpenAI
+from key_coordinator import key_fingerprint
+from single_flight import SingleFlight, prompt_fingerprint
+from hedging import HedgeController
+from key_health import CircuitBreaker, KeyProber, classify_api_error, DEAD_KEY_REASONS
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL = "gpt-4o-mini"
+DEFAULT_EMBEDDING_MODEL = "text-embedding-3-small"
+
+# HTTP connection settings for the per-key clients
+OPENAI_MAX_CONNECTIONS = int(os.getenv('OPENAI_MAX_CONNECTIONS', '50'))
+OPENAI_MAX_KEEPALIVE = int(os.getenv('OPENAI_MAX_KEEPALIVE', '20'))
+OPENAI_KEEPALIVE_EXPIRY = float(os.getenv('OPENAI_KEEPALIVE_EXPIRY', '60'))
+OPENAI_CONNECT_TIMEOUT = float(os.getenv('OPENAI_CONNECT_TIMEOUT', '5'))
+OPENAI_READ_TIMEOUT = float(os.getenv('OPENAI_READ_TIMEOUT', '60'))
+# HTTP/2 multiplexes concurrent requests over one connection; needs the optional h2 package
+OPENAI_HTTP2 = os.getenv('OPENAI_HTTP2', 'true').lower() == 'true' and importlib.util.find_spec('h2') is not None
+
+
+def load_api_keys():
+    """Load OPENAI_API_KEY_1..OPENAI_API_KEY_19, plus OPENAI_API_KEY for backward compatibility"""
+    api_keys = []
+    for i in range(1, 20):  # Support up to 20 API keys
+        key = os.getenv(f'OPENAI_API_KEY_{i}')
+        if key:
+            api_keys.append(key)
+
+    single_key = os.getenv('OPENAI_API_KEY')
+    if single_key and single_key not in api_keys:
+        api_keys.insert(0, single_key)
+
+    return api_keys
+
+
+def parse_reset_duration(value):
+    """Parse OpenAI reset headers like '1s', '6m0s', '20ms' or '1h2m3.5s' into seconds"""
+    if not value:
+        return None
+    total = 0.0
+    matched = False
+    for amount, unit in re.findall(r'([\d.]+)(ms|h|m|s)', value):
+        matched = True
+        amount = float(amount)
+        if unit == 'ms':
+            total += amount / 1000
+        elif unit == 'h':
+            total += amount * 3600
+        elif unit == 'm':
+            total += amount * 60
+        else:
+            total += amount
+    return total if matched else None
+
+
+def build_http_client():
+    """Long-lived httpx client with keep-alive pooling and explicit timeouts"""
+    return httpx.AsyncClient(
+        http2=OPENAI_HTTP2,
+        limits=httpx.Limits(
+            max_connections=OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENAI_MAX_KEEPALIVE,
+            keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY
+        ),
+        timeout=httpx.Timeout(OPENAI_READ_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT)
+    )
+
+
+def _int_header(headers, name):
+    value = headers.get(name)
+    try:
+        return int(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def estimate_tokens(messages, max_tokens):
+    """Rough token estimate used to reserve TPM budget before the real count is known"""
+    chars = sum(len(m.get('content') or '') for m in messages)
+    return chars // 4 + max_tokens
+
+
+class KeyState:
+    """Live load and budget information for one API key"""
+
+    def __init__(self, index: int, api_key: str):
+        self.index = index
+        self.api_key = api_key
+        self.fingerprint = key_fingerprint(api_key)
+        # Built once per key and reused, so switching keys never costs a new TLS handshake
+        self.client = AsyncOpenAI(
+            api_key=api_key,
+            max_retries=0,
+            timeout=httpx.Timeout(OPENAI_READ_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT),
+            http_client=build_http_client()
+        )
+        self.in_flight = 0
+        self.limit_requests = None
+        self.limit_tokens = None
+        self.remaining_requests = None
+        self.remaining_tokens = None
+        self.requests_reset_at = 0.0
+        self.tokens_reset_at = 0.0
+        self.breaker = CircuitBreaker()
+        self.last_used = 0.0
+
+    @property
+    def number(self):
+        """Human readable key number (1-indexed)"""
+        return self.index + 1
+
+    def is_usable(self, now: float, shared=None) -> bool:
+        """Breaker closed here and key not cooling down or dead in another process (shared = coordinator view)"""
+        if not self.breaker.allows_traffic():
+            return False
+        if shared and (shared['deactivated'] or time.time() < shared['cooldown_until']):
+            return False
+        return True
+
+    def is_available(self, now: float, tokens_needed: int = 0, shared=None) -> bool:
+        if not self.is_usable(now, shared):
+            return False
+        if self.remaining_requests is not None and self.remaining_requests <= 0 and now < self.requests_reset_at:
+            return False
+        if self.remaining_tokens is not None and self.remaining_tokens < tokens_needed and now < self.tokens_reset_at:
+            return False
+        return True
+
+    def budget_ratio(self, now: float) -> float:
+        """Fraction of the rate-limit window still unused (1.0 when unknown)"""
+        ratios = []
+        if self.limit_requests and self.remaining_requests is not None and now < self.requests_reset_at:
+            ratios.append(self.remaining_requests / self.limit_requests)
+        if self.limit_tokens and self.remaining_tokens is not None and now < self.tokens_reset_at:
+            ratios.append(self.remaining_tokens / self.limit_tokens)
+        return min(ratios) if ratios else 1.0
+
+    def update_from_headers(self, headers):
+        """Refresh budget from x-ratelimit-* response headers"""
+        if not headers:
+            return
+        now = time.monotonic()
+        limit_requests = _int_header(headers, 'x-ratelimit-limit-requests')
+        limit_tokens = _int_header(headers, 'x-ratelimit-limit-tokens')
+        remaining_requests = _int_header(headers, 'x-ratelimit-remaining-requests')
+        remaining_tokens = _int_header(headers, 'x-ratelimit-remaining-tokens')
+        reset_requests = parse_reset_duration(headers.get('x-ratelimit-reset-requests'))
+        reset_tokens = parse_reset_duration(headers.get('x-ratelimit-reset-tokens'))
+
+        if limit_requests is not None:
+            self.limit_requests = limit_requests
+        if limit_tokens is not None:
+            self.limit_tokens = limit_tokens
+        if remaining_requests is not None:
+            self.remaining_requests = remaining_requests
+            self.requests_reset_at = now + (reset_requests or 60)
+        if remaining_tokens is not None:
+            self.remaining_tokens = remaining_tokens
+            self.tokens_reset_at = now + (reset_tokens or 60)
+
+
+class KeyLease:
+    """One request's reservation on a key (local in-flight slot + shared cross-process lease)"""
+
+    def __init__(self, state: KeyState, lease_id: str | None = None):
+        self.state = state
+        self.lease_id = lease_id
+
+
+class ApiKeyPool:
+    """Least-loaded selection across all API keys with per-key health and budget tracking"""
+
+    def __init__(self, api_keys: list, on_usage=None, on_rate_limit=None, on_key_disabled=None,
+                 coordinator=None):
+        """
+        on_usage(key_index, tokens_input, tokens_output) - called after every successful completion
+        on_rate_limit(key_index) - called when a key returns 429
+        on_key_disabled(key_index, reason) - called when a key is dead (401/403/invalid key)
+        coordinator - optional SharedKeyCoordinator so several processes share load and key health
+        """
+        self.keys = [KeyState(index, key) for index, key in enumerate(api_keys)]
+        self.fingerprints = {state.index: state.fingerprint for state in self.keys}
+        self.on_usage = on_usage
+        self.on_rate_limit = on_rate_limit
+        self.on_key_disabled = on_key_disabled
+        self.coordinator = coordinator
+        self.rate_limit_cooldown = float(os.getenv('API_KEY_RATE_LIMIT_COOLDOWN', '20'))
+        self.prober = KeyProber(self)
+        self.single_flight = SingleFlight()
+        self.hedging = HedgeController(on_hedge=coordinator.record_hedge if coordinator else None)
+        self.restore_health()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _shared_view(self):
+        if not self.coordinator:
+            return {}
+        return self.coordinator.snapshot(self.fingerprints)
+
+    def healthy_keys(self):
+        now = time.monotonic()
+        shared = self._shared_view()
+        return [state for state in self.keys if state.is_available(now, shared=shared.get(state.index))]
+
+    def total_in_flight(self):
+        return sum(state.in_flight for state in self.keys)
+
+    def acquire(self, tokens_needed: int = 0, exclude=()):
+        """Pick the least-loaded healthy key and reserve a slot on it (None if no key is usable)"""
+        now = time.monotonic()
+        shared = self._shared_view()
+        candidates = [
+            state for state in self.keys
+            if state.index not in exclude and state.is_available(now, tokens_needed, shared.get(state.index))
+        ]
+        if not candidates:
+            # Budget estimates can be stale - fall back to any key that isn't dead or cooling down
+            candidates = [
+                state for state in self.keys
+                if state.index not in exclude and state.is_usable(now, shared.get(state.index))
+            ]
+        if not candidates:
+            return None
+
+        def load(state):
+            # Other processes' leases count as load too, so they don't pile onto the same key
+            leases = shared[state.index]['leases'] if state.index in shared else 0
+            return max(state.in_flight, leases)
+
+        state = min(candidates, key=lambda s: (load(s), -s.budget_ratio(now), s.last_used))
+        state.in_flight += 1
+        state.last_used = now
+        # Reserve budget locally until the response headers give us the real numbers
+        if state.remaining_requests is not None:
+            state.remaining_requests -= 1
+        if state.remaining_tokens is not None:
+            state.remaining_tokens -= tokens_needed
+
+        lease_id = self.coordinator.reserve(state.index, tokens_needed) if self.coordinator else None
+        return KeyLease(state, lease_id)
+
+    def release(self, lease: KeyLease, headers=None):
+        state = lease.state
+        state.in_flight = max(0, state.in_flight - 1)
+        state.update_from_headers(headers)
+        if self.coordinator:
+            self.coordinator.release(lease.lease_id)
+
+    def restore_health(self):
+        """Re-open breakers for keys recorded as dead or cooling down before the last restart"""
+        if not self.coordinator:
+            return
+        for key_index, (reason, open_until) in self.coordinator.load_health(self.fingerprints).items():
+            state = self.keys[key_index]
+            state.breaker.restore(reason, open_until)
+            logger.info(f"🔴 API key #{state.number} restored as {reason} - the prober will re-check it")
+
+    def sync_shared_health(self):
+        """Adopt keys another process found dead, so this process's prober re-checks them too"""
+        now = time.time()
+        for key_index, shared in self._shared_view().items():
+            breaker = self.keys[key_index].breaker
+            if shared['deactivated'] and breaker.allows_traffic(now):
+                breaker.restore(shared['deactivated'], now)
+
+    def start_prober(self):
+        """Start background health probing; call once the event loop is running"""
+        return self.prober.start()
+
+    def mark_rate_limited(self, state: KeyState, retry_after: float | None = None):
+        state.breaker.trip('rate_limit', retry_after, self.rate_limit_cooldown)
+        if self.coordinator:
+            self.coordinator.set_cooldown(state.index, state.fingerprint, state.breaker.open_until)
+        if self.on_rate_limit:
+            self.on_rate_limit(state.index)
+
+    def mark_disabled(self, state: KeyState, reason: str):
+        state.breaker.trip(reason)
+        if self.coordinator:
+            self.coordinator.mark_deactivated(state.index, state.fingerprint, reason)
+        if self.on_key_disabled:
+            self.on_key_disabled(state.index, reason)
+
+    def reopen(self, state: KeyState, reason: str, retry_after: float | None = None):
+        """A probe failed - open the breaker again with a longer back-off"""
+        state.breaker.trip(reason, retry_after, self.rate_limit_cooldown)
+        if self.coordinator and reason not in DEAD_KEY_REASONS:
+            self.coordinator.set_cooldown(state.index, state.fingerprint, state.breaker.open_until)
+
+    def mark_recovered(self, state: KeyState):
+        """A probe succeeded - close the breaker and clear the shared dead/cooldown state"""
+        previous = state.breaker.reason
+        state.breaker.reset()
+        if self.coordinator:
+            self.coordinator.mark_recovered(state.index, state.fingerprint)
+        logger.info(f"🟢 API key #{state.number} recovered (was {previous})")
+
+    def _handle_key_error(self, state: KeyState, api_error):
+        """Open the key's breaker for key-specific errors and return the reason; re-raise anything else"""
+        reason, retry_after = classify_api_error(api_error)
+        if reason is None:
+            raise api_error
+
+        if reason == "rate_limit":
+            logger.warning(f"⚠️ API key #{state.number} - Rate limit (429)")
+            self.mark_rate_limited(state, retry_after)
+        else:
+            logger.warning(f"⚠️ API key #{state.number} - {reason}")
+            self.mark_disabled(state, reason)
+        logger.info(f"🔄 Moving to another API key due to {reason}...")
+        return reason
+
+    async def embeddings(self, texts: list, model: str = DEFAULT_EMBEDDING_MODEL):
+        """Embed a batch of texts on the least-loaded key, with the same key failover as completions"""
+        tokens_needed = sum(len(text) for text in texts) // 4
+        tried = set()
+        last_reason = None
+
+        while len(tried) < len(self.keys):
+            lease = self.acquire(tokens_needed, exclude=tried)
+            if lease is None:
+                break
+            state = lease.state
+            tried.add(state.index)
+            headers = None
+            try:
+                raw = await state.client.embeddings.with_raw_response.create(model=model, input=texts)
+                headers = raw.headers
+                response = raw.parse()
+                if self.on_usage and response.usage:
+                    self.on_usage(state.index, response.usage.prompt_tokens, 0)
+                return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+            except Exception as api_error:
+                response = getattr(api_error, 'response', None)
+                headers = getattr(response, 'headers', None)
+                last_reason = self._handle_key_error(state, api_error)
+            finally:
+                self.release(lease, headers)
+
+        raise Exception(f"All API keys exhausted. Last error: {last_reason}")
+
+    async def chat_completion(self, messages: list, on_delta=None, model: str = DEFAULT_MODEL,
+                              max_tokens: int = 500, temperature: float = 0.7):
+        """Run a chat completion on the least-loaded key, moving to another key on 401/403/429.
+
+        If on_delta is given the completion is streamed and on_delta(text_so_far) is awaited
+        as tokens arrive. Identical concurrent requests share one completion; callers that
+        join an in-flight request get deltas from then on only if the first caller streams.
+        """
+        key = prompt_fingerprint(messages, model=model, max_tokens=max_tokens, temperature=temperature)
+        return await self.single_flight.run(
+            key,
+            lambda fan_out: self._chat_completion(messages, fan_out, model, max_tokens, temperature),
+            on_delta=on_delta
+        )
+
+    async def _chat_completion(self, messages: list, on_delta, model: str, max_tokens: int, temperature: float):
+        tokens_needed = estimate_tokens(messages, max_tokens)
+        # Shared by the primary and a possible hedge, so they never use the same key
+        tried = set()
+        if len(self.keys) < 2:
+            return await self._complete(messages, on_delta, model, max_tokens, temperature, tokens_needed, tried)
+        return await self.hedging.run(
+            model, tokens_needed,
+            lambda attempt_delta, attempt: self._complete(
+                messages, attempt_delta, model, max_tokens, temperature, tokens_needed, tried, attempt),
+            on_delta=on_delta
+        )
+
+    async def _complete(self, messages: list, on_delta, model: str, max_tokens: int, temperature: float,
+                        tokens_needed: int, tried: set, attempt=None):
+        last_reason = None
+
+        while len(tried) < len(self.keys):
+            lease = self.acquire(tokens_needed, exclude=tried)
+            if lease is None:
+                break
+            state = lease.state
+            tried.add(state.index)
+            if attempt is not None:
+                attempt.state = state
+            headers = None
+            try:
+                raw = await state.client.chat.completions.with_raw_response.create(
+                    model=model,
+                    messages=messages,
+                    max_tokens=max_tokens,
+                    temperature=temperature,
+                    **({"stream": True, "stream_options": {"include_usage": True}} if on_delta else {})
+                )
+                headers = raw.headers
+
+                if on_delta:
+                    parts = []
+                    usage = None
+                    async for chunk in raw.parse():
+                        if chunk.usage:
+                            usage = chunk.usage
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            parts.append(chunk.choices[0].delta.content)
+                            await on_delta(''.join(parts))
+                    ai_response = ''.join(parts)
+                else:
+                    response = raw.parse()
+                    ai_response = response.choices[0].message.content
+                    usage = response.usage
+
+                tokens_input = usage.prompt_tokens if usage else 0
+                tokens_output = usage.completion_tokens if usage else 0
+                if self.on_usage:
+                    self.on_usage(state.index, tokens_input, tokens_output)
+                self.hedging.note_tokens(tokens_input + tokens_output)
+                logger.info(f"✅ API call on key #{state.number}. Tokens: {tokens_input} in + {tokens_output} out = {tokens_input + tokens_output} total")
+                return ai_response
+
+            except Exception as api_error:
+                response = getattr(api_error, 'response', None)
+                headers = getattr(response, 'headers', None)
+                last_reason = self._handle_key_error(state, api_error)
+
+            finally:
+                self.release(lease, headers)
+
+        logger.error(f"❌ All {len(self.keys)} API keys failed!")
+        raise Exception(f"All API keys exhausted. Last error: {last_reason}")
+
+    def status_summary(self):
+        """Per-key snapshot for admin screens and logs"""
+        now = time.time()
+        shared = self._shared_view()
+        summary = []
+        for state in self.keys:
+            key_shared = shared.get(state.index)
+            breaker_state = state.breaker.current_state(now)
+            if state.breaker.is_dead or (key_shared and key_shared['deactivated']):
+                status = state.breaker.reason if state.breaker.is_dead else key_shared['deactivated']
+            elif breaker_state != 'closed' or (key_shared and now < key_shared['cooldown_until']):
+                status = "cooling_down"
+            else:
+                status = "healthy"
+            summary.append({
+                'key_index': state.index,
+                'status': status,
+                'breaker': breaker_state,
+                'in_flight': state.in_flight,
+                'remaining_requests': state.remaining_requests,
+                'remaining_tokens': state.remaining_tokens
+            })
+        return summary
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Async Database Facade
+Handlers await SQLite work instead of running it on the event loop, so a slow disk
+no longer stalls every chat:
+
+- reads run on a small thread pool (each thread keeps its own db.connect() connection)
+- writes run in order on one dedicated writer thread, so they never contend with
+  each other for the write lock
+- a read or write with a key (usually the user id) waits for that key's earlier
+  writes, so every user sees their own writes in order
+- at most DB_MAX_PENDING_WRITES writes may be queued; further writers wait until
+  the writer thread catches up (backpressure)
+
+Any existing blocking helper can be used as is: await adb.read(self.get_recent_history, user_id, 3).
+"""
+
+import os
+import queue
+import asyncio
+import logging
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+DB_READ_WORKERS = int(os.getenv('DB_READ_WORKERS', '4'))
+DB_MAX_PENDING_WRITES = int(os.getenv('DB_MAX_PENDING_WRITES', '500'))
+
+
+def _resolve(future, result, error):
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+class AsyncDatabase:
+    """Awaitable reads (thread pool) and ordered writes (single writer thread)"""
+
+    def __init__(self, name: str = 'db', read_workers: int = DB_READ_WORKERS,
+                 max_pending_writes: int = DB_MAX_PENDING_WRITES):
+        self.name = name
+        self.max_pending_writes = max_pending_writes
+        self._readers = ThreadPoolExecutor(max_workers=read_workers, thread_name_prefix=f"{name}-read")
+        self._queue = queue.Queue()
+        self._write_slots = None
+        self._pending = {}
+        self.writes = 0
+        self.reads = 0
+        self._writer = threading.Thread(target=self._write_loop, name=f"{name}-writer", daemon=True)
+        self._writer.start()
+
+    def _write_loop(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            fn, loop, future = job
+            try:
+                result, error = fn(), None
+            except Exception as e:
+                result, error = None, e
+                logger.error(f"❌ [{self.name}] Database write failed: {e}")
+            try:
+                loop.call_soon_threadsafe(_resolve, future, result, error)
+            except RuntimeError:
+                pass  # The caller's event loop is already closed
+
+    async def _after_pending(self, key):
+        pending = self._pending.get(key) if key is not None else None
+        if pending is not None and not pending.done():
+            await asyncio.wait({pending})
+
+    async def read(self, fn, *args, key=None, **kwargs):
+        """Run a blocking read on the reader pool (after pending writes for key)"""
+        await self._after_pending(key)
+        self.reads += 1
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._readers, functools.partial(fn, *args, **kwargs))
+
+    async def write(self, fn, *args, key=None, **kwargs):
+        """Run a blocking write on the writer thread and wait for its result"""
+        if self._write_slots is None:
+            self._write_slots = asyncio.Semaphore(self.max_pending_writes)
+        async with self._write_slots:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self._queue.put((functools.partial(fn, *args, **kwargs), loop, future))
+            self.writes += 1
+            if key is not None:
+                self._pending[key] = future
+            try:
+                # Once queued the write always happens, even if this caller is cancelled
+                return await asyncio.shield(future)
+            finally:
+                if key is not None and self._pending.get(key) is future and future.done():
+                    del self._pending[key]
+
+    @property
+    def pending_writes(self):
+        return self._queue.qsize()
+
+    def close(self, timeout: float = 10.0):
+        """Finish queued writes, then stop the writer thread and reader pool"""
+        self._queue.put(None)
+        self._writer.join(timeout)
+        self._readers.shutdown(wait=True)
+
+    def stats(self):
+        return {
+            'reads': self.reads,
+            'writes': self.writes,
+            'pending_writes': self.pending_writes
+        }
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+Knowledge Retrieval (BM25)
+Lexical alternative to the embedding index for deployments that can't afford
+embedding calls (KNOWLEDGE_RETRIEVAL=bm25). Runs fully offline.
+
+Tokens are normalized for mixed Hindi / Hinglish / English text: case folding,
+Devanagari kept as-is, elongated spellings collapsed ("kyaaa" -> "kya") and common
+filler words dropped. The index keeps term frequencies, document frequencies and
+the total length, so a knowledge edit only touches the postings of the entries that
+changed; BM25 weights (which depend on those corpus totals) are computed per query
+over the question's postings.
+"""
+
+import re
+import math
+import heapq
+import sqlite3
+import db
+import logging
+import unicodedata
+from collections import Counter
+from response_cache import knowledge_version
+from knowledge_index import KNOWLEDGE_SOURCES, KNOWLEDGE_TOP_K, content_hash
+
+logger = logging.getLogger(__name__)
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+TOKEN_PATTERN = re.compile(r'[\wऀ-ॿ]+')
+REPEATED_CHARS = re.compile(r'([a-z])\1+')
+
+STOPWORDS = {
+    # English
+    'a', 'an', 'the', 'is', 'are', 'was', 'be', 'to', 'of', 'in', 'on', 'for', 'and', 'or',
+    'i', 'you', 'my', 'it', 'this', 'that', 'do', 'can', 'what', 'how', 'please', 'pls',
+    # Hinglish (after repeated-letter collapsing)
+    'hai', 'he', 'h', 'ho', 'ka', 'ki', 'ke', 'ko', 'se', 'me', 'mein', 'mai', 'main', 'aur',
+    'kya', 'kia', 'ye', 'yeh', 'wo', 'woh', 'bhi', 'to', 'toh', 'na', 'ne', 'hum', 'tum', 'ap',
+    'aap', 'bhai', 'bro', 'sir', 'ji', 'hi', 'hello',
+    # Hindi
+    'है', 'का', 'की', 'के', 'को', 'से', 'में', 'और', 'क्या', 'यह', 'वह', 'भी', 'तो', 'हैं',
+}
+
+
+def tokenize(text: str) -> list:
+    """Normalized content tokens of a Hindi/Hinglish/English text"""
+    text = unicodedata.normalize('NFKC', text or '').casefold()
+    tokens = []
+    for token in TOKEN_PATTERN.findall(text):
+        token = REPEATED_CHARS.sub(r'\1', token)
+        if token and token not in STOPWORDS:
+            tokens.append(token)
+    return tokens
+
+
+class BM25KnowledgeIndex:
+    """BM25 index over bot_knowledge and account_knowledge titles and texts"""
+
+    def __init__(self, db_path: str, top_k: int = KNOWLEDGE_TOP_K):
+        self.db_path = db_path
+        self.top_k = top_k
+        self.enabled = True
+        self.docs = {}          # (source, id) -> (hash, Counter of tokens, length)
+        self.postings = {}      # token -> {source: {id: term frequency}}
+        self.document_frequency = Counter()
+        self.total_length = 0
+        self.version = None
+
+    def _load_entries(self):
+        conn = db.connect(self.db_path)
+        entries = {}
+        try:
+            for source, query in KNOWLEDGE_SOURCES.items():
+                try:
+                    rows = conn.execute(query).fetchall()
+                except sqlite3.OperationalError:
+                    continue
+                for entry_id, title, text in rows:
+                    entries[(source, entry_id)] = (title, text)
+        finally:
+            conn.close()
+        return entries
+
+    def refresh(self):
+        """Re-index only added/edited/deleted entries; other entries' postings are left alone"""
+        version = knowledge_version(self.db_path)
+        if version is not None and version == self.version:
+            return
+        entries = self._load_entries()
+
+        changed = 0
+        for key in [key for key in self.docs if key not in entries]:
+            self._remove_doc(key)
+            changed += 1
+        for key, (title, text) in entries.items():
+            digest = content_hash(title, text)
+            if key in self.docs:
+                if self.docs[key][0] == digest:
+                    continue
+                self._remove_doc(key)
+            # Title words count twice - they usually name the topic
+            tokens = tokenize(title) * 2 + tokenize(text)
+            self._add_doc(key, digest, Counter(tokens), len(tokens))
+            changed += 1
+
+        if changed:
+            logger.info(f"🔎 BM25 knowledge index: {changed} entries updated, {len(self.docs)} indexed")
+        self.version = version
+
+    def _add_doc(self, key, digest: str, counts: Counter, length: int):
+        source, entry_id = key
+        self.docs[key] = (digest, counts, length)
+        self.total_length += length
+        for token, tf in counts.items():
+            self.postings.setdefault(token, {}).setdefault(source, {})[entry_id] = tf
+            self.document_frequency[token] += 1
+
+    def _remove_doc(self, key):
+        source, entry_id = key
+        _, counts, length = self.docs.pop(key)
+        self.total_length -= length
+        for token in counts:
+            by_source = self.postings[token]
+            by_source[source].pop(entry_id, None)
+            if not by_source[source]:
+                del by_source[source]
+            if not by_source:
+                del self.postings[token]
+            self.document_frequency[token] -= 1
+            if self.document_frequency[token] <= 0:
+                del self.document_frequency[token]
+
+    def rank(self, question: str, source: str, entries: list, top_k: int = None):
+        """Entries (dicts with an 'id') ordered by BM25 score, best first, at most top_k"""
+        top_k = top_k or self.top_k
+        scores = {}
+        doc_count = len(self.docs)
+        avg_length = (self.total_length / doc_count if doc_count else 0) or 1.0
+        for token in set(tokenize(question)):
+            postings = self.postings.get(token, {}).get(source)
+            if not postings:
+                continue
+            df = self.document_frequency[token]
+            idf = max(0.0, math.log(1 + (doc_count - df + 0.5) / (df + 0.5)))
+            for entry_id, tf in postings.items():
+                length = self.docs[(source, entry_id)][2]
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * length / avg_length)
+                scores[entry_id] = scores.get(entry_id, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+
+        # Entries can be a scope-filtered subset of the index, so look a bit deeper than top_k
+        best = []
+        if scores:
+            ranked = heapq.nlargest(top_k * 4, scores, key=scores.get)
+            wanted = set(ranked)
+            by_id = {entry['id']: entry for entry in entries if entry['id'] in wanted}
+            if len(by_id) < min(top_k, len(scores)):
+                by_id = {entry['id']: entry for entry in entries}
+                ranked = sorted(scores, key=scores.get, reverse=True)
+            best = [by_id[entry_id] for entry_id in ranked if entry_id in by_id][:top_k]
+        if len(best) < top_k:
+            # Not enough matches - fill up with the remaining entries in their original order
+            chosen = {id(entry) for entry in best}
+            best += [entry for entry in entries if id(entry) not in chosen][:top_k - len(best)]
+        return best
+
+    async def select(self, question: str, source: str, entries: list, top_k: int = None):
+        """Same interface as KnowledgeVectorIndex.select"""
+        top_k = top_k or self.top_k
+        if len(entries) <= top_k or not question:
+            return entries
+        try:
+            self.refresh()
+        except sqlite3.Error as e:
+            logger.warning(f"⚠️ BM25 refresh failed, using all entries: {e}")
+            return entries
+        return self.rank(question, source, entries, top_k)
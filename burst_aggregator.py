@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Burst Aggregator
+Users often send several short messages in a row ("hi", "bro", "price?"). Instead of
+one completion per message (with replies racing each other), messages from the same
+chat are collected until the user is quiet for BURST_QUIET_WINDOW seconds and then
+answered with a single reply. If new input arrives at any point before that reply
+starts going out (history reads, admission queue, generation), the claimed burst is
+superseded - its generation is cancelled and it sends nothing - and the newer burst
+is answered again with all messages.
+"""
+
+import os
+import time
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+BURST_QUIET_WINDOW = float(os.getenv('BURST_QUIET_WINDOW', '1.0'))
+BURST_MAX_WAIT = float(os.getenv('BURST_MAX_WAIT', '4.0'))
+
+
+class BurstHandle:
+    """One claimed burst; the caller keeps it from collect() through finish()"""
+
+    def __init__(self, chat_key):
+        self.chat_key = chat_key
+        self.texts = []
+        self.version = 0
+        self.started_at = time.monotonic()
+        self.claimed = False
+        self.delivering = False
+        self.superseded = False
+        self.generation = None
+
+    @property
+    def text(self) -> str:
+        return '\n'.join(self.texts)
+
+
+class BurstAggregator:
+    """Per-chat debouncing of consecutive messages into one AI request"""
+
+    def __init__(self, quiet_window: float = BURST_QUIET_WINDOW, max_wait: float = BURST_MAX_WAIT):
+        self.quiet_window = quiet_window
+        self.max_wait = max_wait
+        self._bursts = {}
+        self.merged_messages = 0
+        self.cancelled_generations = 0
+
+    async def collect(self, chat_key, text: str):
+        """Add a message to the chat's burst.
+
+        Returns the claimed BurstHandle once the chat has been quiet for the window, or
+        None if a newer message took over the burst (the caller should then just return).
+        """
+        burst = self._bursts.get(chat_key)
+        if burst is not None and burst.claimed:
+            if burst.delivering:
+                # Previous reply is already going out - this message starts a new burst
+                burst = None
+            else:
+                # Still being prepared (DB reads, admission, generation): the newer
+                # burst answers these messages too, the claimed one must not reply
+                self._supersede(burst)
+                previous_texts = burst.texts
+                burst = self._bursts[chat_key] = BurstHandle(chat_key)
+                burst.texts = list(previous_texts)
+        if burst is None:
+            burst = self._bursts[chat_key] = BurstHandle(chat_key)
+
+        burst.texts.append(text)
+        burst.version += 1
+        version = burst.version
+
+        wait = min(self.quiet_window, burst.started_at + self.max_wait - time.monotonic())
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+        if self._bursts.get(chat_key) is not burst or burst.version != version:
+            self.merged_messages += 1
+            return None
+        burst.claimed = True
+        return burst
+
+    def _supersede(self, burst: BurstHandle):
+        burst.superseded = True
+        if burst.generation is not None and not burst.generation.done():
+            burst.generation.cancel()
+            self.cancelled_generations += 1
+            logger.info(f"✂️ New message in {burst.chat_key} - cancelled stale reply generation")
+
+    def deliver(self, burst: BurstHandle) -> bool:
+        """Mark the burst as replying; False if newer input superseded it (send nothing)"""
+        if burst.superseded:
+            return False
+        burst.delivering = True
+        return True
+
+    async def generate(self, burst: BurstHandle, coro):
+        """Run the reply generation for a claimed burst.
+
+        Returns its result, or None if it was cancelled because newer input arrived.
+        A returned result means the burst is now delivering and the caller should send it.
+        """
+        if burst.superseded:
+            coro.close()
+            return None
+        task = asyncio.ensure_future(coro)
+        burst.generation = task
+        await asyncio.wait({task})
+        if task.cancelled():
+            return None
+        if not self.deliver(burst):
+            task.exception()    # superseded anyway; don't leave the error unretrieved
+            return None
+        return task.result()
+
+    def finish(self, burst: BurstHandle):
+        """Forget a burst after its reply was sent (or it failed)"""
+        if self._bursts.get(burst.chat_key) is burst:
+            del self._bursts[burst.chat_key]
+
+    def stats(self):
+        return {
+            'merged_messages': self.merged_messages,
+            'cancelled_generations': self.cancelled_generations,
+            'active_bursts': len(self._bursts)
+        }
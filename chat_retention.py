@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""
+Chat History Retention
+chat_history receives every reply of all three bots and used to grow forever. A
+background job of the main bot now moves rows older than CHAT_RETENTION_DAYS into
+one archive file per month and deletes them from the hot table:
+
+- archives are JSONL, compressed with zstd when zstandard is installed, else gzip
+  (CHAT_ARCHIVE_DIR/chat_history-YYYY-MM.jsonl.zst / .gz); each batch is appended
+  as its own compressed frame/member, so the files decompress as one stream
+- rows are archived and deleted RETENTION_BATCH_SIZE at a time, walking the primary
+  key from the oldest id and stopping at the first unexpired row, and each batch is
+  a short transaction so the bots' writes are not held up
+- a batch is written and fsynced inside the transaction that deletes it; only a
+  crash between the fsync and the commit can archive a batch twice, never lose it
+- freed pages are returned to the filesystem with incremental vacuum; converting an
+  existing database to it needs one full VACUUM, which holds the write lock for
+  every process, so it only runs with CHAT_RETENTION_VACUUM_CONVERT=true (set it
+  for one start during a quiet window) - otherwise freed pages are just reused
+
+Hot-table reads (get_recent_history, context lookups) then only ever see the last
+CHAT_RETENTION_DAYS days. CHAT_RETENTION_DAYS=0 keeps everything.
+"""
+
+import os
+import gzip
+import json
+import time
+import sqlite3
+import asyncio
+import logging
+import db
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+CHAT_RETENTION_DAYS = int(os.getenv('CHAT_RETENTION_DAYS', '90'))
+CHAT_ARCHIVE_DIR = os.getenv('CHAT_ARCHIVE_DIR', 'chat_archive')
+CHAT_ARCHIVE_COMPRESSION = os.getenv('CHAT_ARCHIVE_COMPRESSION', 'zstd' if zstandard else 'gzip').lower()
+RETENTION_BATCH_SIZE = int(os.getenv('RETENTION_BATCH_SIZE', '1000'))
+RETENTION_INTERVAL = float(os.getenv('RETENTION_INTERVAL', '3600'))
+# Pause between batches so bot writes get the lock in between
+RETENTION_BATCH_PAUSE = float(os.getenv('RETENTION_BATCH_PAUSE', '0.05'))
+# Free pages returned to the filesystem per incremental_vacuum call
+RETENTION_VACUUM_PAGES = int(os.getenv('RETENTION_VACUUM_PAGES', '2000'))
+# Opt-in: the one-time conversion VACUUM blocks every other writer while it runs
+CHAT_RETENTION_VACUUM_CONVERT = os.getenv('CHAT_RETENTION_VACUUM_CONVERT', 'false').lower() == 'true'
+
+AUTO_VACUUM_INCREMENTAL = 2
+
+
+class ChatRetention:
+    """Archives and prunes chat_history rows older than the retention window"""
+
+    def __init__(self, db_path: str, retention_days: int = CHAT_RETENTION_DAYS,
+                 archive_dir: str = CHAT_ARCHIVE_DIR, compression: str = CHAT_ARCHIVE_COMPRESSION,
+                 batch_size: int = RETENTION_BATCH_SIZE, interval: float = RETENTION_INTERVAL,
+                 vacuum_convert: bool = CHAT_RETENTION_VACUUM_CONVERT):
+        self.db_path = db_path
+        self.retention_days = retention_days
+        self.archive_dir = archive_dir
+        if compression == 'zstd' and zstandard is None:
+            logger.warning("⚠️ zstandard not installed - chat archives use gzip")
+            compression = 'gzip'
+        self.compression = compression
+        self.batch_size = batch_size
+        self.interval = interval
+        self.vacuum_convert = vacuum_convert
+        self.enabled = retention_days > 0
+        self.rows_archived = 0
+        self.last_run = None
+        self._task = None
+        self._vacuum_checked = False
+
+    def archive_path(self, month: str) -> str:
+        extension = 'zst' if self.compression == 'zstd' else 'gz'
+        return os.path.join(self.archive_dir, f"chat_history-{month}.jsonl.{extension}")
+
+    def _append(self, month: str, rows):
+        """Append rows to the month's archive as one compressed frame and fsync it"""
+        data = ''.join(json.dumps(row, ensure_ascii=False, default=str) + '\n' for row in rows).encode()
+        if self.compression == 'zstd':
+            data = zstandard.ZstdCompressor(level=10).compress(data)
+        else:
+            data = gzip.compress(data)
+        with open(self.archive_path(month), 'ab') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def ensure_incremental_vacuum(self, conn):
+        """Switch the database to auto_vacuum=INCREMENTAL (one full VACUUM, only when opted in)"""
+        if self._vacuum_checked:
+            return
+        self._vacuum_checked = True
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == AUTO_VACUUM_INCREMENTAL:
+            return
+        if not self.vacuum_convert:
+            logger.info("🗜️ Chat database is not in incremental auto-vacuum mode - skipping the one-time "
+                        "VACUUM (set CHAT_RETENTION_VACUUM_CONVERT=true for one start to convert it)")
+            return
+        logger.info("🗜️ Converting chat database to incremental auto-vacuum (one-time VACUUM)...")
+        try:
+            conn.execute(f'PRAGMA auto_vacuum = {AUTO_VACUUM_INCREMENTAL}')
+            conn.execute('VACUUM')
+        except sqlite3.OperationalError as e:
+            # Another connection was busy; freed pages are still reused for new rows
+            logger.warning(f"⚠️ Could not enable incremental vacuum yet: {e}")
+            self._vacuum_checked = False
+
+    def archive_batch(self, conn):
+        """Archive and delete one batch of expired rows; returns the number of rows moved
+
+        Rows are walked by primary key from the oldest id (ids grow with time) and the
+        walk stops at the first row inside the retention window, so no pass ever scans
+        the table. Select, archive and delete share one write transaction: if the
+        database is busy nothing has been archived yet.
+        """
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            cutoff = conn.execute("SELECT datetime('now', ?)", (f'-{self.retention_days} days',)).fetchone()[0]
+            cursor = conn.execute('SELECT * FROM chat_history ORDER BY id LIMIT ?', (self.batch_size,))
+            columns = [c[0] for c in cursor.description]
+            rows = []
+            for values in cursor.fetchall():
+                row = dict(zip(columns, values))
+                if row['timestamp'] is None or str(row['timestamp']) >= cutoff:
+                    break
+                rows.append(row)
+            if not rows:
+                conn.rollback()
+                return 0
+
+            by_month = {}
+            for row in rows:
+                by_month.setdefault(str(row['timestamp'])[:7], []).append(row)
+            for month, month_rows in by_month.items():
+                self._append(month, month_rows)
+
+            conn.executemany('DELETE FROM chat_history WHERE id = ?', [(row['id'],) for row in rows])
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        return len(rows)
+
+    def run_once(self, max_batches: int = None):
+        """Archive everything past the retention window, then reclaim space; returns rows moved"""
+        if not self.enabled:
+            return 0
+        os.makedirs(self.archive_dir, exist_ok=True)
+        conn = db.connect(self.db_path)
+        moved = 0
+        try:
+            self.ensure_incremental_vacuum(conn)
+            batches = 0
+            while max_batches is None or batches < max_batches:
+                count = self.archive_batch(conn)
+                if not count:
+                    break
+                moved += count
+                batches += 1
+                time.sleep(RETENTION_BATCH_PAUSE)
+
+            if moved and conn.execute('PRAGMA auto_vacuum').fetchone()[0] == AUTO_VACUUM_INCREMENTAL:
+                # Return freed pages to the filesystem a slice at a time
+                free_pages = conn.execute('PRAGMA freelist_count').fetchone()[0]
+                for _ in range(-(-free_pages // RETENTION_VACUUM_PAGES)):
+                    # executescript steps the pragma to completion (execute() frees a single page)
+                    conn.executescript(f'PRAGMA incremental_vacuum({RETENTION_VACUUM_PAGES});')
+                    time.sleep(RETENTION_BATCH_PAUSE)
+        finally:
+            conn.close()
+        self.rows_archived += moved
+        self.last_run = time.time()
+        if moved:
+            logger.info(f"🗃️ Archived {moved} chat messages older than {self.retention_days} days to {self.archive_dir}/")
+        return moved
+
+    def start(self):
+        """Start the periodic retention pass on the running event loop"""
+        if self.enabled and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._run())
+            logger.info(f"🗃️ Chat retention started (keeping {self.retention_days} days, {self.compression} archives)")
+        return self._task
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.run_once)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Chat retention pass failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'retention_days': self.retention_days,
+            'rows_archived': self.rows_archived,
+            'last_run': self.last_run
+        }
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Full-Text Chat Search
+Admin search over chat_history through the chat_history_fts FTS5 index (schema
+migration 6; triggers keep it in sync with every insert, edit, prune and archive).
+
+The admin types plain words, optionally followed by a time window:
+    refund            -> every message or reply mentioning "refund"
+    refund policy 7d  -> both words, within the last 7 days
+
+Words are quoted before they reach MATCH, so user input can never be parsed as FTS
+syntax. Results are ranked with bm25() and paginated with LIMIT/OFFSET. If SQLite
+was built without FTS5 the search falls back to a (slow) LIKE scan, returning the
+first SNIPPET_CHARS characters of each message and reply.
+"""
+
+import os
+import re
+import sqlite3
+import logging
+import db
+
+logger = logging.getLogger(__name__)
+
+CHAT_SEARCH_PAGE_SIZE = int(os.getenv('CHAT_SEARCH_PAGE_SIZE', '5'))
+
+DAYS_PATTERN = re.compile(r'^(\d{1,4})d$', re.IGNORECASE)
+SNIPPET_TOKENS = 12
+# Longest message/response text returned per result, so a page fits in one Telegram message
+SNIPPET_CHARS = 200
+# Rendered page length kept below Telegram's 4096-character message limit
+CHAT_SEARCH_MAX_CHARS = 3800
+
+
+def parse_search(text: str):
+    """Split admin input into (words, days or None)"""
+    words = text.split()
+    days = None
+    if len(words) > 1:
+        match = DAYS_PATTERN.match(words[-1])
+        if match:
+            days = int(match.group(1))
+            words = words[:-1]
+    return words, days
+
+
+def fts_query(words) -> str:
+    """Quote each word so the input is matched literally (all words must appear)"""
+    return ' '.join('"' + word.replace('"', '""') + '"' for word in words)
+
+
+def clip(text, limit: int = SNIPPET_CHARS) -> str:
+    """Shorten text to limit characters, marking the cut with …"""
+    text = str(text or '')
+    return text if len(text) <= limit else text[:limit] + '…'
+
+
+def _clipped(column: str) -> str:
+    return (f"CASE WHEN length({column}) > {SNIPPET_CHARS} "
+            f"THEN substr({column}, 1, {SNIPPET_CHARS}) || '…' ELSE {column} END")
+
+
+def _has_fts(conn) -> bool:
+    row = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'chat_history_fts'").fetchone()
+    return row is not None
+
+
+def search_chats(db_path: str, words, days: int = None, page: int = 0,
+                 page_size: int = CHAT_SEARCH_PAGE_SIZE):
+    """One page of matches, best first: (total_matches, [(username, chat_type, timestamp, message, response)])"""
+    if not words:
+        return 0, []
+    since = f'-{days} days' if days else None
+    conn = db.connect(db_path)
+    try:
+        if _has_fts(conn):
+            where = '''
+                chat_history_fts MATCH ?
+                AND (? IS NULL OR ch.timestamp >= datetime('now', ?))
+            '''
+            params = (fts_query(words), since, since)
+            total = conn.execute(f'''
+                SELECT COUNT(*) FROM chat_history_fts
+                JOIN chat_history ch ON ch.id = chat_history_fts.rowid
+                WHERE {where}
+            ''', params).fetchone()[0]
+            rows = conn.execute(f'''
+                SELECT COALESCE(au.username, ch.username, ch.user_id), ch.chat_type, ch.timestamp,
+                       snippet(chat_history_fts, 0, '«', '»', '…', {SNIPPET_TOKENS}),
+                       snippet(chat_history_fts, 1, '«', '»', '…', {SNIPPET_TOKENS})
+                FROM chat_history_fts
+                JOIN chat_history ch ON ch.id = chat_history_fts.rowid
+                LEFT JOIN all_users au ON au.user_id = ch.user_id
+                WHERE {where}
+                ORDER BY bm25(chat_history_fts)
+                LIMIT ? OFFSET ?
+            ''', params + (page_size, page * page_size)).fetchall()
+        else:
+            conditions = ' AND '.join(['(ch.message LIKE ? OR ch.response LIKE ?)'] * len(words))
+            like_params = tuple(p for word in words for p in (f'%{word}%', f'%{word}%'))
+            where = f"{conditions} AND (? IS NULL OR ch.timestamp >= datetime('now', ?))"
+            params = like_params + (since, since)
+            total = conn.execute(f'SELECT COUNT(*) FROM chat_history ch WHERE {where}', params).fetchone()[0]
+            rows = conn.execute(f'''
+                SELECT COALESCE(au.username, ch.username, ch.user_id), ch.chat_type, ch.timestamp,
+                       {_clipped('ch.message')}, {_clipped('ch.response')}
+                FROM chat_history ch
+                LEFT JOIN all_users au ON au.user_id = ch.user_id
+                WHERE {where}
+                ORDER BY ch.timestamp DESC
+                LIMIT ? OFFSET ?
+            ''', params + (page_size, page * page_size)).fetchall()
+    except sqlite3.OperationalError as e:
+        logger.warning(f"⚠️ Chat search failed: {e}")
+        return 0, []
+    finally:
+        conn.close()
+    return total, rows
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Cross-Process Config Cache
+The personal bot and the multi-account manager used to re-read bot_knowledge,
+group_keywords and account_knowledge from chat_history.db on every DM, because only
+the main bot's admin panel edits them. ConfigCache keeps those tables in memory:
+
+- at most every CONFIG_CACHE_CHECK_INTERVAL seconds it reads PRAGMA data_version on
+  its own connection, which only changes when another connection committed
+- only then does it read config_versions (bumped per table by the triggers from
+  schema migration 2) and reload just the tables whose counter moved
+
+Between checks a lookup touches no database at all, and admin edits made by any
+process show up within CONFIG_CACHE_CHECK_INTERVAL.
+"""
+
+import os
+import time
+import sqlite3
+import logging
+import threading
+import db
+from keyword_matcher import KeywordRuleIndex
+
+logger = logging.getLogger(__name__)
+
+CONFIG_CACHE_CHECK_INTERVAL = float(os.getenv('CONFIG_CACHE_CHECK_INTERVAL', '0.5'))
+
+
+def load_bot_knowledge(conn):
+    """All bot_knowledge rows, oldest first: (id, text, target_scope, priority, status, updated_at)"""
+    return conn.execute('''
+        SELECT id, knowledge_text, target_scope, priority, status, updated_at
+        FROM bot_knowledge
+        ORDER BY created_at ASC
+    ''').fetchall()
+
+
+def load_group_keywords(conn):
+    """Keyword rules compiled into a per-scope KeywordRuleIndex, in the order they were added"""
+    return KeywordRuleIndex(conn.execute('''
+        SELECT keyword, response, scope, scope_id, is_regex, priority
+        FROM group_keywords
+        ORDER BY id
+    ''').fetchall())
+
+
+def load_account_knowledge(conn):
+    """{account_id: [(id, text, priority), ...]} of active entries, super entries first"""
+    by_account = {}
+    rows = conn.execute('''
+        SELECT account_id, id, knowledge_text, priority
+        FROM account_knowledge
+        WHERE status = 'active'
+        ORDER BY
+            account_id,
+            CASE priority
+                WHEN 'super' THEN 0
+                ELSE 1
+            END,
+            updated_at DESC
+    ''').fetchall()
+    for account_id, entry_id, text, priority in rows:
+        by_account.setdefault(account_id, []).append((entry_id, text, priority))
+    return by_account
+
+
+# Cached tables: name -> loader(conn); each name is also its config_versions counter
+CONFIG_TABLES = {
+    'bot_knowledge': load_bot_knowledge,
+    'group_keywords': load_group_keywords,
+    'account_knowledge': load_account_knowledge,
+}
+
+
+class ConfigCache:
+    """In-memory copies of admin-edited tables, reloaded only when they change"""
+
+    def __init__(self, db_path: str, loaders: dict = None, check_interval: float = CONFIG_CACHE_CHECK_INTERVAL):
+        self.db_path = db_path
+        self.loaders = dict(loaders or CONFIG_TABLES)
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        # data_version is per connection, so the cache keeps its own
+        self._conn = db.open_connection(db_path, check_same_thread=False)
+        self._data_version = None
+        self._versions = {}
+        self._values = {}
+        self._checked_at = 0.0
+        self.checks = 0
+        self.reloads = 0
+
+    def get(self, name: str):
+        """Current contents of a cached table"""
+        if time.monotonic() - self._checked_at >= self.check_interval or name not in self._values:
+            self.refresh()
+        return self._values[name]
+
+    def refresh(self):
+        """Reload the tables whose config_versions counter changed since the last check"""
+        with self._lock:
+            self._checked_at = time.monotonic()
+            self.checks += 1
+            data_version = self._conn.execute('PRAGMA data_version').fetchone()[0]
+            if data_version == self._data_version and len(self._values) == len(self.loaders):
+                return
+            try:
+                versions = dict(self._conn.execute('SELECT name, version FROM config_versions').fetchall())
+            except sqlite3.OperationalError:
+                versions = {}
+
+            for name, loader in self.loaders.items():
+                version = versions.get(name)
+                # Without a counter (table not versioned) reload on every data change
+                if name in self._values and version is not None and self._versions.get(name) == version:
+                    continue
+                self._values[name] = loader(self._conn)
+                self._versions[name] = version
+                self.reloads += 1
+                logger.info(f"🔄 Reloaded cached {name} (version {version})")
+            self._data_version = data_version
+
+    def stats(self):
+        return {
+            'checks': self.checks,
+            'reloads': self.reloads
+        }
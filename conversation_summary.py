@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+Rolling Conversation Summaries
+Older chat_history turns are folded in the background into a short per-user summary
+stored in user_sessions.session_context. Prompts then carry "summary + every turn
+after it", so long-running users get better context at a fixed token cost. A long
+backlog is folded SUMMARY_MAX_FOLD_TURNS turns per pass, oldest first.
+"""
+
+import os
+import db
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_ENABLED = os.getenv('CONVERSATION_SUMMARY', 'true').lower() == 'true'
+SUMMARY_KEEP_TURNS = int(os.getenv('SUMMARY_KEEP_TURNS', '3'))
+SUMMARY_MIN_NEW_TURNS = int(os.getenv('SUMMARY_MIN_NEW_TURNS', '6'))
+SUMMARY_MAX_TOKENS = int(os.getenv('SUMMARY_MAX_TOKENS', '200'))
+SUMMARY_INTERVAL = float(os.getenv('SUMMARY_INTERVAL', '30'))
+# Turns folded per completion, so a long backlog never overflows the context window
+SUMMARY_MAX_FOLD_TURNS = int(os.getenv('SUMMARY_MAX_FOLD_TURNS', '40'))
+
+SUMMARY_INSTRUCTIONS = (
+    "You maintain a short memory of a Telegram conversation between a user and an AI assistant. "
+    "Update the existing summary with the new turns. Keep facts about the user (name, needs, "
+    "products asked about, decisions, open questions) and drop small talk. Write in the same "
+    "language mix the user uses (Hindi/Hinglish/English). Maximum 120 words."
+)
+
+
+class ConversationSummarizer:
+    """Background job that keeps user_sessions.session_context up to date"""
+
+    def __init__(self, db_path: str, key_pool, keep_turns: int = SUMMARY_KEEP_TURNS,
+                 min_new_turns: int = SUMMARY_MIN_NEW_TURNS, interval: float = SUMMARY_INTERVAL,
+                 max_fold_turns: int = SUMMARY_MAX_FOLD_TURNS):
+        self.db_path = db_path
+        self.key_pool = key_pool
+        self.keep_turns = keep_turns
+        self.min_new_turns = min_new_turns
+        self.interval = interval
+        self.max_fold_turns = max(max_fold_turns, min_new_turns)
+        self.enabled = SUMMARY_ENABLED and key_pool is not None
+        self._pending = set()
+        self._task = None
+
+    def note_activity(self, user_id: int):
+        """Queue a user for summarization after a new turn was saved"""
+        if self.enabled:
+            self._pending.add(user_id)
+
+    def start(self):
+        """Start the background loop on the running event loop"""
+        if self.enabled and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._run())
+            logger.info(f"🧠 Conversation summarizer started (every {self.interval:.0f}s)")
+        return self._task
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            users, self._pending = self._pending, set()
+            for user_id in users:
+                try:
+                    await self.summarize_user(user_id)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.warning(f"⚠️ Could not summarize conversation of {user_id}: {e}")
+
+    def _load_unsummarized(self, user_id: int):
+        """Summary, and the oldest unsummarized turns: one fold chunk plus the kept recent turns"""
+        conn = db.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('SELECT session_context, summarized_until FROM user_sessions WHERE user_id = ?', (user_id,))
+        row = cursor.fetchone()
+        summary, summarized_until = (row[0], row[1] or 0) if row else (None, 0)
+        cursor.execute('''
+            SELECT id, message, response FROM chat_history
+            WHERE user_id = ? AND id > ?
+            ORDER BY id ASC
+            LIMIT ?
+        ''', (user_id, summarized_until, self.max_fold_turns + self.keep_turns))
+        turns = cursor.fetchall()
+        conn.close()
+        return summary, turns
+
+    def get_context(self, user_id: int):
+        """(summary, turns) for a prompt: every turn the summary does not cover yet, oldest first
+
+        Between folds up to keep_turns + min_new_turns - 1 turns are unsummarized, so that
+        many recent turns are returned; without summaries just the last keep_turns.
+        """
+        limit = self.keep_turns + self.min_new_turns - 1 if self.enabled else self.keep_turns
+        conn = db.connect(self.db_path)
+        try:
+            summary, summarized_until = None, 0
+            if self.enabled:
+                row = conn.execute('SELECT session_context, summarized_until FROM user_sessions WHERE user_id = ?',
+                                   (user_id,)).fetchone()
+                if row:
+                    summary, summarized_until = row[0] or None, row[1] or 0
+            turns = conn.execute('''
+                SELECT message, response FROM chat_history
+                WHERE user_id = ? AND id > ?
+                ORDER BY id DESC
+                LIMIT ?
+            ''', (user_id, summarized_until, limit)).fetchall()
+        finally:
+            conn.close()
+        return summary, list(reversed(turns))
+
+    def _save_summary(self, user_id: int, summary: str, summarized_until: int):
+        conn = db.connect(self.db_path)
+        conn.execute('''
+            INSERT INTO user_sessions (user_id, session_context, summarized_until, summary_updated_at, last_active)
+            VALUES (?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+            ON CONFLICT(user_id) DO UPDATE SET
+                session_context = excluded.session_context,
+                summarized_until = excluded.summarized_until,
+                summary_updated_at = CURRENT_TIMESTAMP,
+                last_active = CURRENT_TIMESTAMP
+        ''', (user_id, summary, summarized_until))
+        conn.commit()
+        conn.close()
+
+    async def summarize_user(self, user_id: int):
+        """Fold the oldest unsummarized turns (at most max_fold_turns, never the last keep_turns) into the summary"""
+        summary, turns = await asyncio.to_thread(self._load_unsummarized, user_id)
+        to_fold = turns[:-self.keep_turns] if self.keep_turns else turns
+        to_fold = to_fold[:self.max_fold_turns]
+        if len(to_fold) < self.min_new_turns:
+            return
+
+        transcript = '\n'.join(f"User: {message}\nAssistant: {response}" for _, message, response in to_fold)
+        messages = [
+            {"role": "system", "content": SUMMARY_INSTRUCTIONS},
+            {"role": "user", "content": f"Existing summary:\n{summary or '(none)'}\n\nNew turns:\n{transcript}"}
+        ]
+        new_summary = await self.key_pool.chat_completion(messages, max_tokens=SUMMARY_MAX_TOKENS, temperature=0.2)
+        if not new_summary:
+            return
+
+        await asyncio.to_thread(self._save_summary, user_id, new_summary.strip(), to_fold[-1][0])
+        logger.info(f"🧠 Summarized {len(to_fold)} older turns for user {user_id}")
+        if len(turns) == self.max_fold_turns + self.keep_turns:
+            # Long backlog (e.g. a user from before summaries existed): next chunk on the next pass
+            self._pending.add(user_id)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Shared SQLite Access
+The main bot, the personal bot, the multi-account manager and the account
+authenticator all share chat_history.db. Opening a fresh connection per helper
+call cost 6-8 connection setups per incoming message, and the default rollback
+journal made the processes block each other ("database is locked").
+
+connect() hands out the calling thread's long-lived connection to a database:
+
+- WAL journal, so readers never block the writer and vice versa
+- busy_timeout, so a briefly locked database is waited for instead of failing
+- synchronous=NORMAL plus a larger page cache and in-memory temp storage
+- a prepared-statement cache (cached_statements) that survives between calls
+
+Callers keep the usual connect / cursor / commit / close pattern: close() only
+releases the connection (rolling back anything left uncommitted, like a real
+close would) and the connection stays open for the next call on that thread.
+"""
+
+import os
+import sqlite3
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+DB_PATH = 'chat_history.db'
+
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000'))
+SQLITE_CACHE_SIZE_KB = int(os.getenv('SQLITE_CACHE_SIZE_KB', '16384'))
+SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', str(64 * 1024 * 1024)))
+SQLITE_CACHED_STATEMENTS = int(os.getenv('SQLITE_CACHED_STATEMENTS', '256'))
+
+_local = threading.local()
+_all_connections = []
+_all_lock = threading.Lock()
+
+
+def configure(conn, foreign_keys: bool = False, busy_timeout_ms: int = SQLITE_BUSY_TIMEOUT_MS):
+    """Apply the shared pragmas to a connection"""
+    conn.execute(f'PRAGMA busy_timeout = {busy_timeout_ms}')
+    try:
+        # Persistent per database file; the first process to open it switches it over
+        conn.execute('PRAGMA journal_mode = WAL')
+    except sqlite3.OperationalError as e:
+        logger.warning(f"⚠️ Could not enable WAL mode: {e}")
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute(f'PRAGMA cache_size = -{SQLITE_CACHE_SIZE_KB}')
+    conn.execute('PRAGMA temp_store = MEMORY')
+    conn.execute(f'PRAGMA mmap_size = {SQLITE_MMAP_SIZE}')
+    if foreign_keys:
+        conn.execute('PRAGMA foreign_keys = ON')
+    return conn
+
+
+def open_connection(db_path: str = DB_PATH, foreign_keys: bool = False, **kwargs):
+    """A new, fully configured connection (for callers that manage its lifetime themselves)"""
+    kwargs.setdefault('timeout', SQLITE_BUSY_TIMEOUT_MS / 1000)
+    kwargs.setdefault('cached_statements', SQLITE_CACHED_STATEMENTS)
+    return configure(sqlite3.connect(db_path, **kwargs), foreign_keys=foreign_keys,
+                     busy_timeout_ms=int(kwargs['timeout'] * 1000))
+
+
+class PooledConnection:
+    """Handle to a thread's long-lived connection; close() releases instead of closing"""
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def close(self):
+        if self._conn is not None and self._conn.in_transaction:
+            self._conn.rollback()
+        self._conn = None
+
+    def __getattr__(self, name):
+        if self._conn is None:
+            raise sqlite3.ProgrammingError("Cannot operate on a closed database.")
+        return getattr(self._conn, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # Same as sqlite3.Connection: commit on success, roll back on error
+        return self._conn.__exit__(exc_type, exc, tb)
+
+
+def connect(db_path: str = DB_PATH, foreign_keys: bool = False) -> PooledConnection:
+    """The calling thread's long-lived connection to db_path"""
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+    key = (db_path, foreign_keys)
+    conn = connections.get(key)
+    if conn is None:
+        conn = connections[key] = open_connection(db_path, foreign_keys=foreign_keys)
+        with _all_lock:
+            _all_connections.append(conn)
+    elif conn.in_transaction:
+        # A previous caller failed before commit/close - discard its half-done work
+        conn.rollback()
+    return PooledConnection(conn)
+
+
+def close_all():
+    """Close every pooled connection (at shutdown)"""
+    with _all_lock:
+        connections, _all_connections[:] = list(_all_connections), []
+    for conn in connections:
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+    _local.__dict__.pop('connections', None)
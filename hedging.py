@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+Hedged Completion Requests
+Most completions return in ~2s, but a few take 15-30s on an unlucky key or backend.
+With HEDGE_REQUESTS=true, a request that hasn't answered by the live HEDGE_PERCENTILE
+latency of its model gets a duplicate on a different healthy key; the first answer
+wins and the other request is cancelled. For streamed replies "answered" means the
+first token arrived, so only one stream ever reaches the user.
+
+Extra spend is capped: hedges may use at most HEDGE_BUDGET_RATIO of the tokens all
+completions used so far (default 5%).
+"""
+
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+HEDGE_ENABLED = os.getenv('HEDGE_REQUESTS', 'false').lower() == 'true'
+HEDGE_PERCENTILE = float(os.getenv('HEDGE_PERCENTILE', '95'))
+HEDGE_MIN_DELAY = float(os.getenv('HEDGE_MIN_DELAY', '1.0'))
+HEDGE_MIN_SAMPLES = int(os.getenv('HEDGE_MIN_SAMPLES', '20'))
+HEDGE_BUDGET_RATIO = float(os.getenv('HEDGE_BUDGET_RATIO', '0.05'))
+LATENCY_WINDOW = 500
+
+
+class LatencyTracker:
+    """Sliding window of recent latencies per model"""
+
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self.window = window
+        self._samples = {}
+
+    def record(self, model: str, seconds: float):
+        self._samples.setdefault(model, deque(maxlen=self.window)).append(seconds)
+
+    def percentile(self, model: str, pct: float, min_samples: int = 1):
+        """pct-th percentile latency of the model, or None with fewer than min_samples samples"""
+        samples = self._samples.get(model)
+        if not samples or len(samples) < min_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+class _Attempt:
+    """One of the racing requests; the pool fills in the key it ended up on"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.state = None
+        self.started_at = time.monotonic()
+        self.task = None
+
+
+class HedgeController:
+    """Decides when to hedge and runs the primary/hedge race"""
+
+    def __init__(self, enabled: bool = HEDGE_ENABLED, percentile: float = HEDGE_PERCENTILE,
+                 min_delay: float = HEDGE_MIN_DELAY, budget_ratio: float = HEDGE_BUDGET_RATIO,
+                 min_samples: int = HEDGE_MIN_SAMPLES, on_hedge=None):
+        """on_hedge(key_index, won, tokens) - called when a hedge finished, for per-key reporting"""
+        self.enabled = enabled
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.budget_ratio = budget_ratio
+        self.min_samples = min_samples
+        self.on_hedge = on_hedge
+        self.latency = LatencyTracker()
+        self.total_tokens = 0
+        self.hedge_tokens = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.skipped_budget = 0
+
+    def note_tokens(self, tokens: int):
+        """Count tokens of every completed request - the base the hedge budget is a share of"""
+        self.total_tokens += tokens
+
+    def hedge_delay(self, model: str):
+        """Seconds to wait before hedging, or None while there is too little latency data"""
+        threshold = self.latency.percentile(model, self.percentile, self.min_samples)
+        if threshold is None:
+            return None
+        return max(self.min_delay, threshold)
+
+    def within_budget(self, tokens_needed: int) -> bool:
+        return self.hedge_tokens + tokens_needed <= self.budget_ratio * self.total_tokens
+
+    async def run(self, model: str, tokens_needed: int, attempt, on_delta=None):
+        """Run attempt(on_delta, info) and hedge it with a second call if it is too slow.
+
+        attempt must pick a key not used by any earlier attempt and store it in info.state.
+        """
+        latency_key = f"{model}:stream" if on_delta else model
+        delay = self.hedge_delay(latency_key) if self.enabled else None
+
+        attempts = []
+        winner = None
+        responded = asyncio.Event()
+
+        def gate(current):
+            async def push(text):
+                # The first attempt to stream a token owns the reply; the other one is cancelled
+                nonlocal winner
+                if winner is None:
+                    winner = current
+                    responded.set()
+                    self.latency.record(latency_key, time.monotonic() - current.started_at)
+                    for other in attempts:
+                        if other is not current:
+                            other.task.cancel()
+                if winner is current:
+                    await on_delta(text)
+            return push if on_delta else None
+
+        def launch(name):
+            current = _Attempt(name)
+            current.task = asyncio.ensure_future(attempt(gate(current), current))
+            attempts.append(current)
+            return current
+
+        primary = launch('primary')
+        try:
+            if delay is not None:
+                waiter = asyncio.ensure_future(responded.wait())
+                await asyncio.wait({primary.task, waiter}, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+                waiter.cancel()
+                if not primary.task.done() and not responded.is_set():
+                    if self.within_budget(tokens_needed):
+                        self.hedged += 1
+                        self.hedge_tokens += tokens_needed
+                        launch('hedge')
+                        logger.info(f"🏇 Hedging slow {model} request after {delay:.1f}s")
+                    else:
+                        self.skipped_budget += 1
+
+            pending = {current.task for current in attempts}
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for current in attempts:
+                    if current.task not in done or current.task.cancelled():
+                        continue
+                    if current.task.exception() is not None:
+                        error = current.task.exception()
+                        continue
+                    for other in pending:
+                        other.cancel()
+                    self._finished(current, attempts, latency_key, tokens_needed, streamed=winner is not None)
+                    return current.task.result()
+            raise error or asyncio.CancelledError()
+        finally:
+            for current in attempts:
+                if not current.task.done():
+                    current.task.cancel()
+
+    def _finished(self, current, attempts, latency_key, tokens_needed, streamed):
+        if not streamed:
+            self.latency.record(latency_key, time.monotonic() - current.started_at)
+        if len(attempts) < 2:
+            return
+        hedge = attempts[1]
+        won = current is hedge
+        if won:
+            self.hedge_wins += 1
+            logger.info(f"🏁 Hedged request won on key #{hedge.state.index + 1}")
+        if self.on_hedge and hedge.state is not None:
+            self.on_hedge(hedge.state.index, won, tokens_needed)
+
+    def stats(self):
+        return {
+            'hedged': self.hedged,
+            'hedge_wins': self.hedge_wins,
+            'skipped_budget': self.skipped_budget,
+            'hedge_tokens': self.hedge_tokens,
+            'total_tokens': self.total_tokens
+        }
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+"""
+Cross-Process API Key Coordination
+The main bot, the personal bot and the multi-account manager all load the same
+OPENAI_API_KEY_n list. Without coordination each process picks keys on its own and
+they trigger each other's 429s. This module shares key load and health through
+chat_history.db:
+
+- api_key_leases: one row per in-flight request (expiring, so a crashed process
+  can never hold capacity forever)
+- api_key_stats.cooldown_until / is_deactivated: shared "cooling down" and "dead" state
+
+Leases are taken and returned in memory; a background thread mirrors them into
+api_key_leases every LEASE_SYNC_INTERVAL seconds in one short transaction, so the
+request path never waits on the database write lock (requests shorter than one
+interval never touch the table). The shared view is cached for a fraction of a
+second, so coordination adds very little lock contention.
+"""
+
+import os
+import time
+import uuid
+import socket
+import sqlite3
+import hashlib
+import logging
+import threading
+import db
+from migrations import migrate
+
+logger = logging.getLogger(__name__)
+
+LEASE_TTL_SECONDS = float(os.getenv('API_KEY_LEASE_TTL', '120'))
+SNAPSHOT_MAX_AGE = float(os.getenv('API_KEY_SNAPSHOT_MAX_AGE', '0.25'))
+LEASE_SYNC_INTERVAL = float(os.getenv('API_KEY_LEASE_SYNC_INTERVAL', '0.25'))
+
+
+def key_fingerprint(api_key: str) -> str:
+    """Short stable id for a key so shared state is dropped when a key at an index is replaced"""
+    return hashlib.sha256(api_key.encode()).hexdigest()[:16]
+
+
+class SharedKeyCoordinator:
+    """Shares per-key leases, cooldowns and deactivation between processes"""
+
+    def __init__(self, db_path: str, holder_name: str = 'bot'):
+        self.db_path = db_path
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{holder_name}"
+        self._lock = threading.Lock()
+        self._conn = db.open_connection(db_path, timeout=1.0, check_same_thread=False, isolation_level=None)
+        self._snapshot = None
+        self._snapshot_at = 0.0
+        self._last_cleanup = 0.0
+        # lease_id -> (key_index, tokens_reserved, expires_at) of this process's requests
+        self._leases = {}
+        self._synced = set()
+        self._leases_lock = threading.Lock()
+        # Own connection, so a sync waiting on the write lock never holds up snapshot() reads
+        self._sync_lock = threading.Lock()
+        self._sync_conn = db.open_connection(db_path, timeout=5.0, check_same_thread=False, isolation_level=None)
+        self.ensure_schema()
+        self._sync_thread = threading.Thread(target=self._sync_loop, name=f"{holder_name}-key-leases", daemon=True)
+        self._sync_thread.start()
+
+    def ensure_schema(self):
+        """Apply pending schema migrations and drop expired leases"""
+        migrate(self.db_path)
+        with self._lock:
+            # Leases left behind by a previous run of this process name are stale now
+            self._conn.execute('DELETE FROM api_key_leases WHERE expires_at < ?', (time.time(),))
+
+    def snapshot(self, fingerprints: dict):
+        """Shared view of all keys: {key_index: {'leases', 'tokens_reserved', 'cooldown_until', 'deactivated'}}
+
+        fingerprints maps key_index -> key_fingerprint() of the key this process loaded;
+        shared state recorded for a different key at the same index is ignored.
+        """
+        now = time.time()
+        if self._snapshot is not None and time.monotonic() - self._snapshot_at < SNAPSHOT_MAX_AGE:
+            return self._snapshot
+
+        view = {index: {'leases': 0, 'tokens_reserved': 0, 'cooldown_until': 0.0, 'deactivated': None}
+                for index in fingerprints}
+        try:
+            with self._lock:
+                cursor = self._conn.cursor()
+                cursor.execute('''
+                    SELECT key_index, COUNT(*), COALESCE(SUM(tokens_reserved), 0)
+                    FROM api_key_leases
+                    WHERE expires_at > ?
+                    GROUP BY key_index
+                ''', (now,))
+                lease_rows = cursor.fetchall()
+                cursor.execute('''
+                    SELECT key_index, cooldown_until, is_deactivated, deactivation_reason, key_fingerprint
+                    FROM api_key_stats
+                    WHERE (cooldown_until IS NOT NULL AND cooldown_until > ?) OR is_deactivated = 1
+                ''', (now,))
+                state_rows = cursor.fetchall()
+        except sqlite3.Error as e:
+            # Coordination is best-effort: if the DB is busy, keep routing on local state
+            logger.warning(f"⚠️ Key coordination snapshot failed: {e}")
+            return self._snapshot or view
+
+        for key_index, leases, tokens_reserved in lease_rows:
+            if key_index in view:
+                view[key_index]['leases'] = leases
+                view[key_index]['tokens_reserved'] = tokens_reserved
+
+        for key_index, cooldown_until, is_deactivated, reason, fingerprint in state_rows:
+            if key_index not in view or fingerprint != fingerprints[key_index]:
+                continue
+            if cooldown_until and cooldown_until > now:
+                view[key_index]['cooldown_until'] = cooldown_until
+            if is_deactivated:
+                view[key_index]['deactivated'] = reason or 'deactivated'
+
+        self._snapshot = view
+        self._snapshot_at = time.monotonic()
+        return view
+
+    def reserve(self, key_index: int, tokens: int = 0):
+        """Take an expiring lease on a key before calling it; returns the lease id (never blocks)"""
+        lease_id = uuid.uuid4().hex
+        with self._leases_lock:
+            self._leases[lease_id] = (key_index, tokens, time.time() + LEASE_TTL_SECONDS)
+
+        if self._snapshot and key_index in self._snapshot:
+            self._snapshot[key_index]['leases'] += 1
+            self._snapshot[key_index]['tokens_reserved'] += tokens
+        return lease_id
+
+    def release(self, lease_id: str | None):
+        """Return a lease once the request has finished; the row is removed on the next sync"""
+        if not lease_id:
+            return
+        with self._leases_lock:
+            self._leases.pop(lease_id, None)
+
+    def sync_leases(self):
+        """Mirror this process's in-memory leases into api_key_leases in one transaction"""
+        now = time.time()
+        with self._leases_lock:
+            added = [(lease_id, key_index, self.holder, tokens, expires_at)
+                     for lease_id, (key_index, tokens, expires_at) in self._leases.items()
+                     if lease_id not in self._synced]
+            removed = [(lease_id,) for lease_id in self._synced if lease_id not in self._leases]
+        cleanup = now - self._last_cleanup > LEASE_TTL_SECONDS
+        if not added and not removed and not cleanup:
+            return
+
+        try:
+            with self._sync_lock:
+                cursor = self._sync_conn.cursor()
+                cursor.execute('BEGIN IMMEDIATE')
+                try:
+                    cursor.executemany('''
+                        INSERT OR REPLACE INTO api_key_leases (lease_id, key_index, holder, tokens_reserved, expires_at)
+                        VALUES (?, ?, ?, ?, ?)
+                    ''', added)
+                    cursor.executemany('DELETE FROM api_key_leases WHERE lease_id = ?', removed)
+                    if cleanup:
+                        cursor.execute('DELETE FROM api_key_leases WHERE expires_at < ?', (now,))
+                    cursor.execute('COMMIT')
+                except BaseException:
+                    cursor.execute('ROLLBACK')
+                    raise
+        except sqlite3.Error as e:
+            # Nothing is lost: the same differences are retried on the next sync
+            logger.warning(f"⚠️ Could not sync API key leases: {e}")
+            return
+
+        if cleanup:
+            self._last_cleanup = now
+        with self._leases_lock:
+            self._synced.update(row[0] for row in added)
+            self._synced.difference_update(row[0] for row in removed)
+
+    def _sync_loop(self):
+        while True:
+            time.sleep(LEASE_SYNC_INTERVAL)
+            try:
+                self.sync_leases()
+            except Exception as e:
+                logger.error(f"❌ API key lease sync failed: {e}")
+
+    def set_cooldown(self, key_index: int, fingerprint: str, until: float):
+        """Tell every process to stay off this key until the given unix time"""
+        try:
+            with self._lock:
+                self._conn.execute('''
+                    INSERT INTO api_key_stats (key_index, usage_count, rate_limit_hits, cooldown_until, key_fingerprint)
+                    VALUES (?, 0, 0, ?, ?)
+                    ON CONFLICT(key_index) DO UPDATE SET
+                        cooldown_until = MAX(COALESCE(cooldown_until, 0), excluded.cooldown_until),
+                        key_fingerprint = excluded.key_fingerprint
+                ''', (key_index, until, fingerprint))
+        except sqlite3.Error as e:
+            logger.warning(f"⚠️ Could not share cooldown for API key #{key_index + 1}: {e}")
+        self._snapshot = None
+
+    def mark_deactivated(self, key_index: int, fingerprint: str, reason: str):
+        """Record a dead key so no process sends user traffic to it again"""
+        try:
+            with self._lock:
+                self._conn.execute('''
+                    INSERT INTO api_key_stats (key_index, usage_count, rate_limit_hits, is_deactivated,
+                                               deactivation_reason, deactivated_at, key_fingerprint)
+                    VALUES (?, 0, 0, 1, ?, CURRENT_TIMESTAMP, ?)
+                    ON CONFLICT(key_index) DO UPDATE SET
+                        is_deactivated = 1,
+                        deactivation_reason = excluded.deactivation_reason,
+                        deactivated_at = CURRENT_TIMESTAMP,
+                        key_fingerprint = excluded.key_fingerprint
+                ''', (key_index, reason, fingerprint))
+        except sqlite3.Error as e:
+            logger.warning(f"⚠️ Could not share deactivation of API key #{key_index + 1}: {e}")
+        self._snapshot = None
+
+    def mark_recovered(self, key_index: int, fingerprint: str):
+        """Clear dead/cooldown state after a successful health probe"""
+        try:
+            with self._lock:
+                self._conn.execute('''
+                    UPDATE api_key_stats
+                    SET is_deactivated = 0, deactivation_reason = NULL, deactivated_at = NULL,
+                        cooldown_until = NULL, key_fingerprint = ?
+                    WHERE key_index = ?
+                ''', (fingerprint, key_index))
+        except sqlite3.Error as e:
+            logger.warning(f"⚠️ Could not share recovery of API key #{key_index + 1}: {e}")
+        self._snapshot = None
+
+    def record_hedge(self, key_index: int, won: bool, tokens: int):
+        """Count a hedged duplicate request sent on this key (and whether it answered first)"""
+        try:
+            with self._lock:
+                self._conn.execute('''
+                    INSERT INTO api_key_stats (key_index, usage_count, rate_limit_hits, hedged_requests, hedge_wins, hedge_tokens)
+                    VALUES (?, 0, 0, 1, ?, ?)
+                    ON CONFLICT(key_index) DO UPDATE SET
+                        hedged_requests = COALESCE(hedged_requests, 0) + 1,
+                        hedge_wins = COALESCE(hedge_wins, 0) + excluded.hedge_wins,
+                        hedge_tokens = COALESCE(hedge_tokens, 0) + excluded.hedge_tokens
+                ''', (key_index, 1 if won else 0, tokens))
+        except sqlite3.Error as e:
+            logger.warning(f"⚠️ Could not record hedge for API key #{key_index + 1}: {e}")
+
+    def load_health(self, fingerprints: dict):
+        """Persisted breaker state at startup: {key_index: (reason, open_until)}
+
+        Dead keys come back open until now, so the prober re-checks them right away
+        instead of a user request. Rows written before fingerprints existed are trusted.
+        """
+        now = time.time()
+        try:
+            with self._lock:
+                rows = self._conn.execute('''
+                    SELECT key_index, is_deactivated, deactivation_reason, cooldown_until, key_fingerprint
+                    FROM api_key_stats
+                    WHERE is_deactivated = 1 OR (cooldown_until IS NOT NULL AND cooldown_until > ?)
+                ''', (now,)).fetchall()
+        except sqlite3.Error as e:
+            logger.warning(f"⚠️ Could not load persisted API key health: {e}")
+            return {}
+
+        health = {}
+        for key_index, is_deactivated, reason, cooldown_until, fingerprint in rows:
+            if key_index not in fingerprints:
+                continue
+            if fingerprint is not None and fingerprint != fingerprints[key_index]:
+                continue
+            if is_deactivated:
+                health[key_index] = (reason or 'account_deactivated', now)
+            else:
+                health[key_index] = ('rate_limit', cooldown_until)
+        return health
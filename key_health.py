@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+API Key Health
+Per-key circuit breakers so user traffic only ever goes to keys known to work.
+
+- closed:    key is healthy and receives traffic
+- open:      key failed (429, 401, 403, quota) and is skipped until open_until
+- half_open: open period is over; the background prober re-checks the key before
+             it is closed again - a free models.list() call for auth/forbidden
+             failures, a 1-token completion for quota and rate limits (models.list()
+             still succeeds on keys that cannot complete anything)
+
+Breaker state is persisted in api_key_stats (via SharedKeyCoordinator), so a
+restart does not walk back into dead keys on live requests.
+"""
+
+import os
+import time
+import asyncio
+import logging
+from openai import AuthenticationError, PermissionDeniedError, RateLimitError, APIStatusError
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# Reasons that mean the key itself is broken (as opposed to temporarily throttled)
+DEAD_KEY_REASONS = ('account_deactivated', 'invalid_key', 'forbidden', 'quota_exhausted')
+
+KEY_PROBE_INTERVAL = float(os.getenv('API_KEY_PROBE_INTERVAL', '5'))
+DEAD_KEY_RETRY_BASE = float(os.getenv('API_KEY_DEAD_RETRY_BASE', '300'))
+DEAD_KEY_RETRY_MAX = float(os.getenv('API_KEY_DEAD_RETRY_MAX', '21600'))
+KEY_PROBE_MODEL = os.getenv('API_KEY_PROBE_MODEL', 'gpt-4o-mini')
+
+# Failures that only a real completion can rule out
+COMPLETION_PROBE_REASONS = ('quota_exhausted', 'rate_limit')
+
+
+def retry_after_seconds(headers):
+    """Read retry-after-ms / retry-after from a response, or None if not present"""
+    if not headers:
+        return None
+    try:
+        value = headers.get('retry-after-ms')
+        if value is not None:
+            return float(value) / 1000
+        value = headers.get('retry-after')
+        if value is not None:
+            return float(value)
+    except (TypeError, ValueError):
+        return None
+    return None
+
+
+def classify_api_error(error):
+    """Return (reason, retry_after) for key-specific errors, or (None, None) for anything else"""
+    response = getattr(error, 'response', None)
+    retry_after = retry_after_seconds(getattr(response, 'headers', None))
+    code = getattr(error, 'code', None)
+
+    if isinstance(error, AuthenticationError):
+        return ('invalid_key' if code == 'invalid_api_key' else 'account_deactivated'), None
+    if isinstance(error, PermissionDeniedError):
+        return 'forbidden', None
+    if isinstance(error, RateLimitError):
+        # 429 with insufficient_quota is a billing problem, not a burst - the key is unusable
+        if code == 'insufficient_quota':
+            return 'quota_exhausted', None
+        return 'rate_limit', retry_after
+    if isinstance(error, APIStatusError):
+        if error.status_code == 401:
+            return 'account_deactivated', None
+        if error.status_code == 403:
+            return 'forbidden', None
+        if error.status_code == 429:
+            return 'rate_limit', retry_after
+    return None, None
+
+
+class CircuitBreaker:
+    """closed / open / half_open state for one API key (times are unix timestamps)"""
+
+    def __init__(self):
+        self.state = CLOSED
+        self.reason = None
+        self.open_until = 0.0
+        self.failures = 0
+
+    @property
+    def is_dead(self):
+        return self.state != CLOSED and self.reason in DEAD_KEY_REASONS
+
+    def current_state(self, now: float = None) -> str:
+        now = time.time() if now is None else now
+        if self.state == OPEN and now >= self.open_until:
+            return HALF_OPEN
+        return self.state
+
+    def allows_traffic(self, now: float = None) -> bool:
+        """Only closed breakers receive user requests; half-open keys wait for the prober"""
+        return self.current_state(now) == CLOSED
+
+    def trip(self, reason: str, retry_after: float = None, cooldown: float = 20.0):
+        """Open the breaker; dead keys back off exponentially between probes"""
+        self.failures += 1
+        if reason in DEAD_KEY_REASONS:
+            delay = min(DEAD_KEY_RETRY_BASE * 2 ** (self.failures - 1), DEAD_KEY_RETRY_MAX)
+        else:
+            delay = retry_after or cooldown
+        self.state = OPEN
+        self.reason = reason
+        self.open_until = max(self.open_until, time.time() + delay)
+
+    def restore(self, reason: str, open_until: float):
+        """Re-open a breaker from persisted state at startup"""
+        self.state = OPEN
+        self.reason = reason
+        self.open_until = open_until
+        self.failures = 1
+
+    def reset(self):
+        self.state = CLOSED
+        self.reason = None
+        self.open_until = 0.0
+        self.failures = 0
+
+
+class KeyProber:
+    """Background task that re-checks half-open keys so user requests never have to"""
+
+    def __init__(self, pool, interval: float = KEY_PROBE_INTERVAL):
+        self.pool = pool
+        self.interval = interval
+        self._task = None
+
+    def start(self):
+        """Start probing on the running event loop (safe to call more than once)"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+            logger.info(f"🩺 API key prober started (every {self.interval:.0f}s)")
+        return self._task
+
+    async def stop(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def warm_up(self):
+        """Open a connection on every healthy key at startup so the first user request skips the handshake"""
+        healthy = [state for state in self.pool.keys if state.breaker.allows_traffic()]
+        results = await asyncio.gather(*(self.probe(state) for state in healthy), return_exceptions=True)
+        warmed = sum(1 for result in results if result is True)
+        logger.info(f"🔥 Pre-warmed connections for {warmed}/{len(healthy)} API keys")
+
+    async def _run(self):
+        await self.warm_up()
+        while True:
+            try:
+                self.pool.sync_shared_health()
+                now = time.time()
+                due = [state for state in self.pool.keys if state.breaker.current_state(now) == HALF_OPEN]
+                if due:
+                    await asyncio.gather(*(self.probe(state) for state in due))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ API key prober error: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def probe(self, state):
+        """Check one key with the cheapest request that proves it works; returns True if it does"""
+        try:
+            if not state.breaker.allows_traffic() and state.breaker.reason in COMPLETION_PROBE_REASONS:
+                await state.client.chat.completions.create(
+                    model=KEY_PROBE_MODEL,
+                    messages=[{"role": "user", "content": "ping"}],
+                    max_tokens=1
+                )
+            else:
+                await state.client.models.list()
+        except Exception as error:
+            reason, retry_after = classify_api_error(error)
+            if reason is None:
+                # Network trouble says nothing about the key - try again next round
+                logger.warning(f"⚠️ Probe of API key #{state.number} inconclusive: {error}")
+                return False
+            if state.breaker.allows_traffic():
+                # Found during warm-up: record it exactly like a failure on a real request
+                if reason == 'rate_limit':
+                    self.pool.mark_rate_limited(state, retry_after)
+                else:
+                    self.pool.mark_disabled(state, reason)
+            else:
+                self.pool.reopen(state, reason, retry_after)
+            logger.warning(f"🔴 API key #{state.number} unhealthy ({reason}), next probe in "
+                           f"{state.breaker.open_until - time.time():.0f}s")
+            return False
+
+        if not state.breaker.allows_traffic():
+            self.pool.mark_recovered(state)
+        return True
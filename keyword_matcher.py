@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+"""
+Keyword Matcher (Aho-Corasick)
+group_keywords used to be matched with one `keyword in message` test per keyword on
+every message. The keywords are now compiled once into an Aho-Corasick automaton
+(rebuilt by ConfigCache whenever the table changes), so a message is scanned a
+single time no matter how many keywords there are.
+
+Matching semantics:
+- case-insensitive (str.casefold) with runs of whitespace treated as one space
+- KEYWORD_WORD_BOUNDARY=true (default): a keyword only matches as whole words, so
+  "hi" no longer fires inside "this"; edges that are not letters/digits (emoji,
+  punctuation) match anywhere
+- when several keywords match: highest priority first, then the longest keyword,
+  then the earliest position in the message, then the oldest keyword
+
+Rules can be scoped (schema migration 7): everywhere, DMs only, groups only, one
+group chat, or one managed pyrogram account. KeywordRuleIndex compiles every scope
+into its own matcher (plus its regex rules) at load time, so a message only checks
+the scopes that apply to its chat; a more specific scope wins a priority tie.
+"""
+
+import os
+import re
+import csv
+import io
+import logging
+import unicodedata
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+KEYWORD_WORD_BOUNDARY = os.getenv('KEYWORD_WORD_BOUNDARY', 'true').lower() == 'true'
+
+SCOPE_ALL = 'all'
+SCOPE_DM = 'dm'
+SCOPE_GROUP = 'group'
+SCOPE_CHAT = 'chat'
+SCOPE_ACCOUNT = 'account'
+# Scopes that need a scope_id (group chat id / pyrogram account id)
+SCOPES_WITH_ID = (SCOPE_CHAT, SCOPE_ACCOUNT)
+SCOPE_SPECIFICITY = {SCOPE_ALL: 0, SCOPE_DM: 1, SCOPE_GROUP: 1, SCOPE_CHAT: 2, SCOPE_ACCOUNT: 2}
+
+CSV_COLUMNS = ('keyword', 'response', 'scope', 'scope_id', 'regex', 'priority')
+
+
+def normalize(text: str) -> str:
+    return ' '.join(text.casefold().split())
+
+
+def is_word_char(char: str) -> bool:
+    # Combining marks count as letters, so Devanagari matras don't look like a boundary
+    return char.isalnum() or char == '_' or unicodedata.category(char).startswith('M')
+
+
+class KeywordMatcher:
+    """Aho-Corasick automaton over (keyword, response[, priority[, order]]) entries"""
+
+    def __init__(self, keywords, word_boundary: bool = KEYWORD_WORD_BOUNDARY):
+        self.word_boundary = word_boundary
+        self.patterns = []      # (folded keyword, keyword, response, priority, order)
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [()]
+
+        for index, entry in enumerate(keywords):
+            keyword, response = entry[0], entry[1]
+            priority = entry[2] if len(entry) > 2 and entry[2] is not None else 0
+            order = entry[3] if len(entry) > 3 else index
+            folded = normalize(keyword or '')
+            if folded:
+                self._add(folded, (folded, keyword, response, priority, order))
+        self._build_failure_links()
+
+    def _add(self, folded: str, pattern):
+        node = 0
+        for char in folded:
+            next_node = self._goto[node].get(char)
+            if next_node is None:
+                next_node = len(self._goto)
+                self._goto[node][char] = next_node
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(())
+            node = next_node
+        self._out[node] += (len(self.patterns),)
+        self.patterns.append(pattern)
+
+    def _build_failure_links(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+                # Every pattern ending at the fallback state also ends here
+                self._out[child] += self._out[self._fail[child]]
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def find_all(self, message: str):
+        """Every (start, end, pattern) occurrence in the message (positions in normalized text)"""
+        text = normalize(message)
+        goto, fail, out = self._goto, self._fail, self._out
+        node = 0
+        for index, char in enumerate(text):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            for pattern_index in out[node]:
+                pattern = self.patterns[pattern_index]
+                start = index - len(pattern[0]) + 1
+                if self.word_boundary and not self._on_boundary(text, start, index + 1, pattern[0]):
+                    continue
+                yield start, index + 1, pattern
+
+    @staticmethod
+    def _on_boundary(text: str, start: int, end: int, folded: str) -> bool:
+        if start > 0 and is_word_char(folded[0]) and is_word_char(text[start - 1]):
+            return False
+        if end < len(text) and is_word_char(folded[-1]) and is_word_char(text[end]):
+            return False
+        return True
+
+    def best_match(self, message: str):
+        """(rank, keyword, response) of the best match, or None; lower rank wins"""
+        if not self.patterns or not message:
+            return None
+        best = None
+        for start, end, pattern in self.find_all(message):
+            rank = (-pattern[3], -(end - start), start, pattern[4])
+            if best is None or rank < best[0]:
+                best = (rank, pattern[1], pattern[2])
+        return best
+
+    def match(self, message: str):
+        """Best matching (keyword, response), or None"""
+        best = self.best_match(message)
+        return (best[1], best[2]) if best else None
+
+
+class RuleSet:
+    """Rules of one scope: literal keywords in a KeywordMatcher, regex rules alongside"""
+
+    def __init__(self):
+        self.literals = []
+        self.regexes = []       # (compiled, keyword, response, priority, order)
+        self.matcher = None
+
+    def compile(self):
+        self.matcher = KeywordMatcher(self.literals)
+
+    def best_match(self, message: str):
+        best = self.matcher.best_match(message)
+        for pattern, keyword, response, priority, order in self.regexes:
+            found = pattern.search(message)
+            if found:
+                rank = (-priority, -(found.end() - found.start()), found.start(), order)
+                if best is None or rank < best[0]:
+                    best = (rank, keyword, response)
+        return best
+
+
+def compile_regex(pattern: str):
+    return re.compile(pattern, re.IGNORECASE)
+
+
+class KeywordRuleIndex:
+    """Keyword rules compiled per scope; matching only touches the scopes of the message's chat"""
+
+    def __init__(self, rules):
+        """rules: (keyword, response, scope, scope_id, is_regex, priority) rows, oldest first"""
+        self.rule_sets = {}
+        self.rule_count = 0
+        for order, (keyword, response, scope, scope_id, is_regex, priority) in enumerate(rules):
+            scope = scope or SCOPE_ALL
+            key = (scope, scope_id if scope in SCOPES_WITH_ID else None)
+            rule_set = self.rule_sets.setdefault(key, RuleSet())
+            priority = priority or 0
+            if is_regex:
+                try:
+                    rule_set.regexes.append((compile_regex(keyword), keyword, response, priority, order))
+                except re.error as e:
+                    logger.warning(f"⚠️ Skipping invalid keyword regex {keyword!r}: {e}")
+                    continue
+            else:
+                rule_set.literals.append((keyword, response, priority, order))
+            self.rule_count += 1
+        for rule_set in self.rule_sets.values():
+            rule_set.compile()
+
+    def __len__(self):
+        return self.rule_count
+
+    def scopes_for(self, chat_type: str = SCOPE_DM, chat_id: int = None, account_id: int = None):
+        keys = [(SCOPE_ALL, None), (SCOPE_GROUP if chat_type == SCOPE_GROUP else SCOPE_DM, None)]
+        if chat_type == SCOPE_GROUP and chat_id is not None:
+            keys.append((SCOPE_CHAT, chat_id))
+        if account_id is not None:
+            keys.append((SCOPE_ACCOUNT, account_id))
+        return keys
+
+    def match(self, message: str, chat_type: str = SCOPE_DM, chat_id: int = None, account_id: int = None):
+        """Best matching (keyword, response) for a message in this chat, or None"""
+        best = None
+        for key in self.scopes_for(chat_type, chat_id, account_id):
+            rule_set = self.rule_sets.get(key)
+            if rule_set is None:
+                continue
+            found = rule_set.best_match(message)
+            if found:
+                rank, keyword, response = found
+                # Priority first, then the more specific scope, then the matcher's own order
+                rank = (rank[0], -SCOPE_SPECIFICITY[key[0]]) + rank[1:]
+                if best is None or rank < best[0]:
+                    best = (rank, keyword, response)
+        return (best[1], best[2]) if best else None
+
+
+def validate_rule(keyword: str, scope: str = SCOPE_ALL, scope_id=None, is_regex: bool = False, priority=0):
+    """Normalized (keyword, scope, scope_id, is_regex, priority); raises ValueError with a readable reason"""
+    keyword = (keyword or '').strip()
+    if not keyword:
+        raise ValueError("keyword is empty")
+    scope = (scope or SCOPE_ALL).strip().lower()
+    if scope not in SCOPE_SPECIFICITY:
+        raise ValueError(f"unknown scope '{scope}' (use {', '.join(SCOPE_SPECIFICITY)})")
+    if scope in SCOPES_WITH_ID:
+        try:
+            scope_id = int(scope_id)
+        except (TypeError, ValueError):
+            raise ValueError(f"scope '{scope}' needs a numeric scope_id")
+    else:
+        scope_id = None
+    if is_regex:
+        try:
+            compile_regex(keyword)
+        except re.error as e:
+            raise ValueError(f"invalid regex: {e}")
+    try:
+        priority = int(priority or 0)
+    except (TypeError, ValueError):
+        raise ValueError(f"priority '{priority}' is not a number")
+    return keyword, scope, scope_id, 1 if is_regex else 0, priority
+
+
+def parse_keyword_csv(text: str):
+    """Validated (keyword, response, scope, scope_id, is_regex, priority) rows and a list of errors
+
+    The CSV needs a header row; only keyword is required:
+        keyword,response,scope,scope_id,regex,priority
+    """
+    reader = csv.DictReader(io.StringIO(text.lstrip('\ufeff')))
+    if not reader.fieldnames or 'keyword' not in [name.strip().lower() for name in reader.fieldnames]:
+        return [], ["missing header row with a 'keyword' column"]
+
+    rows, errors = [], []
+    for line_number, raw in enumerate(reader, start=2):
+        if raw.get(None):
+            # DictReader puts fields beyond the header under None
+            errors.append(f"line {line_number}: too many columns (quote fields containing commas)")
+            continue
+        row = {name.strip().lower(): (value or '').strip() for name, value in raw.items() if name is not None}
+        if not any(row.values()):
+            continue
+        try:
+            keyword, scope, scope_id, is_regex, priority = validate_rule(
+                row.get('keyword'), row.get('scope'), row.get('scope_id'),
+                row.get('regex', '').lower() in ('1', 'true', 'yes', 'y'), row.get('priority'))
+        except ValueError as e:
+            errors.append(f"line {line_number}: {e}")
+            continue
+        rows.append((keyword, row.get('response') or None, scope, scope_id, is_regex, priority))
+    return rows, errors
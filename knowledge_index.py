@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+Knowledge Retrieval (Vector Index)
+Instead of pasting every active knowledge entry into every prompt, only the top-k
+regular entries most relevant to the user's question are used. Super-priority
+directives are always included by the callers.
+
+- Embeddings are stored per entry in knowledge_embeddings (shared by all bots),
+  keyed on a hash of title + text, so only new or edited entries are re-embedded.
+- The in-process matrix is written to a .npy file and re-opened memory-mapped.
+- Any knowledge change bumps config_versions (see response_cache.py), which
+  triggers an incremental re-sync on the next question.
+
+KNOWLEDGE_RETRIEVAL=bm25 switches to the offline lexical index in bm25_index.py.
+"""
+
+import os
+import json
+import sqlite3
+import db
+import hashlib
+import asyncio
+import logging
+from api_key_pool import DEFAULT_EMBEDDING_MODEL
+from response_cache import knowledge_version
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger(__name__)
+
+KNOWLEDGE_RETRIEVAL = os.getenv('KNOWLEDGE_RETRIEVAL', 'embedding').lower()
+KNOWLEDGE_TOP_K = int(os.getenv('KNOWLEDGE_TOP_K', '5'))
+KNOWLEDGE_EMBEDDING_MODEL = os.getenv('KNOWLEDGE_EMBEDDING_MODEL', DEFAULT_EMBEDDING_MODEL)
+EMBEDDING_BATCH_SIZE = 100
+
+# Knowledge tables that are indexed: source name -> query for active entries (id, title, text)
+KNOWLEDGE_SOURCES = {
+    'bot_knowledge': "SELECT id, title, knowledge_text FROM bot_knowledge WHERE status = 'active'",
+    'account_knowledge': "SELECT id, title, knowledge_text FROM account_knowledge WHERE status = 'active'",
+}
+
+
+def content_hash(title, text) -> str:
+    return hashlib.sha256(f"{title or ''}\n{text or ''}".encode()).hexdigest()
+
+
+def create_knowledge_retriever(db_path: str, key_pool, name: str = 'main'):
+    """Retriever for the configured KNOWLEDGE_RETRIEVAL mode (off | embedding | bm25)"""
+    if KNOWLEDGE_RETRIEVAL == 'bm25':
+        from bm25_index import BM25KnowledgeIndex
+        return BM25KnowledgeIndex(db_path)
+    # 'off' gives a disabled vector index, whose select() returns every entry unchanged
+    return KnowledgeVectorIndex(db_path, key_pool, name=name)
+
+
+class KnowledgeVectorIndex:
+    """Embedding index over bot_knowledge and account_knowledge"""
+
+    def __init__(self, db_path: str, key_pool, name: str = 'main',
+                 model: str = KNOWLEDGE_EMBEDDING_MODEL, top_k: int = KNOWLEDGE_TOP_K):
+        self.db_path = db_path
+        self.key_pool = key_pool
+        self.model = model
+        self.top_k = top_k
+        self.matrix_path = f"knowledge_vectors_{name}.npy"
+        self.ids_path = f"knowledge_vectors_{name}.json"
+        self.enabled = KNOWLEDGE_RETRIEVAL == 'embedding' and key_pool is not None and np is not None
+        if KNOWLEDGE_RETRIEVAL == 'embedding' and np is None:
+            logger.warning("⚠️ numpy not installed - knowledge retrieval disabled, using all entries")
+
+        self.ids = []
+        self.positions = {}
+        self.matrix = None
+        self.version = None
+        self._lock = asyncio.Lock()
+
+    def _load_entries(self):
+        """Active entries from every source: {(source, id): (hash, text_to_embed)}"""
+        conn = db.connect(self.db_path)
+        entries = {}
+        try:
+            for source, query in KNOWLEDGE_SOURCES.items():
+                try:
+                    rows = conn.execute(query).fetchall()
+                except sqlite3.OperationalError:
+                    continue
+                for entry_id, title, text in rows:
+                    body = f"{title}\n{text}" if title else text
+                    entries[(source, entry_id)] = (content_hash(title, text), body)
+        finally:
+            conn.close()
+        return entries
+
+    def _load_stored(self):
+        conn = db.connect(self.db_path)
+        rows = conn.execute(
+            'SELECT source, entry_id, content_hash, embedding FROM knowledge_embeddings WHERE model = ?',
+            (self.model,)
+        ).fetchall()
+        conn.close()
+        return {(source, entry_id): (digest, blob) for source, entry_id, digest, blob in rows}
+
+    def _save_embeddings(self, embedded, stale):
+        conn = db.connect(self.db_path)
+        conn.executemany('''
+            INSERT INTO knowledge_embeddings (source, entry_id, content_hash, model, embedding, updated_at)
+            VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(source, entry_id) DO UPDATE SET
+                content_hash = excluded.content_hash,
+                model = excluded.model,
+                embedding = excluded.embedding,
+                updated_at = CURRENT_TIMESTAMP
+        ''', [(source, entry_id, digest, self.model, blob) for (source, entry_id), (digest, blob) in embedded.items()])
+        conn.executemany('DELETE FROM knowledge_embeddings WHERE source = ? AND entry_id = ?', stale)
+        conn.commit()
+        conn.close()
+
+    def _open_persisted(self, ids):
+        """Re-open the memory-mapped matrix if it was written for exactly these entries"""
+        try:
+            with open(self.ids_path) as f:
+                saved = json.load(f)
+            if saved.get('model') != self.model or [tuple(key) for key in saved.get('ids', [])] != ids:
+                return None
+            return np.load(self.matrix_path, mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+
+    def _persist(self, matrix, ids):
+        tmp_path = self.matrix_path + '.tmp.npy'
+        mapped = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=matrix.shape)
+        mapped[:] = matrix
+        mapped.flush()
+        del mapped
+        os.replace(tmp_path, self.matrix_path)
+        with open(self.ids_path, 'w') as f:
+            json.dump({'model': self.model, 'ids': ids}, f)
+        return np.load(self.matrix_path, mmap_mode='r')
+
+    async def refresh(self):
+        """Bring the index in line with the knowledge tables (only changed entries are embedded)"""
+        version = knowledge_version(self.db_path)
+        if self.matrix is not None and version is not None and version == self.version:
+            return
+        async with self._lock:
+            if self.matrix is not None and version is not None and version == self.version:
+                return
+            await self._sync()
+            self.version = version
+
+    async def _sync(self):
+        entries = self._load_entries()
+        stored = self._load_stored()
+
+        to_embed = [key for key, (digest, _) in entries.items() if key not in stored or stored[key][0] != digest]
+        stale = [key for key in stored if key not in entries]
+
+        embedded = {}
+        for start in range(0, len(to_embed), EMBEDDING_BATCH_SIZE):
+            batch = to_embed[start:start + EMBEDDING_BATCH_SIZE]
+            vectors = await self.key_pool.embeddings([entries[key][1] for key in batch], model=self.model)
+            for key, vector in zip(batch, vectors):
+                vector = np.asarray(vector, dtype=np.float32)
+                vector /= (np.linalg.norm(vector) or 1.0)
+                embedded[key] = (entries[key][0], vector.tobytes())
+        if embedded or stale:
+            self._save_embeddings(embedded, stale)
+            logger.info(f"🧭 Knowledge index: embedded {len(embedded)} entries, removed {len(stale)}")
+
+        ids = sorted(entries)
+        matrix = None if embedded or stale else self._open_persisted(ids)
+        if matrix is None:
+            blobs = {**{key: value[1] for key, value in stored.items()}, **{key: value[1] for key, value in embedded.items()}}
+            rows = [np.frombuffer(blobs[key], dtype=np.float32) for key in ids]
+            matrix = np.vstack(rows) if rows else np.zeros((0, 1), dtype=np.float32)
+            if rows:
+                matrix = self._persist(matrix, [list(key) for key in ids])
+
+        self.ids = ids
+        self.positions = {key: position for position, key in enumerate(ids)}
+        self.matrix = matrix
+
+    async def select(self, question: str, source: str, entries: list, top_k: int = None):
+        """Return the top-k entries (dicts with an 'id') most relevant to the question, best first.
+
+        Falls back to the entries unchanged if retrieval is off, unnecessary or fails.
+        """
+        top_k = top_k or self.top_k
+        if not self.enabled or len(entries) <= top_k or not question:
+            return entries
+        try:
+            await self.refresh()
+            query = np.asarray((await self.key_pool.embeddings([question], model=self.model))[0], dtype=np.float32)
+            query /= (np.linalg.norm(query) or 1.0)
+        except Exception as e:
+            logger.warning(f"⚠️ Knowledge retrieval failed, using all entries: {e}")
+            return entries
+
+        indexed = [entry for entry in entries if (source, entry['id']) in self.positions]
+        if not indexed:
+            return entries
+        rows = [self.positions[(source, entry['id'])] for entry in indexed]
+        scores = self.matrix[rows] @ query
+        best = np.argsort(-scores)[:top_k]
+        return [indexed[i] for i in best]
@@ -1,15 +1,32 @@
 #!/usr/bin/env python3
 import os
 import logging
-import sqlite3
+import db
+from async_db import AsyncDatabase
+from write_behind import WriteBehindBuffer
+from usage_counters import UsageCounters
 import re
 import threading
 import asyncio
 from datetime import datetime
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
-from openai import OpenAI
+from api_key_pool import ApiKeyPool, load_api_keys
+from key_coordinator import SharedKeyCoordinator
 from flask import Flask
+from streaming_reply import StreamingReply, streaming_enabled
+from prompt_builder import PromptBuilder
+from knowledge_index import create_knowledge_retriever
+from burst_aggregator import BurstAggregator
+from admission import AdmissionController, AdmissionRejected, DEFAULT_BUSY_MESSAGE
+from conversation_summary import ConversationSummarizer
+from response_cache import ResponseCache, knowledge_version, normalize_question
+from migrations import migrate
+from chat_retention import ChatRetention
+from config_cache import ConfigCache
+from keyword_matcher import (SCOPE_ALL, SCOPE_DM, SCOPE_GROUP, SCOPE_CHAT, SCOPE_ACCOUNT,
+                             validate_rule, parse_keyword_csv)
+from chat_search import parse_search, search_chats, clip, CHAT_SEARCH_PAGE_SIZE, CHAT_SEARCH_MAX_CHARS
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -39,6 +56,17 @@ def escape_markdown(text):
     escape_chars = r'_*[]()~`>#+-=|{}.!'
     return ''.join('\\' + char if char in escape_chars else char for char in str(text))
 
+def escape_markdown_clipped(text, limit: int):
+    """escape_markdown() cut to at most limit characters of escaped text (ending in an escaped …)"""
+    escaped = escape_markdown(text)
+    if len(escaped) <= limit:
+        return escaped
+    cut = escaped[:max(0, limit - 1)]
+    # Never leave a dangling backslash from a cut escape sequence
+    if (len(cut) - len(cut.rstrip('\\'))) % 2:
+        cut = cut[:-1]
+    return cut + '…'
+
 class TelegramChatBot:
     def __init__(self):
         self.telegram_token = os.getenv('TELEGRAM_BOT_TOKEN')
@@ -50,297 +78,82 @@ class TelegramChatBot:
             logger.warning("ADMIN_ID not set! Admin features will not work.")
         
         # Load multiple API keys from environment variables
-        self.api_keys = []
-        for i in range(1, 20):  # Support up to 20 API keys
-            key = os.getenv(f'OPENAI_API_KEY_{i}')
-            if key:
-                self.api_keys.append(key)
-        
-        # Also check for single OPENAI_API_KEY (backward compatibility)
-        single_key = os.getenv('OPENAI_API_KEY')
-        if single_key and single_key not in self.api_keys:
-            self.api_keys.insert(0, single_key)
+        self.api_keys = load_api_keys()
         
         if not self.api_keys:
             raise ValueError("No OPENAI_API_KEY found! Set OPENAI_API_KEY_1, OPENAI_API_KEY_2, etc.")
         
         logger.info(f"✅ Loaded {len(self.api_keys)} API keys for rotation")
         
-        # API key rotation setup
-        # max_retries=0 disables OpenAI's built-in retry for instant key switching
-        self.current_key_index = 0
-        self.openai_client = OpenAI(api_key=self.api_keys[self.current_key_index], max_retries=0)
-        
         self.db_path = 'chat_history.db'
+        # Handlers await DB work: reads on a thread pool, writes on one writer thread
+        self.adb = AsyncDatabase('main')
+        # Per-message bookkeeping (users, groups, chat history) is written in batches
+        self.write_behind = WriteBehindBuffer(self.db_path, 'main')
+        # API key usage is counted in memory and flushed every USAGE_FLUSH_INTERVAL seconds
+        self.usage_counters = UsageCounters(self.db_path)
+        
+        # Concurrent requests are spread over all healthy keys (least-loaded first);
+        # leases and cooldowns are shared with the personal bot and multi-account manager
+        self.key_pool = ApiKeyPool(
+            self.api_keys,
+            on_usage=self.usage_counters.record_usage,
+            on_rate_limit=self.usage_counters.record_rate_limit,
+            on_key_disabled=self.mark_api_key_deactivated,
+            coordinator=SharedKeyCoordinator(self.db_path, 'main')
+        )
+        
+        # Stream replies by editing one message as tokens arrive (STREAM_REPLIES=true)
+        self.stream_replies = streaming_enabled()
+        
+        # Answers to context-free questions, invalidated when knowledge/keywords change
+        self.response_cache = ResponseCache()
+        
+        # Keeps knowledge + history under PROMPT_TOKEN_BUDGET input tokens
+        self.prompt_builder = PromptBuilder()
+        
         self.active_admin_chats = {}
         self.user_to_admin_chat = {}
         self.admin_state = {}
+        self.chat_searches = {}
+        self.pending_keywords = {}
         self.active_group_sessions = {}
         self.group_to_admin = {}
         self.init_database()
-    
-    def rotate_api_key(self):
-        """Rotate to the next available API key"""
-        self.current_key_index = (self.current_key_index + 1) % len(self.api_keys)
-        new_key = self.api_keys[self.current_key_index]
-        # max_retries=0 disables OpenAI's built-in retry mechanism for instant switching
-        self.openai_client = OpenAI(api_key=new_key, max_retries=0)
-        logger.warning(f"🔄 Rotated to API key #{self.current_key_index + 1} (out of {len(self.api_keys)} keys)")
-        return self.current_key_index + 1
-    
-    def get_db_connection(self):
-        """Get database connection with foreign keys enabled"""
-        conn = sqlite3.connect(self.db_path)
-        conn.execute('PRAGMA foreign_keys = ON')
-        return conn
-    
-    def init_database(self):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Enable foreign key constraints
-        cursor.execute('PRAGMA foreign_keys = ON')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS chat_history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                username TEXT,
-                message TEXT NOT NULL,
-                response TEXT NOT NULL,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_sessions (
-                user_id INTEGER PRIMARY KEY,
-                session_context TEXT,
-                last_active DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS bot_knowledge (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                knowledge_text TEXT NOT NULL,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS all_users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                first_name TEXT,
-                last_name TEXT,
-                first_seen DATETIME DEFAULT CURRENT_TIMESTAMP,
-                last_active DATETIME DEFAULT CURRENT_TIMESTAMP,
-                message_count INTEGER DEFAULT 0
-            )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS group_keywords (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                keyword TEXT NOT NULL,
-                response TEXT,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS automated_messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                message_type TEXT UNIQUE NOT NULL,
-                message_text TEXT NOT NULL,
-                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS api_key_stats (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                key_index INTEGER NOT NULL UNIQUE,
-                usage_count INTEGER DEFAULT 0,
-                last_used DATETIME,
-                rate_limit_hits INTEGER DEFAULT 0,
-                tokens_used_today INTEGER DEFAULT 0,
-                tokens_input_today INTEGER DEFAULT 0,
-                tokens_output_today INTEGER DEFAULT 0,
-                daily_reset_time DATETIME,
-                total_tokens_lifetime INTEGER DEFAULT 0
-            )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS group_registry (
-                group_id INTEGER PRIMARY KEY,
-                title TEXT,
-                username TEXT,
-                chat_type TEXT,
-                first_seen DATETIME DEFAULT CURRENT_TIMESTAMP,
-                last_active DATETIME DEFAULT CURRENT_TIMESTAMP,
-                message_count INTEGER DEFAULT 0
-            )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS pyrogram_accounts (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                phone_number TEXT UNIQUE NOT NULL,
-                account_name TEXT,
-                api_id TEXT,
-                api_hash TEXT,
-                session_string TEXT,
-                is_active INTEGER DEFAULT 0,
-                is_authenticated INTEGER DEFAULT 0,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                last_active DATETIME,
-                reply_count INTEGER DEFAULT 0,
-                error_message TEXT
-            )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS account_knowledge (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                account_id INTEGER NOT NULL,
-                title TEXT,
-                knowledge_text TEXT NOT NULL,
-                priority TEXT DEFAULT 'regular',
-                status TEXT DEFAULT 'active',
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (account_id) REFERENCES pyrogram_accounts(id) ON DELETE CASCADE
-            )
-        ''')
-        
-        try:
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_account_knowledge_account ON account_knowledge(account_id, priority, updated_at DESC)')
-        except sqlite3.OperationalError:
-            pass
-        
-        try:
-            cursor.execute('ALTER TABLE chat_history ADD COLUMN message_role TEXT DEFAULT "user"')
-        except sqlite3.OperationalError:
-            pass
-        
-        try:
-            cursor.execute('ALTER TABLE chat_history ADD COLUMN chat_type TEXT DEFAULT "dm"')
-        except sqlite3.OperationalError:
-            pass
-        
-        try:
-            cursor.execute('ALTER TABLE chat_history ADD COLUMN chat_id INTEGER')
-        except sqlite3.OperationalError:
-            pass
-        
-        try:
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_chat_user_time ON chat_history(user_id, timestamp DESC)')
-        except sqlite3.OperationalError:
-            pass
-        
-        try:
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_chat_type_time ON chat_history(chat_type, chat_id, timestamp DESC)')
-        except sqlite3.OperationalError:
-            pass
-        
-        try:
-            cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_api_key_stats_key ON api_key_stats(key_index)')
-        except sqlite3.OperationalError:
-            pass
-        
-        # Add token tracking columns if they don't exist
-        try:
-            cursor.execute('ALTER TABLE api_key_stats ADD COLUMN tokens_used_today INTEGER DEFAULT 0')
-        except sqlite3.OperationalError:
-            pass
         
-        try:
-            cursor.execute('ALTER TABLE api_key_stats ADD COLUMN tokens_input_today INTEGER DEFAULT 0')
-        except sqlite3.OperationalError:
-            pass
-        
-        try:
-            cursor.execute('ALTER TABLE api_key_stats ADD COLUMN tokens_output_today INTEGER DEFAULT 0')
-        except sqlite3.OperationalError:
-            pass
-        
-        try:
-            cursor.execute('ALTER TABLE api_key_stats ADD COLUMN daily_reset_time DATETIME')
-        except sqlite3.OperationalError:
-            pass
-        
-        try:
-            cursor.execute('ALTER TABLE api_key_stats ADD COLUMN total_tokens_lifetime INTEGER DEFAULT 0')
-        except sqlite3.OperationalError:
-            pass
-        
-        # Add deactivation tracking columns
-        try:
-            cursor.execute('ALTER TABLE api_key_stats ADD COLUMN is_deactivated INTEGER DEFAULT 0')
-        except sqlite3.OperationalError:
-            pass
-        
-        try:
-            cursor.execute('ALTER TABLE api_key_stats ADD COLUMN deactivation_reason TEXT')
-        except sqlite3.OperationalError:
-            pass
-        
-        try:
-            cursor.execute('ALTER TABLE api_key_stats ADD COLUMN deactivated_at DATETIME')
-        except sqlite3.OperationalError:
-            pass
-        
-        # Add Super Knowledge columns to bot_knowledge table
-        try:
-            cursor.execute('ALTER TABLE bot_knowledge ADD COLUMN priority TEXT DEFAULT "regular"')
-        except sqlite3.OperationalError:
-            pass
-        
-        try:
-            cursor.execute('ALTER TABLE bot_knowledge ADD COLUMN target_scope TEXT DEFAULT "both"')
-        except sqlite3.OperationalError:
-            pass
+        # Keyword lookups per message come from memory, reloaded when the table changes
+        self.config_cache = ConfigCache(self.db_path)
         
-        try:
-            cursor.execute('ALTER TABLE bot_knowledge ADD COLUMN title TEXT')
-        except sqlite3.OperationalError:
-            pass
+        # Only the regular knowledge entries relevant to the question go into the prompt
+        self.knowledge_index = create_knowledge_retriever(self.db_path, self.key_pool, name='main')
         
-        try:
-            cursor.execute('ALTER TABLE bot_knowledge ADD COLUMN status TEXT DEFAULT "active"')
-        except sqlite3.OperationalError:
-            pass
+        # Older turns are folded into a per-user summary in user_sessions
+        self.summarizer = ConversationSummarizer(self.db_path, self.key_pool)
         
-        # Create index for efficient knowledge retrieval
-        try:
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_knowledge_scope_priority ON bot_knowledge(target_scope, priority, updated_at DESC)')
-        except sqlite3.OperationalError:
-            pass
+        # Chat history older than CHAT_RETENTION_DAYS moves to monthly compressed archives
+        self.chat_retention = ChatRetention(self.db_path)
         
-        try:
-            cursor.execute('ALTER TABLE pyrogram_accounts ADD COLUMN api_id TEXT')
-        except sqlite3.OperationalError:
-            pass
+        # Rapid consecutive messages from one user are answered with a single reply
+        self.burst_aggregator = BurstAggregator()
         
-        try:
-            cursor.execute('ALTER TABLE pyrogram_accounts ADD COLUMN api_hash TEXT')
-        except sqlite3.OperationalError:
-            pass
-        
-        conn.commit()
-        conn.close()
-        logger.info("Database initialized successfully")
+        # Caps concurrent AI replies; overflow gets the 'busy' automated message
+        self.admission = AdmissionController('main')
+    
+    def get_db_connection(self):
+        """Get database connection with foreign keys enabled"""
+        return db.connect(self.db_path, foreign_keys=True)
+    
+    def init_database(self):
+        """Apply pending schema migrations (a single PRAGMA read when up to date)"""
+        version = migrate(self.db_path)
+        logger.info(f"Database initialized successfully (schema version {version})")
     
     def is_admin(self, user_id: int) -> bool:
         return user_id == self.admin_id
     
     def get_automated_message(self, message_type: str):
         """Get automated message by type"""
-        conn = sqlite3.connect(self.db_path)
+        conn = db.connect(self.db_path)
         cursor = conn.cursor()
         
         cursor.execute('SELECT message_text FROM automated_messages WHERE message_type = ?', (message_type,))
@@ -351,7 +164,7 @@ class TelegramChatBot:
     
     def set_automated_message(self, message_type: str, message_text: str):
         """Set or update automated message"""
-        conn = sqlite3.connect(self.db_path)
+        conn = db.connect(self.db_path)
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -367,7 +180,7 @@ class TelegramChatBot:
     
     def get_all_automated_messages(self):
         """Get all automated messages"""
-        conn = sqlite3.connect(self.db_path)
+        conn = db.connect(self.db_path)
         cursor = conn.cursor()
         
         cursor.execute('SELECT message_type, message_text, updated_at FROM automated_messages ORDER BY message_type')
@@ -376,95 +189,9 @@ class TelegramChatBot:
         
         return results
     
-    def track_api_key_usage(self, key_index: int, is_rate_limit: bool = False, tokens_input: int = 0, tokens_output: int = 0):
-        """Track API key usage with token counting and daily reset"""
-        from datetime import datetime, timedelta
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Get current stats for this key
-        cursor.execute('SELECT daily_reset_time, tokens_used_today FROM api_key_stats WHERE key_index = ?', (key_index,))
-        result = cursor.fetchone()
-        
-        # Check if daily reset is needed (24 hours passed)
-        should_reset = False
-        if result and result[0]:
-            last_reset = datetime.fromisoformat(result[0])
-            if datetime.now() - last_reset >= timedelta(hours=24):
-                should_reset = True
-        else:
-            should_reset = True  # First time tracking
-        
-        tokens_total = tokens_input + tokens_output
-        
-        if should_reset:
-            # Reset daily counters
-            if is_rate_limit:
-                cursor.execute('''
-                    INSERT INTO api_key_stats (key_index, usage_count, last_used, rate_limit_hits, 
-                                               tokens_used_today, tokens_input_today, tokens_output_today,
-                                               daily_reset_time, total_tokens_lifetime)
-                    VALUES (?, 0, CURRENT_TIMESTAMP, 1, 0, 0, 0, CURRENT_TIMESTAMP, ?)
-                    ON CONFLICT(key_index) DO UPDATE SET
-                        rate_limit_hits = rate_limit_hits + 1,
-                        last_used = CURRENT_TIMESTAMP,
-                        tokens_used_today = 0,
-                        tokens_input_today = 0,
-                        tokens_output_today = 0,
-                        daily_reset_time = CURRENT_TIMESTAMP,
-                        total_tokens_lifetime = total_tokens_lifetime + ?
-                ''', (key_index, tokens_total, tokens_total))
-            else:
-                cursor.execute('''
-                    INSERT INTO api_key_stats (key_index, usage_count, last_used, rate_limit_hits,
-                                               tokens_used_today, tokens_input_today, tokens_output_today,
-                                               daily_reset_time, total_tokens_lifetime)
-                    VALUES (?, 1, CURRENT_TIMESTAMP, 0, ?, ?, ?, CURRENT_TIMESTAMP, ?)
-                    ON CONFLICT(key_index) DO UPDATE SET
-                        usage_count = usage_count + 1,
-                        last_used = CURRENT_TIMESTAMP,
-                        tokens_used_today = ?,
-                        tokens_input_today = ?,
-                        tokens_output_today = ?,
-                        daily_reset_time = CURRENT_TIMESTAMP,
-                        total_tokens_lifetime = total_tokens_lifetime + ?
-                ''', (key_index, tokens_total, tokens_input, tokens_output, tokens_total, 
-                      tokens_total, tokens_input, tokens_output, tokens_total))
-        else:
-            # Increment daily counters
-            if is_rate_limit:
-                cursor.execute('''
-                    INSERT INTO api_key_stats (key_index, usage_count, last_used, rate_limit_hits,
-                                               tokens_used_today, tokens_input_today, tokens_output_today,
-                                               daily_reset_time, total_tokens_lifetime)
-                    VALUES (?, 0, CURRENT_TIMESTAMP, 1, 0, 0, 0, CURRENT_TIMESTAMP, ?)
-                    ON CONFLICT(key_index) DO UPDATE SET
-                        rate_limit_hits = rate_limit_hits + 1,
-                        last_used = CURRENT_TIMESTAMP,
-                        total_tokens_lifetime = total_tokens_lifetime + ?
-                ''', (key_index, tokens_total, tokens_total))
-            else:
-                cursor.execute('''
-                    INSERT INTO api_key_stats (key_index, usage_count, last_used, rate_limit_hits,
-                                               tokens_used_today, tokens_input_today, tokens_output_today,
-                                               daily_reset_time, total_tokens_lifetime)
-                    VALUES (?, 1, CURRENT_TIMESTAMP, 0, ?, ?, ?, CURRENT_TIMESTAMP, ?)
-                    ON CONFLICT(key_index) DO UPDATE SET
-                        usage_count = usage_count + 1,
-                        last_used = CURRENT_TIMESTAMP,
-                        tokens_used_today = tokens_used_today + ?,
-                        tokens_input_today = tokens_input_today + ?,
-                        tokens_output_today = tokens_output_today + ?,
-                        total_tokens_lifetime = total_tokens_lifetime + ?
-                ''', (key_index, tokens_total, tokens_input, tokens_output, tokens_total,
-                      tokens_total, tokens_input, tokens_output, tokens_total))
-        
-        conn.commit()
-        conn.close()
-    
     def mark_api_key_deactivated(self, key_index: int, reason: str):
         """Mark an API key as deactivated in the database"""
-        conn = sqlite3.connect(self.db_path)
+        conn = db.connect(self.db_path)
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -484,19 +211,27 @@ class TelegramChatBot:
     def get_api_key_stats(self):
         """Get detailed API key usage statistics with token tracking"""
         from datetime import datetime, timedelta
-        conn = sqlite3.connect(self.db_path)
+        conn = db.connect(self.db_path)
         cursor = conn.cursor()
         
         cursor.execute('''
             SELECT key_index, usage_count, last_used, rate_limit_hits,
                    tokens_used_today, tokens_input_today, tokens_output_today,
-                   daily_reset_time, total_tokens_lifetime
+                   daily_reset_time, total_tokens_lifetime,
+                   daily_reset_time IS NULL OR julianday('now') - julianday(daily_reset_time) >= 1
             FROM api_key_stats
             ORDER BY key_index
         ''')
         results = cursor.fetchall()
         conn.close()
         
+        # Keys used since the last usage flush may not have a row yet
+        known_keys = {row[0] for row in results}
+        for key_index in self.usage_counters.pending_keys():
+            if key_index not in known_keys:
+                results.append((key_index, 0, None, 0, 0, 0, 0, None, 0, 1))
+        results.sort(key=lambda row: row[0])
+        
         # Free tier limits (assuming GPT-4o-mini complimentary program)
         # Tier 1-2: 2.5M tokens/day for mini models
         DAILY_TOKEN_LIMIT = 2500000  # 2.5 million tokens for GPT-4o-mini
@@ -505,22 +240,36 @@ class TelegramChatBot:
         for row in results:
             (key_index, usage_count, last_used, rate_limit_hits,
              tokens_used_today, tokens_input_today, tokens_output_today,
-             daily_reset_time, total_tokens_lifetime) = row
+             daily_reset_time, total_tokens_lifetime, window_expired) = row
+            
+            # Same 24h window rule as the usage flush: an expired window starts again at 0
+            if window_expired:
+                tokens_used_today = tokens_input_today = tokens_output_today = 0
+                daily_reset_time = None
+            
+            # Add usage counted in memory since the last flush
+            requests, rate_limits, pending_in, pending_out = self.usage_counters.pending(key_index)
+            usage_count = (usage_count or 0) + requests
+            rate_limit_hits = (rate_limit_hits or 0) + rate_limits
+            tokens_input_today = (tokens_input_today or 0) + pending_in
+            tokens_output_today = (tokens_output_today or 0) + pending_out
+            tokens_used_today = (tokens_used_today or 0) + pending_in + pending_out
+            total_tokens_lifetime = (total_tokens_lifetime or 0) + pending_in + pending_out
             
             # Calculate tokens left
             tokens_left = max(0, DAILY_TOKEN_LIMIT - (tokens_used_today or 0))
             
-            # Calculate reset time
+            # Calculate reset time (daily_reset_time is CURRENT_TIMESTAMP, i.e. UTC)
             reset_time = None
             hours_until_reset = None
             if daily_reset_time:
                 try:
                     reset_dt = datetime.fromisoformat(daily_reset_time)
                     next_reset = reset_dt + timedelta(hours=24)
-                    hours_until_reset = (next_reset - datetime.now()).total_seconds() / 3600
+                    hours_until_reset = (next_reset - datetime.utcnow()).total_seconds() / 3600
                     if hours_until_reset < 0:
                         hours_until_reset = 0
-                    reset_time = next_reset.strftime("%Y-%m-%d %H:%M:%S")
+                    reset_time = next_reset.strftime("%Y-%m-%d %H:%M:%S UTC")
                 except:
                     pass
             
@@ -536,14 +285,15 @@ class TelegramChatBot:
                 'daily_limit': DAILY_TOKEN_LIMIT,
                 'reset_time': reset_time,
                 'hours_until_reset': hours_until_reset,
-                'total_tokens_lifetime': total_tokens_lifetime or 0
+                'total_tokens_lifetime': total_tokens_lifetime or 0,
+                'requests_last_5m': self.usage_counters.recent(key_index)[0]
             })
         
         return detailed_stats
     
     def add_super_knowledge(self, title: str, knowledge_text: str, target_scope: str):
         """Add super knowledge with priority and scope"""
-        conn = sqlite3.connect(self.db_path)
+        conn = db.connect(self.db_path)
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -559,7 +309,7 @@ class TelegramChatBot:
     
     def get_super_knowledge_list(self):
         """Get all super knowledge entries for display"""
-        conn = sqlite3.connect(self.db_path)
+        conn = db.connect(self.db_path)
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -587,7 +337,7 @@ class TelegramChatBot:
     
     def delete_super_knowledge(self, knowledge_id: int):
         """Delete super knowledge by ID"""
-        conn = sqlite3.connect(self.db_path)
+        conn = db.connect(self.db_path)
         cursor = conn.cursor()
         
         cursor.execute('DELETE FROM bot_knowledge WHERE id = ? AND priority = "super"', (knowledge_id,))
@@ -599,7 +349,7 @@ class TelegramChatBot:
     
     def toggle_knowledge_status(self, knowledge_id: int):
         """Toggle knowledge status between active/inactive"""
-        conn = sqlite3.connect(self.db_path)
+        conn = db.connect(self.db_path)
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -617,7 +367,7 @@ class TelegramChatBot:
     
     def add_account_knowledge(self, account_id: int, title: str, knowledge_text: str, priority: str = 'regular'):
         """Add knowledge for a specific Pyrogram account"""
-        conn = sqlite3.connect(self.db_path)
+        conn = db.connect(self.db_path)
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -633,7 +383,7 @@ class TelegramChatBot:
     
     def get_account_knowledge_list(self, account_id: int, priority_filter: str = None):
         """Get knowledge entries for a specific account"""
-        conn = sqlite3.connect(self.db_path)
+        conn = db.connect(self.db_path)
         cursor = conn.cursor()
         
         if priority_filter:
@@ -675,7 +425,7 @@ class TelegramChatBot:
     
     def delete_account_knowledge(self, knowledge_id: int):
         """Delete account knowledge by ID"""
-        conn = sqlite3.connect(self.db_path)
+        conn = db.connect(self.db_path)
         cursor = conn.cursor()
         
         cursor.execute('DELETE FROM account_knowledge WHERE id = ?', (knowledge_id,))
@@ -687,7 +437,7 @@ class TelegramChatBot:
     
     def toggle_account_knowledge_status(self, knowledge_id: int):
         """Toggle account knowledge status between active/inactive"""
-        conn = sqlite3.connect(self.db_path)
+        conn = db.connect(self.db_path)
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -705,7 +455,7 @@ class TelegramChatBot:
     
     def get_account_knowledge_for_dm(self, account_id: int):
         """Get active knowledge for DM bot responses"""
-        conn = sqlite3.connect(self.db_path)
+        conn = db.connect(self.db_path)
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -730,7 +480,7 @@ class TelegramChatBot:
     
     async def show_super_knowledge_manage(self, query_or_message, user_id: int, knowledge_id: int, context=None):
         """Show super knowledge management interface"""
-        conn = sqlite3.connect(self.db_path)
+        conn = db.connect(self.db_path)
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -799,7 +549,7 @@ class TelegramChatBot:
     
     def get_deactivated_keys(self):
         """Get list of deactivated API keys"""
-        conn = sqlite3.connect(self.db_path)
+        conn = db.connect(self.db_path)
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -854,16 +604,30 @@ class TelegramChatBot:
                 InlineKeyboardButton("🔄 Refresh Panel", callback_data="admin_refresh")
             ],
             [
+                InlineKeyboardButton("🔎 Search Chats", callback_data="admin_search_chats"),
                 InlineKeyboardButton("🔚 End Session", callback_data="admin_end_session")
             ]
         ]
         return InlineKeyboardMarkup(keyboard)
     
+    def get_keyword_scope_keyboard(self):
+        keyboard = [
+            [
+                InlineKeyboardButton("🌐 Everywhere", callback_data=f"kw_scope_{SCOPE_ALL}"),
+                InlineKeyboardButton("💬 DMs only", callback_data=f"kw_scope_{SCOPE_DM}")
+            ],
+            [
+                InlineKeyboardButton("👥 Groups only", callback_data=f"kw_scope_{SCOPE_GROUP}"),
+                InlineKeyboardButton("🏘️ One group", callback_data="kw_scope_chat")
+            ],
+            [
+                InlineKeyboardButton("📱 One account (DM bot)", callback_data="kw_scope_account")
+            ]
+        ]
+        return InlineKeyboardMarkup(keyboard)
+    
     def track_user(self, user_id: int, username: str, first_name: str, last_name: str):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
+        self.write_behind.execute('''
             INSERT INTO all_users (user_id, username, first_name, last_name, last_active, message_count)
             VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP, 1)
             ON CONFLICT(user_id) DO UPDATE SET
@@ -873,9 +637,6 @@ class TelegramChatBot:
                 last_active = CURRENT_TIMESTAMP,
                 message_count = message_count + 1
         ''', (user_id, username, first_name, last_name, username, first_name, last_name))
-        
-        conn.commit()
-        conn.close()
     
     def get_enhanced_knowledge(self, bot_type='main'):
         """
@@ -883,7 +644,7 @@ class TelegramChatBot:
         bot_type: 'main' for main bot, 'dm' for pyrogram DM bot
         Returns: dict with 'super_knowledge' and 'regular_knowledge' lists
         """
-        conn = sqlite3.connect(self.db_path)
+        conn = db.connect(self.db_path)
         cursor = conn.cursor()
         
         # Get active knowledge filtered by scope and ordered by priority
@@ -938,7 +699,7 @@ class TelegramChatBot:
     
     def get_all_bot_knowledge(self):
         """Get all knowledge entries with IDs for display"""
-        conn = sqlite3.connect(self.db_path)
+        conn = db.connect(self.db_path)
         cursor = conn.cursor()
         
         cursor.execute('SELECT id, knowledge_text, created_at FROM bot_knowledge ORDER BY created_at ASC')
@@ -949,7 +710,7 @@ class TelegramChatBot:
     
     def set_bot_knowledge(self, knowledge: str):
         """Add new knowledge entry (does NOT delete existing)"""
-        conn = sqlite3.connect(self.db_path)
+        conn = db.connect(self.db_path)
         cursor = conn.cursor()
         
         cursor.execute('INSERT INTO bot_knowledge (knowledge_text) VALUES (?)', (knowledge,))
@@ -959,7 +720,7 @@ class TelegramChatBot:
     
     def delete_bot_knowledge(self, knowledge_id: int):
         """Delete a specific knowledge entry by ID"""
-        conn = sqlite3.connect(self.db_path)
+        conn = db.connect(self.db_path)
         cursor = conn.cursor()
         
         cursor.execute('DELETE FROM bot_knowledge WHERE id = ?', (knowledge_id,))
@@ -971,19 +732,13 @@ class TelegramChatBot:
         return deleted > 0
     
     def save_chat_history(self, user_id: int, username: str, message: str, response: str, chat_type: str = 'dm', chat_id: int | None = None):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
+        self.write_behind.execute('''
             INSERT INTO chat_history (user_id, username, message, response, message_role, chat_type, chat_id)
             VALUES (?, ?, ?, ?, 'user', ?, ?)
         ''', (user_id, username, message, response, chat_type, chat_id if chat_id is not None else user_id))
-        
-        conn.commit()
-        conn.close()
     
     def get_recent_history(self, user_id: int, limit: int = 5):
-        conn = sqlite3.connect(self.db_path)
+        conn = db.connect(self.db_path)
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -999,7 +754,7 @@ class TelegramChatBot:
         return list(reversed(history))
     
     def get_all_users(self):
-        conn = sqlite3.connect(self.db_path)
+        conn = db.connect(self.db_path)
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -1015,7 +770,7 @@ class TelegramChatBot:
     
     def get_user_info(self, user_id: int):
         """Get user information from database"""
-        conn = sqlite3.connect(self.db_path)
+        conn = db.connect(self.db_path)
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -1032,10 +787,7 @@ class TelegramChatBot:
     
     def track_group(self, chat_id: int, title: str, username: str, chat_type: str):
         """Track group/supergroup in database"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
+        self.write_behind.execute('''
             INSERT INTO group_registry (group_id, title, username, chat_type, last_active, message_count)
             VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP, 1)
             ON CONFLICT(group_id) DO UPDATE SET
@@ -1044,13 +796,10 @@ class TelegramChatBot:
                 last_active = CURRENT_TIMESTAMP,
                 message_count = message_count + 1
         ''', (chat_id, title, username, chat_type, title, username))
-        
-        conn.commit()
-        conn.close()
     
     def get_all_groups(self):
         """Get all groups bot is part of"""
-        conn = sqlite3.connect(self.db_path)
+        conn = db.connect(self.db_path)
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -1066,14 +815,14 @@ class TelegramChatBot:
     
     def get_user_chat_history(self, username: str, limit: int = 50):
         """Get chat history for a specific username"""
-        conn = sqlite3.connect(self.db_path)
+        conn = db.connect(self.db_path)
         cursor = conn.cursor()
         
         cursor.execute('''
             SELECT ch.message, ch.response, ch.timestamp, ch.message_role
             FROM chat_history ch
             JOIN all_users au ON ch.user_id = au.user_id
-            WHERE LOWER(au.username) = LOWER(?) AND ch.chat_type = 'dm'
+            WHERE au.username = ? COLLATE NOCASE AND ch.chat_type = 'dm'
             ORDER BY ch.timestamp DESC
             LIMIT ?
         ''', (username, limit))
@@ -1085,15 +834,21 @@ class TelegramChatBot:
     
     def delete_user_chats(self, username: str):
         """Delete all chat history for a specific user"""
-        conn = sqlite3.connect(self.db_path)
+        conn = db.connect(self.db_path)
         cursor = conn.cursor()
         
         cursor.execute('''
             DELETE FROM chat_history
-            WHERE user_id IN (SELECT user_id FROM all_users WHERE LOWER(username) = LOWER(?))
+            WHERE user_id IN (SELECT user_id FROM all_users WHERE username = ? COLLATE NOCASE)
         ''', (username,))
         
         deleted = cursor.rowcount
+        
+        cursor.execute('''
+            DELETE FROM user_sessions
+            WHERE user_id IN (SELECT user_id FROM all_users WHERE username = ? COLLATE NOCASE)
+        ''', (username,))
+        
         conn.commit()
         conn.close()
         
@@ -1101,59 +856,187 @@ class TelegramChatBot:
     
     def delete_all_chats(self):
         """Delete all chat history"""
-        conn = sqlite3.connect(self.db_path)
+        conn = db.connect(self.db_path)
         cursor = conn.cursor()
         
         cursor.execute('DELETE FROM chat_history')
         deleted = cursor.rowcount
+        # Summaries are derived from the history, so they go too
+        cursor.execute('DELETE FROM user_sessions')
         
         conn.commit()
         conn.close()
         
         return deleted
     
-    def check_keyword_match(self, message: str):
-        """Check if message contains any keyword and return response"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT keyword, response FROM group_keywords')
-        keywords = cursor.fetchall()
-        conn.close()
-        
-        message_lower = message.lower()
-        
-        for keyword, response in keywords:
-            if keyword.lower() in message_lower:
-                logger.info(f"Keyword matched: '{keyword}' in message")
-                return response
+    async def render_chat_search(self, admin_id: int, page: int):
+        """Text and pagination keyboard for one page of the admin's last chat search"""
+        words, days = self.chat_searches[admin_id]
+        total, rows = await self.adb.read(search_chats, self.db_path, words, days, page)
+        pages = max(1, -(-total // CHAT_SEARCH_PAGE_SIZE))
+        
+        window = f" in the last {days} days" if days else ""
+        text = f"🔎 *Chat Search:* {escape_markdown_clipped(' '.join(words) + window, 200)}\n"
+        text += escape_markdown(f"{total} matches - page {page + 1}/{pages}") + "\n\n"
+        # Budget per result after escaping, so a full page always fits in one Telegram message
+        entry_budget = CHAT_SEARCH_MAX_CHARS // CHAT_SEARCH_PAGE_SIZE
+        for username, chat_type, timestamp, message, response in rows:
+            header = f"*@{escape_markdown_clipped(username, 64)}* {escape_markdown(f'({chat_type}, {timestamp})')}\n"
+            text_budget = max(20, (entry_budget - len(header) - 8) // 2)
+            text += header
+            text += f"👤 {escape_markdown_clipped(clip(message), text_budget)}\n"
+            text += f"🤖 {escape_markdown_clipped(clip(response), text_budget)}\n\n"
+        if not rows:
+            text += escape_markdown("No conversations found.")
+        
+        nav = []
+        if page > 0:
+            nav.append(InlineKeyboardButton("« Prev", callback_data=f"chat_search_page_{page - 1}"))
+        if page + 1 < pages:
+            nav.append(InlineKeyboardButton("Next »", callback_data=f"chat_search_page_{page + 1}"))
+        keyboard = [nav] if nav else []
+        keyboard.append([InlineKeyboardButton("« Back", callback_data="admin_refresh")])
+        return text, InlineKeyboardMarkup(keyboard)
+    
+    def check_keyword_match(self, message: str, chat_type: str = 'dm', chat_id: int = None):
+        """Check if message contains any keyword scoped to this chat and return response"""
+        match = self.config_cache.get('group_keywords').match(message, chat_type, chat_id)
+        if match:
+            logger.info(f"Keyword matched: '{match[0]}' in message")
+            return match[1]
         
         return None
     
-    def add_keyword(self, keyword: str, response: str):
-        """Add a new keyword with its response"""
-        conn = sqlite3.connect(self.db_path)
+    def add_keyword(self, keyword: str, response: str, scope: str = SCOPE_ALL, scope_id: int = None,
+                    is_regex: int = 0, priority: int = 0):
+        """Add a new keyword rule with its response"""
+        conn = db.connect(self.db_path)
         cursor = conn.cursor()
         
-        cursor.execute('INSERT INTO group_keywords (keyword, response) VALUES (?, ?)', (keyword, response))
+        cursor.execute('''
+            INSERT INTO group_keywords (keyword, response, scope, scope_id, is_regex, priority)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (keyword, response, scope, scope_id, is_regex, priority))
         
         conn.commit()
         conn.close()
     
+    def import_keywords(self, rules):
+        """Insert validated (keyword, response, scope, scope_id, is_regex, priority) rules in one transaction"""
+        conn = db.connect(self.db_path)
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.executemany('''
+                INSERT INTO group_keywords (keyword, response, scope, scope_id, is_regex, priority)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', rules)
+            conn.commit()
+        finally:
+            conn.close()
+        return len(rules)
+    
     def get_all_keywords(self):
-        """Get all keywords"""
-        conn = sqlite3.connect(self.db_path)
+        """Get all keywords with their scope, regex flag and priority"""
+        conn = db.connect(self.db_path)
         cursor = conn.cursor()
         
-        cursor.execute('SELECT id, keyword, response, created_at FROM group_keywords ORDER BY created_at DESC')
+        cursor.execute('''
+            SELECT id, keyword, response, created_at, scope, scope_id, is_regex, priority
+            FROM group_keywords
+            ORDER BY created_at DESC
+        ''')
         keywords = cursor.fetchall()
         conn.close()
         
         return keywords
     
+    def get_keyword_account_choices(self):
+        """Pyrogram accounts a keyword can be scoped to: (id, account_name, phone_number)"""
+        conn = db.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('SELECT id, account_name, phone_number FROM pyrogram_accounts ORDER BY created_at DESC')
+        accounts = cursor.fetchall()
+        conn.close()
+        return accounts
+    
+    def keyword_scope_label(self, scope: str, scope_id: int = None):
+        """Short human label for a keyword scope"""
+        if scope == SCOPE_DM:
+            return "💬 DMs only"
+        if scope == SCOPE_GROUP:
+            return "👥 Groups only"
+        if scope == SCOPE_CHAT:
+            return f"🏘️ Group {scope_id}"
+        if scope == SCOPE_ACCOUNT:
+            return f"📱 Account #{scope_id}"
+        return "🌐 Everywhere"
+    
+    async def save_pending_keyword(self, query, user_id: int, scope: str, scope_id: int = None):
+        """Store the keyword the admin just finished, with the chosen scope"""
+        pending = self.pending_keywords.pop(user_id, None)
+        if not pending:
+            await query.edit_message_text(
+                "⌛ This keyword was already saved or cancelled. Please add it again.",
+                reply_markup=self.get_admin_keyboard()
+            )
+            return
+        await self.adb.write(self.add_keyword, pending['keyword'], pending['response'], scope, scope_id,
+                             pending['is_regex'], pending['priority'])
+        kind = "Regex" if pending['is_regex'] else "Keyword"
+        await query.edit_message_text(
+            f"✅ *Keyword Added Successfully!*\n\n"
+            f"*{kind}:* `{pending['keyword']}`\n"
+            f"*Scope:* {self.keyword_scope_label(scope, scope_id)}\n"
+            f"*Priority:* {pending['priority']}\n"
+            f"*Response:* {pending['response'][:100]}{'...' if len(pending['response']) > 100 else ''}",
+            reply_markup=self.get_admin_keyboard(),
+            parse_mode='Markdown'
+        )
+        logger.info(f"Admin {user_id} added keyword '{pending['keyword']}' ({scope} {scope_id or ''})")
+    
+    async def import_keyword_csv(self, update: Update, user_id: int, text: str):
+        """Validate a CSV of keyword rules and insert all of them, or none"""
+        rules, errors = parse_keyword_csv(text)
+        if errors or not rules:
+            error_text = "\n".join(errors[:10]) if errors else "No rules found in the CSV."
+            if len(errors) > 10:
+                error_text += f"\n...and {len(errors) - 10} more"
+            await update.message.reply_text(
+                f"❌ Nothing was imported. Fix these rows and send the CSV again:\n\n{error_text}\n\n"
+                f"Send /cancel to cancel."
+            )
+            return
+        
+        self.admin_state.pop(user_id, None)
+        count = await self.adb.write(self.import_keywords, rules)
+        await update.message.reply_text(
+            f"✅ *Imported {count} keyword rules!*",
+            reply_markup=self.get_admin_keyboard(),
+            parse_mode='Markdown'
+        )
+        logger.info(f"Admin {user_id} imported {count} keyword rules")
+    
+    async def handle_document(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """CSV uploads for the keyword bulk import"""
+        user = update.effective_user
+        if not self.is_admin(user.id) or self.admin_state.get(user.id) != "waiting_keyword_csv":
+            return
+        document = update.message.document
+        if not (document.file_name or '').lower().endswith('.csv'):
+            await update.message.reply_text("❌ Please send a .csv file (or paste the CSV as text).")
+            return
+        file = await document.get_file()
+        data = await file.download_as_bytearray()
+        try:
+            text = bytes(data).decode('utf-8-sig')
+        except UnicodeDecodeError:
+            await update.message.reply_text("❌ The CSV must be UTF-8 encoded.")
+            return
+        await self.import_keyword_csv(update, user.id, text)
+    
     def delete_keyword(self, keyword_id: int):
         """Delete a keyword by ID"""
-        conn = sqlite3.connect(self.db_path)
+        conn = db.connect(self.db_path)
         cursor = conn.cursor()
         
         cursor.execute('DELETE FROM group_keywords WHERE id = ?', (keyword_id,))
@@ -1179,7 +1062,7 @@ class TelegramChatBot:
                 reply_markup=self.get_admin_keyboard()
             )
         else:
-            custom_welcome = self.get_automated_message('welcome')
+            custom_welcome = await self.adb.read(self.get_automated_message, 'welcome')
             if custom_welcome:
                 welcome_message = custom_welcome.replace('{first_name}', user.first_name)
             else:
@@ -1206,7 +1089,7 @@ class TelegramChatBot:
                 reply_markup=self.get_admin_keyboard()
             )
         else:
-            custom_help = self.get_automated_message('help')
+            custom_help = await self.adb.read(self.get_automated_message, 'help')
             if custom_help:
                 help_text = custom_help
             else:
@@ -1226,7 +1109,7 @@ class TelegramChatBot:
     async def clear_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = update.effective_user.id
         
-        conn = sqlite3.connect(self.db_path)
+        conn = db.connect(self.db_path)
         cursor = conn.cursor()
         cursor.execute('DELETE FROM chat_history WHERE user_id = ?', (user_id,))
         cursor.execute('DELETE FROM user_sessions WHERE user_id = ?', (user_id,))
@@ -1249,7 +1132,7 @@ class TelegramChatBot:
         data = query.data
         
         if data == "admin_view_knowledge":
-            all_knowledge = self.get_all_bot_knowledge()
+            all_knowledge = await self.adb.read(self.get_all_bot_knowledge)
             if all_knowledge:
                 knowledge_text = "📚 *All Bot Knowledge:*\n\n"
                 for idx, (kid, ktext, created) in enumerate(all_knowledge, 1):
@@ -1286,7 +1169,7 @@ class TelegramChatBot:
             )
         
         elif data == "admin_delete_knowledge":
-            all_knowledge = self.get_all_bot_knowledge()
+            all_knowledge = await self.adb.read(self.get_all_bot_knowledge)
             if not all_knowledge:
                 await query.edit_message_text(
                     "⚠️ *No knowledge to delete\\!*\n\n"
@@ -1313,7 +1196,7 @@ class TelegramChatBot:
             )
         
         elif data == "admin_view_users":
-            users = self.get_all_users()
+            users = await self.adb.read(self.get_all_users)
             if not users:
                 await query.edit_message_text(
                     "📭 No users yet!",
@@ -1343,7 +1226,7 @@ class TelegramChatBot:
             )
         
         elif data == "admin_message_user":
-            users = self.get_all_users()
+            users = await self.adb.read(self.get_all_users)
             if not users:
                 await query.edit_message_text(
                     "📭 No users to message!",
@@ -1371,7 +1254,7 @@ class TelegramChatBot:
             self.user_to_admin_chat[target_user_id] = user_id
             self.admin_state[user_id] = "chatting"
             
-            conn = sqlite3.connect(self.db_path)
+            conn = db.connect(self.db_path)
             cursor = conn.cursor()
             cursor.execute('SELECT username, first_name FROM all_users WHERE user_id = ?', (target_user_id,))
             result = cursor.fetchone()
@@ -1434,10 +1317,11 @@ class TelegramChatBot:
             )
         
         elif data == "admin_auto_messages":
-            all_messages = self.get_all_automated_messages()
+            all_messages = await self.adb.read(self.get_all_automated_messages)
             keyboard = [
                 [InlineKeyboardButton("📝 Edit Welcome Message", callback_data="edit_msg_welcome")],
                 [InlineKeyboardButton("📝 Edit Help Message", callback_data="edit_msg_help")],
+                [InlineKeyboardButton("📝 Edit Busy Message", callback_data="edit_msg_busy")],
                 [InlineKeyboardButton("📋 View All Messages", callback_data="view_all_auto_msgs")],
                 [InlineKeyboardButton("« Back", callback_data="admin_refresh")]
             ]
@@ -1445,7 +1329,8 @@ class TelegramChatBot:
                 "📝 *Automated Messages*\n\n"
                 "Manage bot's automatic responses:\n\n"
                 "• Welcome Message - /start command\n"
-                "• Help Message - /help command\n\n"
+                "• Help Message - /help command\n"
+                "• Busy Message - sent when too many AI replies are pending\n\n"
                 "Use {first_name} in messages for user's name\n\n"
                 "Choose an option below:",
                 reply_markup=InlineKeyboardMarkup(keyboard),
@@ -1455,9 +1340,9 @@ class TelegramChatBot:
         elif data.startswith("edit_msg_"):
             message_type = data.replace("edit_msg_", "")
             self.admin_state[user_id] = f"waiting_auto_msg_{message_type}"
-            current_msg = self.get_automated_message(message_type)
+            current_msg = await self.adb.read(self.get_automated_message, message_type)
             
-            msg_name = "Welcome" if message_type == "welcome" else "Help"
+            msg_name = {'welcome': "Welcome", 'busy': "Busy"}.get(message_type, "Help")
             await query.edit_message_text(
                 f"✏️ *Edit {msg_name} Message*\n\n"
                 f"Current message:\n"
@@ -1468,7 +1353,7 @@ class TelegramChatBot:
             )
         
         elif data == "view_all_auto_msgs":
-            all_messages = self.get_all_automated_messages()
+            all_messages = await self.adb.read(self.get_all_automated_messages)
             if all_messages:
                 msg_text = "📋 *All Automated Messages:*\n\n"
                 for msg_type, msg_text_db, updated in all_messages:
@@ -1488,24 +1373,29 @@ class TelegramChatBot:
                 [InlineKeyboardButton("📝 View Keywords", callback_data="admin_view_keywords")],
                 [InlineKeyboardButton("➕ Add Keyword", callback_data="admin_add_keyword")],
                 [InlineKeyboardButton("🗑️ Delete Keyword", callback_data="admin_delete_keyword")],
+                [InlineKeyboardButton("📥 Import CSV", callback_data="admin_import_keywords")],
                 [InlineKeyboardButton("« Back", callback_data="admin_refresh")]
             ]
             await query.edit_message_text(
                 "🔑 *Keyword Management*\n\n"
                 "Keywords work in both groups and DMs!\n\n"
                 "When someone sends a message containing a keyword, bot will automatically reply with the saved response.\n\n"
+                "Keywords can be limited to DMs, groups, one group or one account, and can be regexes.\n\n"
                 "Choose an option:",
                 reply_markup=InlineKeyboardMarkup(keyboard),
                 parse_mode='Markdown'
             )
         
         elif data == "admin_view_keywords":
-            keywords = self.get_all_keywords()
+            keywords = await self.adb.read(self.get_all_keywords)
             if keywords:
                 kw_text = "📝 *All Keywords:*\n\n"
-                for idx, (kid, keyword, response, created) in enumerate(keywords, 1):
+                for idx, (kid, keyword, response, created, scope, scope_id, is_regex, priority) in enumerate(keywords, 1):
+                    response = response or ""
                     resp_preview = response[:80] + "..." if len(response) > 80 else response
-                    kw_text += f"{idx}. *Keyword:* `{keyword}`\n"
+                    kw_text += f"{idx}. *{'Regex' if is_regex else 'Keyword'}:* `{keyword}`\n"
+                    kw_text += f"   *Scope:* {self.keyword_scope_label(scope, scope_id)}"
+                    kw_text += f" | *Priority:* {priority}\n" if priority else "\n"
                     kw_text += f"   *Response:* {resp_preview}\n\n"
                 kw_text += f"\n*Total: {len(keywords)} keywords*"
             else:
@@ -1524,12 +1414,14 @@ class TelegramChatBot:
                 "Send the keyword you want to detect.\n\n"
                 "*Example:* `price` or `contact` or `website`\n\n"
                 "⚡ Bot will respond whenever this word appears in a message!\n\n"
+                "*Regex:* start with `re:` (e.g. `re:order\\s*#?\\d+`)\n"
+                "*Priority:* end with `!N` (e.g. `price !5`); higher wins when several match\n\n"
                 "Send /cancel to cancel.",
                 parse_mode='Markdown'
             )
         
         elif data == "admin_delete_keyword":
-            keywords = self.get_all_keywords()
+            keywords = await self.adb.read(self.get_all_keywords)
             if not keywords:
                 await query.edit_message_text(
                     "⚠️ *No keywords to delete!*\n\nAdd some keywords first.",
@@ -1539,8 +1431,8 @@ class TelegramChatBot:
                 return
             
             kw_text = "🗑️ *Delete Keyword*\n\n"
-            for idx, (kid, keyword, response, created) in enumerate(keywords, 1):
-                kw_text += f"{idx}. `{keyword}`\n"
+            for idx, (kid, keyword, response, created, scope, scope_id, is_regex, priority) in enumerate(keywords, 1):
+                kw_text += f"{idx}. `{keyword}` ({self.keyword_scope_label(scope, scope_id)})\n"
             kw_text += f"\n*Total: {len(keywords)} keywords*\n\n"
             kw_text += "Send the number (1, 2, 3...) of the keyword you want to delete.\n\n"
             kw_text += "Send /cancel to cancel."
@@ -1551,11 +1443,95 @@ class TelegramChatBot:
                 parse_mode='Markdown'
             )
         
+        elif data == "admin_import_keywords":
+            self.admin_state[user_id] = "waiting_keyword_csv"
+            await query.edit_message_text(
+                "📥 *Import Keywords (CSV)*\n\n"
+                "Send a .csv file or paste the CSV text. The first row must be the header:\n"
+                "`keyword,response,scope,scope_id,regex,priority`\n\n"
+                "*scope:* all, dm, group, chat (scope\\_id = group id) or account (scope\\_id = account id)\n"
+                "*regex:* yes/no, *priority:* number (higher wins)\n\n"
+                "All rows are checked first; if any row is invalid nothing is imported.\n\n"
+                "Send /cancel to cancel.",
+                parse_mode='Markdown'
+            )
+        
+        elif data == "kw_scope_chat":
+            groups = await self.adb.read(self.get_all_groups)
+            if not groups:
+                await query.edit_message_text(
+                    "🏘️ No groups known yet - the bot has to see a group message first.\n\n"
+                    "🎯 *Where should this keyword work?*",
+                    reply_markup=self.get_keyword_scope_keyboard(),
+                    parse_mode='Markdown'
+                )
+                return
+            keyboard = [[InlineKeyboardButton(f"🏘️ {title or group_id}", callback_data=f"kw_scope_chat_{group_id}")]
+                        for group_id, title, *_ in groups[:20]]
+            keyboard.append([InlineKeyboardButton("« Back", callback_data="kw_scope_back")])
+            await query.edit_message_text(
+                "🏘️ *Which group should this keyword work in?*",
+                reply_markup=InlineKeyboardMarkup(keyboard),
+                parse_mode='Markdown'
+            )
+        
+        elif data == "kw_scope_account":
+            accounts = await self.adb.read(self.get_keyword_account_choices)
+            if not accounts:
+                await query.edit_message_text(
+                    "📱 No accounts added yet.\n\n"
+                    "🎯 *Where should this keyword work?*",
+                    reply_markup=self.get_keyword_scope_keyboard(),
+                    parse_mode='Markdown'
+                )
+                return
+            keyboard = [[InlineKeyboardButton(f"📱 {name or phone} (#{acc_id})", callback_data=f"kw_scope_account_{acc_id}")]
+                        for acc_id, name, phone in accounts[:20]]
+            keyboard.append([InlineKeyboardButton("« Back", callback_data="kw_scope_back")])
+            await query.edit_message_text(
+                "📱 *Which account should this keyword work for?*",
+                reply_markup=InlineKeyboardMarkup(keyboard),
+                parse_mode='Markdown'
+            )
+        
+        elif data == "kw_scope_back":
+            await query.edit_message_text(
+                "🎯 *Where should this keyword work?*",
+                reply_markup=self.get_keyword_scope_keyboard(),
+                parse_mode='Markdown'
+            )
+        
+        elif data.startswith("kw_scope_chat_"):
+            await self.save_pending_keyword(query, user_id, SCOPE_CHAT, int(data.replace("kw_scope_chat_", "")))
+        
+        elif data.startswith("kw_scope_account_"):
+            await self.save_pending_keyword(query, user_id, SCOPE_ACCOUNT, int(data.replace("kw_scope_account_", "")))
+        
+        elif data.startswith("kw_scope_"):
+            await self.save_pending_keyword(query, user_id, data.replace("kw_scope_", ""))
+        
         elif data == "admin_api_stats":
-            stats = self.get_api_key_stats()
+            stats = await self.adb.read(self.get_api_key_stats)
             stats_text = "🔑 *API Key & Token Statistics*\n\n"
             stats_text += f"📊 Total API Keys: {len(self.api_keys)}\n"
-            stats_text += f"🔄 Currently Using: Key #{self.current_key_index + 1}\n"
+            stats_text += f"🟢 Healthy Keys: {len(self.key_pool.healthy_keys())}/{len(self.key_pool)}\n"
+            stats_text += f"🔄 Requests In Flight: {self.key_pool.total_in_flight()}\n"
+            flight_stats = self.key_pool.single_flight.stats()
+            stats_text += f"🔗 Duplicate Calls Saved: {flight_stats['coalesced']} (of {flight_stats['calls'] + flight_stats['coalesced']} requests)\n"
+            cache_stats = self.response_cache.stats()
+            stats_text += f"⚡ Cached Answers: {cache_stats['hits']} hits / {cache_stats['misses']} misses ({cache_stats['hit_rate']:.0f}%)\n"
+            hedge_stats = self.key_pool.hedging.stats()
+            if self.key_pool.hedging.enabled:
+                stats_text += f"🏇 Hedged Requests: {hedge_stats['hedged']} ({hedge_stats['hedge_wins']} answered first, {hedge_stats['skipped_budget']} skipped by budget)\n"
+            admission_stats = self.admission.stats()
+            stats_text += f"🚦 AI Queue: {admission_stats['in_flight']}/{self.admission.max_in_flight} running, {admission_stats['queue_depth']} waiting, {admission_stats['shed_queue_full'] + admission_stats['shed_deadline']} shed\n"
+            write_stats = self.write_behind.stats()
+            stats_text += f"🗄️ Pending DB Writes: {self.adb.pending_writes + write_stats['pending']} ({write_stats['rows_written']} batched in {write_stats['flushes']} commits, {write_stats['dropped']} failed)\n"
+            burst_stats = self.burst_aggregator.stats()
+            retention_stats = self.chat_retention.stats()
+            if retention_stats['enabled']:
+                stats_text += f"🗃️ Archived Chats: {retention_stats['rows_archived']} (keeping {retention_stats['retention_days']} days)\n"
+            stats_text += f"📨 Merged Messages: {burst_stats['merged_messages']} ({burst_stats['cancelled_generations']} stale replies cancelled)\n"
             stats_text += f"💎 Daily Limit Per Key: 2.5M tokens (GPT-4o-mini)\n\n"
             
             if stats:
@@ -1592,7 +1568,7 @@ class TelegramChatBot:
                     stats_text += f"\n*Key #{key_num}* {status}\n"
                     stats_text += f"  📊 Used: {tokens_used:,} / {s['daily_limit']:,}\n"
                     stats_text += f"  💚 Left: {tokens_left:,} tokens\n"
-                    stats_text += f"  📞 API Calls: {s['usage_count']}\n"
+                    stats_text += f"  📞 API Calls: {s['usage_count']} ({s['requests_last_5m']} in last 5 min)\n"
                     
                     if s['rate_limit_hits'] > 0:
                         stats_text += f"  ⚠️ Rate Hits: {s['rate_limit_hits']}\n"
@@ -1615,7 +1591,7 @@ class TelegramChatBot:
             )
         
         elif data == "admin_deactivated_keys":
-            deactivated = self.get_deactivated_keys()
+            deactivated = await self.adb.read(self.get_deactivated_keys)
             
             if not deactivated:
                 msg_text = "🟢 *No Deactivated API Keys!*\n\n"
@@ -1667,6 +1643,30 @@ class TelegramChatBot:
                 parse_mode='Markdown'
             )
         
+        elif data == "admin_search_chats":
+            self.admin_state[user_id] = "waiting_chat_search"
+            await query.edit_message_text(
+                "🔎 *Search Chats*\n\n"
+                "Send the words to search for in all messages and replies.\n"
+                "Add a time window at the end to limit the search.\n\n"
+                "*Examples:*\n"
+                "`refund`\n"
+                "`refund 7d` (last 7 days)\n\n"
+                "Send /cancel to cancel.",
+                parse_mode='Markdown'
+            )
+        
+        elif data.startswith("chat_search_page_"):
+            if user_id not in self.chat_searches:
+                await query.edit_message_text(
+                    "⌛ This search has expired. Please search again.",
+                    reply_markup=self.get_admin_keyboard()
+                )
+                return
+            page = int(data.replace("chat_search_page_", ""))
+            text, markup = await self.render_chat_search(user_id, page)
+            await query.edit_message_text(text, reply_markup=markup, parse_mode='MarkdownV2')
+        
         elif data == "admin_delete_chats_menu":
             keyboard = [
                 [InlineKeyboardButton("🗑️ Delete User Chats", callback_data="admin_delete_user_chats")],
@@ -1705,7 +1705,7 @@ class TelegramChatBot:
             )
         
         elif data == "confirm_delete_all_chats":
-            deleted_count = self.delete_all_chats()
+            deleted_count = await self.adb.write(self.delete_all_chats)
             await query.edit_message_text(
                 f"✅ *All Chats Deleted!*\n\n"
                 f"Deleted {deleted_count} chat messages.\n\n"
@@ -1716,7 +1716,7 @@ class TelegramChatBot:
             logger.info(f"Admin {user_id} deleted all chat history ({deleted_count} messages)")
         
         elif data == "admin_group_sessions":
-            groups = self.get_all_groups()
+            groups = await self.adb.read(self.get_all_groups)
             if not groups:
                 await query.edit_message_text(
                     "📭 *No Groups Found!*\n\n"
@@ -1750,7 +1750,7 @@ class TelegramChatBot:
             self.group_to_admin[group_id] = user_id
             self.admin_state[user_id] = "group_messaging"
             
-            groups = self.get_all_groups()
+            groups = await self.adb.read(self.get_all_groups)
             group_info = next((g for g in groups if g[0] == group_id), None)
             group_name = group_info[1] if group_info else f"Group {group_id}"
             
@@ -1811,7 +1811,7 @@ class TelegramChatBot:
             )
         
         elif data == "admin_list_super_knowledge":
-            entries = self.get_super_knowledge_list()
+            entries = await self.adb.read(self.get_super_knowledge_list)
             
             if not entries:
                 await query.edit_message_text(
@@ -1856,7 +1856,7 @@ class TelegramChatBot:
         elif data.startswith("sk_toggle_"):
             # Toggle super knowledge active/inactive
             knowledge_id = int(data.split("_")[2])
-            self.toggle_knowledge_status(knowledge_id)
+            await self.adb.write(self.toggle_knowledge_status, knowledge_id)
             await query.answer("✅ Status toggled!")
             # Refresh the manage view
             await self.show_super_knowledge_manage(query, user_id, knowledge_id)
@@ -1864,7 +1864,7 @@ class TelegramChatBot:
         elif data.startswith("sk_delete_"):
             # Delete super knowledge
             knowledge_id = int(data.split("_")[2])
-            self.delete_super_knowledge(knowledge_id)
+            await self.adb.write(self.delete_super_knowledge, knowledge_id)
             await query.answer("🗑️ Deleted!")
             await query.edit_message_text(
                 "✅ *Super Knowledge Deleted!*",
@@ -1896,7 +1896,7 @@ class TelegramChatBot:
             title, knowledge_text = parts
             
             # Add super knowledge to database
-            knowledge_id = self.add_super_knowledge(title, knowledge_text, scope)
+            knowledge_id = await self.adb.write(self.add_super_knowledge, title, knowledge_text, scope)
             
             del self.admin_state[user_id]
             await query.answer("✅ Super Knowledge Added!")
@@ -1922,7 +1922,7 @@ class TelegramChatBot:
         
         elif data == "admin_pyrogram_manager":
             # Get all Pyrogram accounts
-            conn = sqlite3.connect(self.db_path)
+            conn = db.connect(self.db_path)
             cursor = conn.cursor()
             cursor.execute('SELECT id, phone_number, account_name, is_active, is_authenticated, reply_count FROM pyrogram_accounts ORDER BY created_at DESC')
             accounts = cursor.fetchall()
@@ -1986,7 +1986,7 @@ class TelegramChatBot:
             )
         
         elif data == "pyrogram_list_accounts":
-            conn = sqlite3.connect(self.db_path)
+            conn = db.connect(self.db_path)
             cursor = conn.cursor()
             cursor.execute('SELECT id, phone_number, account_name, is_active, is_authenticated, reply_count, last_active, error_message FROM pyrogram_accounts ORDER BY created_at DESC')
             accounts = cursor.fetchall()
@@ -2029,7 +2029,7 @@ class TelegramChatBot:
         elif data.startswith("pyro_toggle_"):
             account_id = int(data.split("_")[2])
             
-            conn = sqlite3.connect(self.db_path)
+            conn = db.connect(self.db_path)
             cursor = conn.cursor()
             
             # Toggle is_active status
@@ -2061,7 +2061,7 @@ class TelegramChatBot:
             # Re-trigger list view
             data = "pyrogram_list_accounts"
             # Fall through to list view below
-            conn = sqlite3.connect(self.db_path)
+            conn = db.connect(self.db_path)
             cursor = conn.cursor()
             cursor.execute('SELECT id, phone_number, account_name, is_active, is_authenticated, reply_count, last_active, error_message FROM pyrogram_accounts ORDER BY created_at DESC')
             accounts = cursor.fetchall()
@@ -2095,7 +2095,7 @@ class TelegramChatBot:
             await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
         
         elif data == "pyro_delete_menu":
-            conn = sqlite3.connect(self.db_path)
+            conn = db.connect(self.db_path)
             cursor = conn.cursor()
             cursor.execute('SELECT id, phone_number, account_name FROM pyrogram_accounts ORDER BY created_at DESC')
             accounts = cursor.fetchall()
@@ -2129,7 +2129,7 @@ class TelegramChatBot:
         elif data.startswith("pyro_delete_"):
             account_id = int(data.split("_")[2])
             
-            conn = sqlite3.connect(self.db_path)
+            conn = db.connect(self.db_path)
             cursor = conn.cursor()
             cursor.execute('SELECT account_name FROM pyrogram_accounts WHERE id = ?', (account_id,))
             result = cursor.fetchone()
@@ -2173,7 +2173,7 @@ class TelegramChatBot:
             await query.answer("ℹ️ Stop the process/deployment to stop all bots.")
         
         elif data == "pyrogram_manage_knowledge":
-            conn = sqlite3.connect(self.db_path)
+            conn = db.connect(self.db_path)
             cursor = conn.cursor()
             cursor.execute('SELECT id, phone_number, account_name, is_authenticated FROM pyrogram_accounts ORDER BY created_at DESC')
             accounts = cursor.fetchall()
@@ -2210,7 +2210,7 @@ class TelegramChatBot:
         elif data.startswith("pyro_know_"):
             account_id = int(data.split("_")[2])
             
-            conn = sqlite3.connect(self.db_path)
+            conn = db.connect(self.db_path)
             cursor = conn.cursor()
             cursor.execute('SELECT account_name, phone_number FROM pyrogram_accounts WHERE id = ?', (account_id,))
             account = cursor.fetchone()
@@ -2256,7 +2256,7 @@ class TelegramChatBot:
         elif data.startswith("pyro_know_list_"):
             account_id = int(data.split("_")[3])
             
-            entries = self.get_account_knowledge_list(account_id)
+            entries = await self.adb.read(self.get_account_knowledge_list, account_id)
             
             if not entries:
                 await query.edit_message_text(
@@ -2294,7 +2294,7 @@ class TelegramChatBot:
         elif data.startswith("pyro_know_del_"):
             account_id = int(data.split("_")[3])
             
-            entries = self.get_account_knowledge_list(account_id)
+            entries = await self.adb.read(self.get_account_knowledge_list, account_id)
             
             if not entries:
                 await query.edit_message_text(
@@ -2318,7 +2318,7 @@ class TelegramChatBot:
             account_id = int(data.split(":")[1])
             
             # Get account details
-            conn = sqlite3.connect(self.db_path)
+            conn = db.connect(self.db_path)
             cursor = conn.cursor()
             cursor.execute('SELECT phone_number, api_id, api_hash FROM pyrogram_accounts WHERE id = ?', (account_id,))
             result = cursor.fetchone()
@@ -2433,6 +2433,15 @@ class TelegramChatBot:
                 reply_markup=self.get_admin_keyboard()
             )
     
+    async def generate_ai_response(self, messages: list, on_delta=None):
+        """Get a chat completion without blocking the event loop.
+        
+        The key pool picks the least-loaded healthy key and moves to another key on 401/403/429.
+        If on_delta is given the completion is streamed and on_delta(text_so_far) is awaited
+        as tokens arrive.
+        """
+        return await self.key_pool.chat_completion(messages, on_delta=on_delta)
+    
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
         user_message = update.message.text
@@ -2453,7 +2462,7 @@ class TelegramChatBot:
             state = self.admin_state[user.id]
             
             if state == "waiting_knowledge":
-                self.set_bot_knowledge(user_message)
+                await self.adb.write(self.set_bot_knowledge, user_message)
                 del self.admin_state[user.id]
                 await update.message.reply_text(
                     f"✅ *Knowledge Added!*\n\n"
@@ -2468,7 +2477,7 @@ class TelegramChatBot:
             elif state == "waiting_delete_knowledge":
                 try:
                     knowledge_num = int(user_message.strip())
-                    all_knowledge = self.get_all_bot_knowledge()
+                    all_knowledge = await self.adb.read(self.get_all_bot_knowledge)
                     
                     if knowledge_num < 1 or knowledge_num > len(all_knowledge):
                         await update.message.reply_text(
@@ -2480,7 +2489,7 @@ class TelegramChatBot:
                     knowledge_id = all_knowledge[knowledge_num - 1][0]
                     deleted_text = all_knowledge[knowledge_num - 1][1]
                     
-                    if self.delete_bot_knowledge(knowledge_id):
+                    if await self.adb.write(self.delete_bot_knowledge, knowledge_id):
                         del self.admin_state[user.id]
                         preview = deleted_text[:100] + "..." if len(deleted_text) > 100 else deleted_text
                         escaped_preview = escape_markdown(preview)
@@ -2508,9 +2517,22 @@ class TelegramChatBot:
             
             elif state == "waiting_keyword":
                 keyword = user_message.strip()
-                self.admin_state[user.id] = f"waiting_keyword_response:{keyword}"
+                priority = 0
+                priority_match = re.match(r'^(.*?)\s+!(\d+)$', keyword)
+                if priority_match:
+                    keyword, priority = priority_match.group(1), int(priority_match.group(2))
+                is_regex = keyword.lower().startswith('re:')
+                if is_regex:
+                    keyword = keyword[3:]
+                try:
+                    keyword, _, _, is_regex, priority = validate_rule(keyword, is_regex=is_regex, priority=priority)
+                except ValueError as e:
+                    await update.message.reply_text(f"❌ {e}\n\nPlease send the keyword again, or /cancel.")
+                    return
+                self.pending_keywords[user.id] = {'keyword': keyword, 'is_regex': is_regex, 'priority': priority}
+                self.admin_state[user.id] = "waiting_keyword_response"
                 await update.message.reply_text(
-                    f"✅ *Keyword Set:* `{keyword}`\n\n"
+                    f"✅ *{'Regex' if is_regex else 'Keyword'} Set:* `{keyword}`\n\n"
                     f"Now send the response you want bot to send when this keyword is detected.\n\n"
                     f"*Example:* Our product costs ₹500/month with premium support!\n\n"
                     f"Send /cancel to cancel.",
@@ -2519,27 +2541,31 @@ class TelegramChatBot:
                 logger.info(f"Admin {user.id} setting keyword: {keyword}")
                 return
             
-            elif state.startswith("waiting_keyword_response:"):
-                keyword = state.split(":", 1)[1]
-                response_text = user_message
-                self.add_keyword(keyword, response_text)
+            elif state == "waiting_keyword_response":
+                pending = self.pending_keywords.get(user.id)
                 del self.admin_state[user.id]
+                if not pending:
+                    await update.message.reply_text("⌛ Please start adding the keyword again.",
+                                                    reply_markup=self.get_admin_keyboard())
+                    return
+                pending['response'] = user_message
                 
                 await update.message.reply_text(
-                    f"✅ *Keyword Added Successfully!*\n\n"
-                    f"*Keyword:* `{keyword}`\n"
-                    f"*Response:* {response_text[:100]}{'...' if len(response_text) > 100 else ''}\n\n"
-                    f"Bot will now respond with this message when '{keyword}' is detected!",
-                    reply_markup=self.get_admin_keyboard(),
+                    f"🎯 *Where should `{pending['keyword']}` work?*\n\n"
+                    f"Choose where the bot should answer with this response:",
+                    reply_markup=self.get_keyword_scope_keyboard(),
                     parse_mode='Markdown'
                 )
-                logger.info(f"Admin {user.id} added keyword '{keyword}' with response")
+                return
+            
+            elif state == "waiting_keyword_csv":
+                await self.import_keyword_csv(update, user.id, user_message)
                 return
             
             elif state == "waiting_delete_keyword":
                 try:
                     keyword_num = int(user_message.strip())
-                    all_keywords = self.get_all_keywords()
+                    all_keywords = await self.adb.read(self.get_all_keywords)
                     
                     if keyword_num < 1 or keyword_num > len(all_keywords):
                         await update.message.reply_text(
@@ -2551,7 +2577,7 @@ class TelegramChatBot:
                     keyword_id = all_keywords[keyword_num - 1][0]
                     deleted_keyword = all_keywords[keyword_num - 1][1]
                     
-                    if self.delete_keyword(keyword_id):
+                    if await self.adb.write(self.delete_keyword, keyword_id):
                         del self.admin_state[user.id]
                         await update.message.reply_text(
                             f"✅ *Keyword Deleted!*\n\n"
@@ -2576,7 +2602,7 @@ class TelegramChatBot:
                     return
             
             elif state == "waiting_broadcast":
-                users = self.get_all_users()
+                users = await self.adb.read(self.get_all_users)
                 sent_count = 0
                 failed_count = 0
                 
@@ -2605,10 +2631,10 @@ class TelegramChatBot:
             
             elif state.startswith("waiting_auto_msg_"):
                 message_type = state.replace("waiting_auto_msg_", "")
-                self.set_automated_message(message_type, user_message)
+                await self.adb.write(self.set_automated_message, message_type, user_message)
                 del self.admin_state[user.id]
                 
-                msg_name = "Welcome" if message_type == "welcome" else "Help"
+                msg_name = {'welcome': "Welcome", 'busy': "Busy"}.get(message_type, "Help")
                 await update.message.reply_text(
                     f"✅ *{msg_name} Message Updated!*\n\n"
                     f"New message:\n{user_message}\n\n"
@@ -2621,7 +2647,7 @@ class TelegramChatBot:
             
             elif state == "waiting_username_for_chats":
                 username = user_message.strip().replace('@', '')
-                history = self.get_user_chat_history(username, limit=30)
+                history = await self.adb.read(self.get_user_chat_history, username, limit=30)
                 
                 if not history:
                     await update.message.reply_text(
@@ -2655,9 +2681,25 @@ class TelegramChatBot:
                 logger.info(f"Admin {user.id} viewed chat history for @{username}")
                 return
             
+            elif state == "waiting_chat_search":
+                words, days = parse_search(user_message)
+                del self.admin_state[user.id]
+                if not words:
+                    await update.message.reply_text(
+                        "❌ Please send at least one word to search for.",
+                        reply_markup=self.get_admin_keyboard()
+                    )
+                    return
+                
+                self.chat_searches[user.id] = (words, days)
+                text, markup = await self.render_chat_search(user.id, 0)
+                await update.message.reply_text(text, reply_markup=markup, parse_mode='MarkdownV2')
+                logger.info(f"Admin {user.id} searched chats for {' '.join(words)!r}")
+                return
+            
             elif state == "waiting_username_for_delete":
                 username = user_message.strip().replace('@', '')
-                deleted_count = self.delete_user_chats(username)
+                deleted_count = await self.adb.write(self.delete_user_chats, username)
                 
                 if deleted_count == 0:
                     await update.message.reply_text(
@@ -2779,7 +2821,7 @@ class TelegramChatBot:
                 
                 title, knowledge_text = parts
                 
-                knowledge_id = self.add_super_knowledge(title, knowledge_text, scope)
+                knowledge_id = await self.adb.write(self.add_super_knowledge, title, knowledge_text, scope)
                 
                 del self.admin_state[user.id]
                 
@@ -2899,7 +2941,7 @@ class TelegramChatBot:
                 account_name = user_message.strip()
                 
                 try:
-                    conn = sqlite3.connect(self.db_path)
+                    conn = db.connect(self.db_path)
                     cursor = conn.cursor()
                     
                     # Check if phone already exists
@@ -2973,7 +3015,7 @@ class TelegramChatBot:
                             parse_mode='Markdown'
                         )
                         # Delete the account
-                        conn = sqlite3.connect(self.db_path)
+                        conn = db.connect(self.db_path)
                         cursor = conn.cursor()
                         cursor.execute('DELETE FROM pyrogram_accounts WHERE id = ?', (account_id,))
                         conn.commit()
@@ -3124,7 +3166,7 @@ class TelegramChatBot:
                 try:
                     # Auto-generate title from first 50 chars of knowledge
                     title = f"Knowledge {account_id}-{datetime.now().strftime('%H%M')}"
-                    knowledge_id = self.add_account_knowledge(account_id, title, knowledge_text)
+                    knowledge_id = await self.adb.write(self.add_account_knowledge, account_id, title, knowledge_text)
                     del self.admin_state[user.id]
                     
                     await update.message.reply_text(
@@ -3152,7 +3194,7 @@ class TelegramChatBot:
                 try:
                     knowledge_id = int(user_message.strip())
                     
-                    if self.delete_account_knowledge(knowledge_id):
+                    if await self.adb.write(self.delete_account_knowledge, knowledge_id):
                         del self.admin_state[user.id]
                         await update.message.reply_text(
                             f"✅ *Knowledge Deleted!*\n\n"
@@ -3228,7 +3270,8 @@ class TelegramChatBot:
                     logger.error(f"Failed to forward group message to admin: {e}")
         
         # Check for keyword matches (works in both groups and DMs)
-        keyword_response = self.check_keyword_match(user_message)
+        keyword_response = await self.adb.read(
+            self.check_keyword_match, user_message, 'group' if is_group else 'dm', update.message.chat.id)
         if keyword_response:
             logger.info(f"Keyword match found! Sending response to {'group' if is_group else 'DM'}")
             await update.message.reply_text(keyword_response)
@@ -3252,20 +3295,62 @@ class TelegramChatBot:
                 logger.info(f"Ignoring group message (not mentioned/replied): {user_message[:50]}")
                 return
         
+        # Wait for the user to stop typing; only the last message of a burst continues
+        burst_key = f"{update.message.chat.id}:{user.id}"
+        burst = await self.burst_aggregator.collect(burst_key, user_message)
+        if burst is None:
+            logger.info(f"Message from {user.id} merged into a newer burst")
+            return
+        user_message = burst.text
+        
         await update.message.chat.send_action("typing")
         
+        admitted = False
         try:
-            recent_history = self.get_recent_history(user.id, limit=3)
-            custom_knowledge = self.get_bot_knowledge()
-            
-            username_db, first_name_db, last_name_db = self.get_user_info(user.id)
-            user_first_name = user.first_name or first_name_db or "Dost"
+            # Summary plus every turn it does not cover yet, so no turn falls between the two
+            conversation_summary, recent_history = await self.adb.read(self.summarizer.get_context, user.id, key=user.id)
+            custom_knowledge = await self.adb.read(self.get_bot_knowledge)
+            
+            username_db, first_name_db, last_name_db = await self.adb.read(self.get_user_info, user.id, key=user.id)
+            real_first_name = user.first_name or first_name_db
+            # "Dost" is only a form of address for the prompt, never a name to template in the cache
+            user_first_name = real_first_name or "Dost"
             user_username = user.username or username_db
             
             # Get enhanced knowledge with priority system
-            knowledge_data = self.get_enhanced_knowledge(bot_type='main')
+            # Same question, same knowledge and no personal history -> same answer
+            cache_key = None
+            if not recent_history and not conversation_summary:
+                cache_key = self.response_cache.make_key(
+                    'main_group' if is_group else 'main_dm',
+                    await self.adb.read(knowledge_version, self.db_path),
+                    normalize_question(user_message, bot_username if is_group else None)
+                )
+                cached_response = self.response_cache.get(cache_key, user_first_name, user_username)
+                if cached_response:
+                    if not self.burst_aggregator.deliver(burst):
+                        return
+                    await update.message.reply_text(cached_response)
+                    self.save_chat_history(user.id, user.username or "Unknown", user_message, cached_response)
+                    self.summarizer.note_activity(user.id)
+                    self.burst_aggregator.finish(burst)
+                    logger.info(f"⚡ Sent cached AI response to {user.id}")
+                    return
+            
+            # Under a flood, answer right away with the busy message instead of queueing forever
+            try:
+                await self.admission.acquire()
+                admitted = True
+            except AdmissionRejected:
+                busy_message = await self.adb.read(self.get_automated_message, 'busy') or DEFAULT_BUSY_MESSAGE
+                if self.burst_aggregator.deliver(burst):
+                    await update.message.reply_text(busy_message.replace('{first_name}', user_first_name))
+                    self.burst_aggregator.finish(burst)
+                return
+            
+            knowledge_data = await self.adb.read(self.get_enhanced_knowledge, bot_type='main')
             super_knowledge = knowledge_data['super']
-            regular_knowledge = knowledge_data['regular']
+            regular_knowledge = await self.knowledge_index.select(user_message, 'bot_knowledge', knowledge_data['regular'])
             
             system_prompt = "Tum ek highly intelligent aur helpful AI assistant ho. Tumhe Hindi aur English dono languages mein expert tarike se baat karni aani hai."
             
@@ -3276,145 +3361,107 @@ class TelegramChatBot:
             
             system_prompt += f"\n\n🔐 IMPORTANT - OWNER RESPECT: Tumhare owner ka naam @tgshaitaan hai. Jab bhi owner baat kare ya unka zikr ho, tum unhe highest respect dena - 'Boss', 'Sir', ya 'Owner' kehke address karna hai."
             
+            summary_prompt = ""
+            if conversation_summary:
+                summary_prompt = f"\n\n🧠 PURANI BAATCHEET KA SUMMARY (earlier conversation with this user):\n{conversation_summary}"
+            
             if is_group:
                 system_prompt += "\n\n👥 GROUP CONTEXT: Yeh ek group chat hai. Natural tareeke se interact karo. Owner @tgshaitaan ko hamesha special respect do."
             
-            # SUPER KNOWLEDGE - MANDATORY DIRECTIVES (Highest Priority)
+            # SUPER KNOWLEDGE - MANDATORY DIRECTIVES (Highest Priority, never trimmed)
+            super_prompt = ""
             if super_knowledge:
-                system_prompt += "\n\n" + "="*60
-                system_prompt += "\n🔴 SUPER KNOWLEDGE - MANDATORY ADMINISTRATOR DIRECTIVES 🔴"
-                system_prompt += "\n" + "="*60
-                system_prompt += "\n\n⚠️ CRITICAL: The following are MANDATORY instructions from your administrator."
-                system_prompt += "\nThese directives OVERRIDE everything else and MUST be followed EXACTLY."
-                system_prompt += "\nAdministrator's teachings have ABSOLUTE priority over all other data."
-                system_prompt += "\nYou MUST apply these directives VERBATIM unless they violate Telegram ToS.\n\n"
+                super_prompt += "\n\n" + "="*60
+                super_prompt += "\n🔴 SUPER KNOWLEDGE - MANDATORY ADMINISTRATOR DIRECTIVES 🔴"
+                super_prompt += "\n" + "="*60
+                super_prompt += "\n\n⚠️ CRITICAL: The following are MANDATORY instructions from your administrator."
+                super_prompt += "\nThese directives OVERRIDE everything else and MUST be followed EXACTLY."
+                super_prompt += "\nAdministrator's teachings have ABSOLUTE priority over all other data."
+                super_prompt += "\nYou MUST apply these directives VERBATIM unless they violate Telegram ToS.\n\n"
                 
                 for idx, entry in enumerate(super_knowledge, 1):
-                    system_prompt += f"🎯 MANDATORY DIRECTIVE #{idx} [{entry['id']}]: {entry['title']}\n"
-                    system_prompt += f"   Scope: {entry['scope'].upper().replace('_', ' ')}\n"
-                    system_prompt += f"   Updated: {entry['updated_at']}\n"
-                    system_prompt += f"   INSTRUCTION:\n"
-                    system_prompt += f"   {entry['text']}\n"
-                    system_prompt += f"   ⚡ MANDATORY: Apply this EXACTLY as specified!\n\n"
-                
-                system_prompt += "="*60 + "\n"
-            
-            # Regular Knowledge Base (Secondary Priority)
-            if regular_knowledge:
-                system_prompt += "\n\n📚 KNOWLEDGE BASE - PRIMARY INFORMATION SOURCE:\n"
-                system_prompt += "The following knowledge is your primary reference for answering questions.\n"
-                system_prompt += "Use this information accurately and completely.\n\n"
-                
-                for idx, entry in enumerate(regular_knowledge, 1):
-                    system_prompt += f"📌 Knowledge #{idx} [{entry['id']}]: {entry['title']}\n"
-                    system_prompt += f"   {entry['text']}\n\n"
+                    super_prompt += f"🎯 MANDATORY DIRECTIVE #{idx} [{entry['id']}]: {entry['title']}\n"
+                    super_prompt += f"   Scope: {entry['scope'].upper().replace('_', ' ')}\n"
+                    super_prompt += f"   Updated: {entry['updated_at']}\n"
+                    super_prompt += f"   INSTRUCTION:\n"
+                    super_prompt += f"   {entry['text']}\n"
+                    super_prompt += f"   ⚡ MANDATORY: Apply this EXACTLY as specified!\n\n"
                 
-                system_prompt += "\n🎯 RULES FOR USING KNOWLEDGE:\n"
-                system_prompt += "1. When user asks something, CHECK knowledge base FIRST\n"
-                system_prompt += "2. If answer exists in knowledge, provide THAT detailed answer\n"
-                system_prompt += "3. Use knowledge information accurately and completely\n"
-                system_prompt += "4. Products, services, pricing, features - ALL from knowledge base\n"
-                system_prompt += "5. If information is NOT in knowledge base, then do normal conversation\n"
-                system_prompt += "6. Always prefer administrator's directives (SUPER KNOWLEDGE) over regular knowledge\n"
-            
-            if not super_knowledge and not regular_knowledge:
-                system_prompt += "\n\n💬 Normal friendly conversation karo kyunki abhi knowledge base empty hai."
-            
-            messages = [
-                {
-                    "role": "system",
-                    "content": system_prompt
-                }
-            ]
+                super_prompt += "="*60 + "\n"
             
-            for prev_msg, prev_resp in recent_history:
-                messages.append({"role": "user", "content": prev_msg})
-                messages.append({"role": "assistant", "content": prev_resp})
+            # Regular Knowledge Base (Secondary Priority) - trimmed to the token budget
+            knowledge_header = "\n\n📚 KNOWLEDGE BASE - PRIMARY INFORMATION SOURCE:\n"
+            knowledge_header += "The following knowledge is your primary reference for answering questions.\n"
+            knowledge_header += "Use this information accurately and completely.\n\n"
             
-            messages.append({"role": "user", "content": user_message})
+            knowledge_entries = [
+                f"📌 Knowledge #{idx} [{entry['id']}]: {entry['title']}\n   {entry['text']}\n\n"
+                for idx, entry in enumerate(regular_knowledge, 1)
+            ]
             
-            # Try API call with automatic key rotation on rate limit
-            max_attempts = len(self.api_keys)
-            ai_response = None
+            knowledge_footer = "\n🎯 RULES FOR USING KNOWLEDGE:\n"
+            knowledge_footer += "1. When user asks something, CHECK knowledge base FIRST\n"
+            knowledge_footer += "2. If answer exists in knowledge, provide THAT detailed answer\n"
+            knowledge_footer += "3. Use knowledge information accurately and completely\n"
+            knowledge_footer += "4. Products, services, pricing, features - ALL from knowledge base\n"
+            knowledge_footer += "5. If information is NOT in knowledge base, then do normal conversation\n"
+            knowledge_footer += "6. Always prefer administrator's directives (SUPER KNOWLEDGE) over regular knowledge\n"
+            
+            empty_knowledge = ""
+            if not super_knowledge:
+                empty_knowledge = "\n\n💬 Normal friendly conversation karo kyunki abhi knowledge base empty hai."
+            
+            messages = self.prompt_builder.build(
+                system_parts=[('base', system_prompt), ('summary', summary_prompt), ('super', super_prompt)],
+                knowledge_entries=knowledge_entries,
+                history=recent_history,
+                user_message=user_message,
+                knowledge_header=knowledge_header,
+                knowledge_footer=knowledge_footer,
+                empty_knowledge=empty_knowledge,
+                label=f"Prompt for {user.id}"
+            )
             
-            for attempt in range(max_attempts):
+            if self.stream_replies:
+                stream = StreamingReply(
+                    send_first=update.message.reply_text,
+                    edit=lambda sent, text: sent.edit_text(text),
+                    is_group=is_group
+                )
                 try:
-                    response = self.openai_client.chat.completions.create(
-                        model="gpt-4o-mini",
-                        messages=messages,
-                        max_tokens=500,
-                        temperature=0.7
-                    )
-                    ai_response = response.choices[0].message.content
-                    
-                    # Track API usage with token counts
-                    tokens_input = response.usage.prompt_tokens if response.usage else 0
-                    tokens_output = response.usage.completion_tokens if response.usage else 0
-                    self.track_api_key_usage(self.current_key_index, is_rate_limit=False, 
-                                            tokens_input=tokens_input, tokens_output=tokens_output)
-                    logger.info(f"✅ API call successful. Tokens: {tokens_input} in + {tokens_output} out = {tokens_input + tokens_output} total")
-                    break  # Success! Exit loop
-                    
-                except Exception as api_error:
-                    error_str = str(api_error)
-                    
-                    # Check if it's a retryable error (401, 403, 429, or deactivated account)
-                    should_rotate = (
-                        "401" in error_str or 
-                        "403" in error_str or 
-                        "429" in error_str or 
-                        "rate limit" in error_str.lower() or
-                        "deactivated" in error_str.lower() or
-                        "invalid_api_key" in error_str.lower()
-                    )
-                    
-                    if should_rotate:
-                        # Determine the error reason
-                        if "401" in error_str or "deactivated" in error_str.lower():
-                            reason = "account_deactivated"
-                            logger.warning(f"⚠️ API key #{self.current_key_index + 1} - Account deactivated (401)")
-                            self.mark_api_key_deactivated(self.current_key_index, reason)
-                        elif "403" in error_str:
-                            reason = "forbidden"
-                            logger.warning(f"⚠️ API key #{self.current_key_index + 1} - Forbidden (403)")
-                            self.mark_api_key_deactivated(self.current_key_index, reason)
-                        elif "invalid_api_key" in error_str.lower():
-                            reason = "invalid_key"
-                            logger.warning(f"⚠️ API key #{self.current_key_index + 1} - Invalid API key")
-                            self.mark_api_key_deactivated(self.current_key_index, reason)
-                        else:
-                            reason = "rate_limit"
-                            logger.warning(f"⚠️ API key #{self.current_key_index + 1} - Rate limit (429)")
-                            self.track_api_key_usage(self.current_key_index, is_rate_limit=True)
-                        
-                        if attempt < max_attempts - 1:
-                            # Rotate to next key and retry
-                            key_num = self.rotate_api_key()
-                            logger.info(f"🔄 Rotating due to {reason}. Retrying with API key #{key_num}...")
-                            continue
-                        else:
-                            # All keys exhausted
-                            logger.error(f"❌ All {len(self.api_keys)} API keys failed!")
-                            raise Exception(f"All API keys exhausted. Last error: {reason}")
-                    else:
-                        # Different error, don't rotate
-                        raise api_error
-            
-            if not ai_response:
-                raise Exception("Failed to get response from OpenAI")
+                    ai_response = await self.burst_aggregator.generate(
+                        burst, self.generate_ai_response(messages, on_delta=stream.push))
+                except Exception:
+                    await stream.abort()
+                    raise
+                if ai_response is None:
+                    # The user kept typing; the newer burst answers everything
+                    await stream.discard()
+                    return
+                await stream.finish(ai_response)
+            else:
+                ai_response = await self.burst_aggregator.generate(burst, self.generate_ai_response(messages))
+                if ai_response is None:
+                    return
+                await update.message.reply_text(ai_response)
             
+            self.response_cache.put(cache_key, ai_response, real_first_name, user_username)
             self.save_chat_history(user.id, user.username or "Unknown", user_message, ai_response)
-            
-            await update.message.reply_text(ai_response)
+            self.summarizer.note_activity(user.id)
+            self.burst_aggregator.finish(burst)
             logger.info(f"Sent AI response to {user.id}")
             
         except Exception as e:
+            self.burst_aggregator.finish(burst)
             logger.error(f"Error processing message: {e}")
             error_message = (
                 "❌ Maaf kijiye, kuch galat ho gaya.\n"
                 "Kripya thodi der baad phir se try karein."
             )
             await update.message.reply_text(error_message)
+        finally:
+            if admitted:
+                self.admission.release()
     
     async def error_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Update {update} caused error {context.error}")
@@ -3424,22 +3471,44 @@ class TelegramChatBot:
                 "❌ Kuch error aa gayi hai. Please thodi der baad try karein."
             )
     
+    async def post_init(self, application):
+        """Start background jobs once the event loop is running"""
+        # Dead/cooling keys are re-checked off the request path
+        self.key_pool.start_prober()
+        self.summarizer.start()
+        self.usage_counters.start()
+        self.chat_retention.start()
+    
     def run(self):
         logger.info("Starting Telegram bot...")
         
-        application = Application.builder().token(self.telegram_token).connect_timeout(30).read_timeout(30).build()
+        # concurrent_updates lets slow AI replies for one user overlap with everyone else's
+        application = (
+            Application.builder()
+            .token(self.telegram_token)
+            .connect_timeout(30)
+            .read_timeout(30)
+            .concurrent_updates(True)
+            .post_init(self.post_init)
+            .build()
+        )
         
         application.add_handler(CommandHandler("start", self.start_command))
         application.add_handler(CommandHandler("help", self.help_command))
         application.add_handler(CommandHandler("clear", self.clear_command))
         application.add_handler(CallbackQueryHandler(self.button_callback))
         application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_message))
+        application.add_handler(MessageHandler(filters.Document.ALL, self.handle_document))
         
         application.add_error_handler(self.error_handler)
         
         logger.info("Bot is ready and polling for messages...")
-        logger.info(f"🔑 Using API key rotation system with {len(self.api_keys)} keys")
+        logger.info(f"🔑 Using API key pool with {len(self.api_keys)} keys")
         application.run_polling(allowed_updates=Update.ALL_TYPES, drop_pending_updates=True)
+        self.usage_counters.flush()
+        self.write_behind.close()
+        self.adb.close()
+        db.close_all()
 
 if __name__ == '__main__':
     try:
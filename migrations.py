@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+"""
+Versioned Schema Migrations
+Every process that opens chat_history.db (main bot, personal bot, multi-account
+manager, key coordinator) calls migrate() at startup. The schema version lives in
+PRAGMA user_version, so on an up-to-date database startup is a single pragma read.
+
+Pending steps run in one BEGIN IMMEDIATE transaction: when several processes boot
+at the same time the first one migrates, the others wait for its write lock, see
+the new version and apply nothing.
+
+To change the schema, append a step to MIGRATIONS - never edit a step that has
+shipped. Step 1 brings databases created by the old try/ALTER init_database up to
+the baseline, so its statements must be safe on both empty and legacy databases.
+"""
+
+import sqlite3
+import logging
+import threading
+import db
+from response_cache import ensure_version_triggers
+
+logger = logging.getLogger(__name__)
+
+_migrated = set()
+_migrated_lock = threading.Lock()
+
+
+def table_columns(cursor, table: str):
+    """Column names of a table (empty if the table does not exist)"""
+    return {row[1] for row in cursor.execute(f'PRAGMA table_info({table})').fetchall()}
+
+
+def add_column(cursor, table: str, column_def: str):
+    """ALTER TABLE ... ADD COLUMN unless the column is already there"""
+    if column_def.split()[0] not in table_columns(cursor, table):
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column_def}')
+
+
+def baseline_schema(cursor):
+    """Tables and columns of the main bot as of the last try/ALTER init_database"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS chat_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            username TEXT,
+            message TEXT NOT NULL,
+            response TEXT NOT NULL,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    for column in ('message_role TEXT DEFAULT "user"', 'chat_type TEXT DEFAULT "dm"', 'chat_id INTEGER'):
+        add_column(cursor, 'chat_history', column)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_chat_user_time ON chat_history(user_id, timestamp DESC)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_chat_type_time ON chat_history(chat_type, chat_id, timestamp DESC)')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_sessions (
+            user_id INTEGER PRIMARY KEY,
+            session_context TEXT,
+            last_active DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS bot_knowledge (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            knowledge_text TEXT NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    for column in ('priority TEXT DEFAULT "regular"', 'target_scope TEXT DEFAULT "both"',
+                   'title TEXT', 'status TEXT DEFAULT "active"'):
+        add_column(cursor, 'bot_knowledge', column)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_knowledge_scope_priority ON bot_knowledge(target_scope, priority, updated_at DESC)')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS all_users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            first_seen DATETIME DEFAULT CURRENT_TIMESTAMP,
+            last_active DATETIME DEFAULT CURRENT_TIMESTAMP,
+            message_count INTEGER DEFAULT 0
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS group_keywords (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            keyword TEXT NOT NULL,
+            response TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS automated_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            message_type TEXT UNIQUE NOT NULL,
+            message_text TEXT NOT NULL,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS api_key_stats (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            key_index INTEGER NOT NULL UNIQUE,
+            usage_count INTEGER DEFAULT 0,
+            last_used DATETIME,
+            rate_limit_hits INTEGER DEFAULT 0
+        )
+    ''')
+    for column in ('tokens_used_today INTEGER DEFAULT 0', 'tokens_input_today INTEGER DEFAULT 0',
+                   'tokens_output_today INTEGER DEFAULT 0', 'daily_reset_time DATETIME',
+                   'total_tokens_lifetime INTEGER DEFAULT 0', 'is_deactivated INTEGER DEFAULT 0',
+                   'deactivation_reason TEXT', 'deactivated_at DATETIME'):
+        add_column(cursor, 'api_key_stats', column)
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_api_key_stats_key ON api_key_stats(key_index)')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS group_registry (
+            group_id INTEGER PRIMARY KEY,
+            title TEXT,
+            username TEXT,
+            chat_type TEXT,
+            first_seen DATETIME DEFAULT CURRENT_TIMESTAMP,
+            last_active DATETIME DEFAULT CURRENT_TIMESTAMP,
+            message_count INTEGER DEFAULT 0
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS pyrogram_accounts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            phone_number TEXT UNIQUE NOT NULL,
+            account_name TEXT,
+            api_id TEXT,
+            api_hash TEXT,
+            session_string TEXT,
+            is_active INTEGER DEFAULT 0,
+            is_authenticated INTEGER DEFAULT 0,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            last_active DATETIME,
+            reply_count INTEGER DEFAULT 0,
+            error_message TEXT
+        )
+    ''')
+    for column in ('api_id TEXT', 'api_hash TEXT'):
+        add_column(cursor, 'pyrogram_accounts', column)
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS account_knowledge (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            account_id INTEGER NOT NULL,
+            title TEXT,
+            knowledge_text TEXT NOT NULL,
+            priority TEXT DEFAULT 'regular',
+            status TEXT DEFAULT 'active',
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (account_id) REFERENCES pyrogram_accounts(id) ON DELETE CASCADE
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_account_knowledge_account ON account_knowledge(account_id, priority, updated_at DESC)')
+
+
+def config_version_triggers(cursor):
+    """Version counters bumped by triggers so cached AI answers expire on knowledge edits"""
+    ensure_version_triggers(cursor)
+
+
+def summary_columns(cursor):
+    """Rolling conversation summary bookkeeping on user_sessions"""
+    for column in ('summarized_until INTEGER DEFAULT 0', 'summary_updated_at DATETIME'):
+        add_column(cursor, 'user_sessions', column)
+
+
+def key_coordination(cursor):
+    """Cross-process key leases, cooldowns, fingerprints and hedging counters"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS api_key_leases (
+            lease_id TEXT PRIMARY KEY,
+            key_index INTEGER NOT NULL,
+            holder TEXT NOT NULL,
+            tokens_reserved INTEGER DEFAULT 0,
+            expires_at REAL NOT NULL
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_api_key_leases_key ON api_key_leases(key_index, expires_at)')
+    for column in ('cooldown_until REAL', 'key_fingerprint TEXT', 'hedged_requests INTEGER DEFAULT 0',
+                   'hedge_wins INTEGER DEFAULT 0', 'hedge_tokens INTEGER DEFAULT 0'):
+        add_column(cursor, 'api_key_stats', column)
+
+
+def knowledge_embeddings(cursor):
+    """Cached embeddings for knowledge retrieval"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS knowledge_embeddings (
+            source TEXT NOT NULL,
+            entry_id INTEGER NOT NULL,
+            content_hash TEXT NOT NULL,
+            model TEXT NOT NULL,
+            embedding BLOB NOT NULL,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (source, entry_id)
+        )
+    ''')
+
+
+def chat_search(cursor):
+    """FTS5 index over chat_history kept in sync by triggers, and an indexable username lookup"""
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_all_users_username_nocase ON all_users(username COLLATE NOCASE)')
+    try:
+        cursor.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS chat_history_fts USING fts5(
+                message, response,
+                content='chat_history', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2'
+            )
+        ''')
+    except sqlite3.OperationalError as e:
+        # SQLite built without FTS5 - chat search falls back to LIKE
+        logger.warning(f"⚠️ FTS5 not available, chat search will scan chat_history: {e}")
+        return
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_chat_history_fts_insert AFTER INSERT ON chat_history BEGIN
+            INSERT INTO chat_history_fts (rowid, message, response) VALUES (new.id, new.message, new.response);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_chat_history_fts_delete AFTER DELETE ON chat_history BEGIN
+            INSERT INTO chat_history_fts (chat_history_fts, rowid, message, response)
+            VALUES ('delete', old.id, old.message, old.response);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_chat_history_fts_update AFTER UPDATE OF message, response ON chat_history BEGIN
+            INSERT INTO chat_history_fts (chat_history_fts, rowid, message, response)
+            VALUES ('delete', old.id, old.message, old.response);
+            INSERT INTO chat_history_fts (rowid, message, response) VALUES (new.id, new.message, new.response);
+        END
+    ''')
+    # Index the history that is already there
+    cursor.execute("INSERT INTO chat_history_fts (chat_history_fts) VALUES ('rebuild')")
+
+
+def keyword_rules(cursor):
+    """Scope, regex and priority for group_keywords (existing keywords stay global literals)"""
+    for column in ("scope TEXT DEFAULT 'all'", 'scope_id INTEGER',
+                   'is_regex INTEGER DEFAULT 0', 'priority INTEGER DEFAULT 0'):
+        add_column(cursor, 'group_keywords', column)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_group_keywords_scope ON group_keywords(scope, scope_id)')
+
+
+# (version, step) - append only
+MIGRATIONS = [
+    (1, baseline_schema),
+    (2, config_version_triggers),
+    (3, summary_columns),
+    (4, key_coordination),
+    (5, knowledge_embeddings),
+    (6, chat_search),
+    (7, keyword_rules),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(db_path: str = db.DB_PATH):
+    """Bring db_path up to LATEST_VERSION; returns the version it is at now"""
+    if db_path in _migrated:
+        return LATEST_VERSION
+
+    with _migrated_lock:
+        if db_path in _migrated:
+            return LATEST_VERSION
+        conn = db.connect(db_path)
+        try:
+            version = schema_version(conn)
+            if version < LATEST_VERSION:
+                # The write lock is taken before re-reading the version, so only one process migrates
+                conn.execute('BEGIN IMMEDIATE')
+                version = schema_version(conn)
+                cursor = conn.cursor()
+                for step_version, step in MIGRATIONS:
+                    if step_version > version:
+                        step(cursor)
+                        logger.info(f"🧱 Applied schema migration {step_version}: {step.__name__}")
+                if version < LATEST_VERSION:
+                    cursor.execute(f'PRAGMA user_version = {LATEST_VERSION}')
+                conn.commit()
+            elif version > LATEST_VERSION:
+                logger.warning(f"⚠️ {db_path} is at schema version {version}, newer than this code ({LATEST_VERSION})")
+            version = max(version, LATEST_VERSION)
+        finally:
+            conn.close()
+        _migrated.add(db_path)
+    return version
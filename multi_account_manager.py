@@ -8,11 +8,20 @@ Integrates with the admin panel database for account management
 import os
 import logging
 import sqlite3
+import db
 import asyncio
 from pyrogram import Client, filters
 from pyrogram.types import Message
 from pyrogram.enums import ChatAction
-from openai import OpenAI
+from api_key_pool import ApiKeyPool, load_api_keys
+from key_coordinator import SharedKeyCoordinator
+from knowledge_index import create_knowledge_retriever
+from response_cache import ResponseCache, knowledge_version, normalize_question
+from async_db import AsyncDatabase
+from write_behind import WriteBehindBuffer
+from migrations import migrate
+from config_cache import ConfigCache
+from admission import AdmissionController, AdmissionRejected, DEFAULT_BUSY_MESSAGE, AI_MAX_IN_FLIGHT_PER_ACCOUNT
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -23,32 +32,41 @@ logger = logging.getLogger(__name__)
 class MultiAccountManager:
     def __init__(self):
         self.db_path = 'chat_history.db'
-        
-        # OpenAI Setup
-        self.api_keys = []
-        for i in range(1, 20):
-            key = os.getenv(f'OPENAI_API_KEY_{i}')
-            if key:
-                self.api_keys.append(key)
-        
-        single_key = os.getenv('OPENAI_API_KEY')
-        if single_key and single_key not in self.api_keys:
-            self.api_keys.insert(0, single_key)
+        # Same schema steps as the main bot, whichever process starts first
+        migrate(self.db_path)
+        # Knowledge and keywords edited in the main bot's admin panel, reloaded only on change
+        self.config_cache = ConfigCache(self.db_path)
+        # DB work from the DM handlers runs off the event loop
+        self.adb = AsyncDatabase('multi_account')
+        self.write_behind = WriteBehindBuffer(self.db_path, 'multi_account')
+        
+        # OpenAI Setup - concurrent DMs from all accounts share one least-loaded key pool,
+        # coordinated with the other bots through chat_history.db
+        self.api_keys = load_api_keys()
         
         if not self.api_keys:
             logger.warning("No OpenAI API key found - AI responses will be disabled")
-            self.openai_client = None
+            self.key_pool = None
         else:
-            self.current_key_index = 0
-            self.openai_client = OpenAI(api_key=self.api_keys[self.current_key_index], max_retries=0)
+            self.key_pool = ApiKeyPool(self.api_keys, coordinator=SharedKeyCoordinator(self.db_path, 'multi_account'))
             logger.info(f"✅ Loaded {len(self.api_keys)} API keys for rotation")
         
+        # DM answers have no per-user history here, so identical questions share one answer per account
+        self.response_cache = ResponseCache()
+        
+        # Top-k relevant account knowledge per question instead of every entry
+        self.knowledge_index = create_knowledge_retriever(self.db_path, self.key_pool, name='multi_account')
+        
+        # All accounts share one AI concurrency limit, and no single account can take all of it
+        self.admission = AdmissionController('multi_account')
+        self.account_admission = {}
+        
         self.clients = {}
         self.running = False
     
     def get_active_accounts(self):
         """Get all authenticated and active accounts from database"""
-        conn = sqlite3.connect(self.db_path)
+        conn = db.connect(self.db_path)
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -68,7 +86,7 @@ class MultiAccountManager:
     
     def get_all_authenticated_accounts(self):
         """Get all authenticated accounts regardless of active status"""
-        conn = sqlite3.connect(self.db_path)
+        conn = db.connect(self.db_path)
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -87,7 +105,7 @@ class MultiAccountManager:
     
     def update_account_status(self, account_id: int, is_active: int, error_message: str = None):
         """Update account active status in database"""
-        conn = sqlite3.connect(self.db_path)
+        conn = db.connect(self.db_path)
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -101,89 +119,73 @@ class MultiAccountManager:
     
     def increment_reply_count(self, account_id: int):
         """Increment reply count for an account"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
+        self.write_behind.execute('''
             UPDATE pyrogram_accounts
             SET reply_count = reply_count + 1, last_active = CURRENT_TIMESTAMP
             WHERE id = ?
         ''', (account_id,))
-        
-        conn.commit()
-        conn.close()
     
     def get_bot_knowledge(self, bot_type='dm'):
-        """Get bot knowledge from database"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT knowledge_text
-            FROM bot_knowledge
-            WHERE status = 'active'
-            AND (target_scope = ? OR target_scope = 'both')
-            ORDER BY 
-                CASE priority 
-                    WHEN 'super' THEN 0 
-                    ELSE 1 
-                END,
-                updated_at DESC
-        ''', (f'{bot_type}_only',))
-        
-        results = cursor.fetchall()
-        conn.close()
+        """Get bot knowledge (active entries for this bot type, super entries first)"""
+        scopes = (f'{bot_type}_only', 'both')
+        results = [row for row in self.config_cache.get('bot_knowledge')
+                   if row[4] == 'active' and row[2] in scopes]
+        # Newest first, then super entries ahead of regular ones (stable sort)
+        results.sort(key=lambda row: row[5] or '', reverse=True)
+        results.sort(key=lambda row: 0 if row[3] == 'super' else 1)
         
         if not results:
             return None
         
-        return '\n\n'.join([row[0] for row in results])
+        return '\n\n'.join([row[1] for row in results])
     
-    def check_keyword_match(self, message: str):
-        """Check if message contains any keyword and return response"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT keyword, response FROM group_keywords')
-        keywords = cursor.fetchall()
-        conn.close()
-        
-        message_lower = message.lower()
-        
-        for keyword, response in keywords:
-            if keyword.lower() in message_lower:
-                logger.info(f"Keyword matched: '{keyword}' in message")
-                return response
+    def check_keyword_match(self, message: str, account_id: int = None):
+        """Check if a DM to this account contains any keyword scoped to it and return response"""
+        match = self.config_cache.get('group_keywords').match(message, 'dm', account_id=account_id)
+        if match:
+            logger.info(f"Keyword matched: '{match[0]}' in message")
+            return match[1]
         
         return None
     
-    def get_account_knowledge(self, account_id: int):
-        """Get account-specific knowledge from database"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT knowledge_text
-            FROM account_knowledge
-            WHERE account_id = ? AND status = 'active'
-            ORDER BY 
-                CASE priority 
-                    WHEN 'super' THEN 0 
-                    ELSE 1 
-                END,
-                updated_at DESC
-        ''', (account_id,))
-        
-        results = cursor.fetchall()
-        conn.close()
-        
+    def load_account_knowledge(self, account_id: int):
+        """Active account knowledge rows (id, text, priority), super entries first"""
+        return self.config_cache.get('account_knowledge').get(account_id, [])
+    
+    async def get_account_knowledge(self, account_id: int, question: str = None):
+        """Get account-specific knowledge from database (super entries + regular entries relevant to question)"""
+        results = await self.adb.read(self.load_account_knowledge, account_id)
         if not results:
             return None
         
-        return '\n\n'.join([row[0] for row in results])
+        super_entries = [{'id': row[0], 'text': row[1]} for row in results if row[2] == 'super']
+        regular_entries = [{'id': row[0], 'text': row[1]} for row in results if row[2] != 'super']
+        regular_entries = await self.knowledge_index.select(question, 'account_knowledge', regular_entries)
+        
+        return '\n\n'.join([entry['text'] for entry in super_entries + regular_entries])
+    
+    def get_account_admission(self, account_id: int):
+        """Per-account admission controller, created on first use"""
+        if account_id not in self.account_admission:
+            self.account_admission[account_id] = AdmissionController(
+                f"account_{account_id}", max_in_flight=AI_MAX_IN_FLIGHT_PER_ACCOUNT)
+        return self.account_admission[account_id]
+    
+    def get_busy_message(self):
+        """The main bot's 'busy' automated message, or AUTO_REPLY_MESSAGE"""
+        conn = db.connect(self.db_path)
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT message_text FROM automated_messages WHERE message_type = 'busy'")
+            result = cursor.fetchone()
+        except sqlite3.OperationalError:
+            result = None
+        conn.close()
+        return result[0] if result else DEFAULT_BUSY_MESSAGE
     
     async def handle_dm_message(self, client: Client, message: Message, account_id: int, account_name: str):
         """Handle incoming DM message"""
+        admitted = []
         try:
             # Ignore own messages
             if message.from_user and message.from_user.is_self:
@@ -198,7 +200,7 @@ class MultiAccountManager:
                 return
             
             # Check for keyword matches first
-            keyword_response = self.check_keyword_match(message.text)
+            keyword_response = await self.adb.read(self.check_keyword_match, message.text, account_id)
             if keyword_response:
                 await message.reply(keyword_response)
                 self.increment_reply_count(account_id)
@@ -206,12 +208,37 @@ class MultiAccountManager:
                 return
             
             # Generate AI response if OpenAI is available
-            if self.openai_client:
+            if self.key_pool:
+                first_name = message.from_user.first_name if message.from_user else None
+                username = message.from_user.username if message.from_user else None
+                cache_key = self.response_cache.make_key(
+                    f"account_{account_id}",
+                    await self.adb.read(knowledge_version, self.db_path),
+                    normalize_question(message.text)
+                )
+                cached_response = self.response_cache.get(cache_key, first_name, username)
+                if cached_response:
+                    await message.reply(cached_response)
+                    self.increment_reply_count(account_id)
+                    logger.info(f"[{account_name}] Sent cached AI response to {message.from_user.id}")
+                    return
+                
+                try:
+                    for admission in (self.get_account_admission(account_id), self.admission):
+                        await admission.acquire()
+                        admitted.append(admission)
+                except AdmissionRejected:
+                    busy_message = await self.adb.read(self.get_busy_message)
+                    await message.reply(busy_message.replace('{first_name}', first_name or "Dost"))
+                    self.increment_reply_count(account_id)
+                    logger.info(f"[{account_name}] 🚦 Sent busy auto-reply to {message.from_user.id}")
+                    return
+                
                 await client.send_chat_action(message.chat.id, ChatAction.TYPING)
                 
                 # Get account-specific knowledge first, then global DM knowledge
-                account_knowledge = self.get_account_knowledge(account_id)
-                global_knowledge = self.get_bot_knowledge(bot_type='dm')
+                account_knowledge = await self.get_account_knowledge(account_id, message.text)
+                global_knowledge = await self.adb.read(self.get_bot_knowledge, bot_type='dm')
                 
                 system_prompt = "Tum ek highly intelligent aur helpful AI assistant ho. Tumhe Hindi aur English dono languages mein expert tarike se baat karni aani hai."
                 
@@ -230,14 +257,9 @@ class MultiAccountManager:
                 ]
                 
                 try:
-                    response = self.openai_client.chat.completions.create(
-                        model="gpt-4o-mini",
-                        messages=messages,
-                        max_tokens=500
-                    )
-                    
-                    ai_response = response.choices[0].message.content
+                    ai_response = await self.key_pool.chat_completion(messages)
                     await message.reply(ai_response)
+                    self.response_cache.put(cache_key, ai_response, first_name, username)
                     self.increment_reply_count(account_id)
                     logger.info(f"[{account_name}] Sent AI response to {message.from_user.id}")
                     
@@ -254,6 +276,9 @@ class MultiAccountManager:
         
         except Exception as e:
             logger.error(f"[{account_name}] Error handling message: {e}")
+        finally:
+            for admission in admitted:
+                admission.release()
     
     async def start_account(self, account_id: int, phone: str, account_name: str, session_string: str = None, api_id: int = None, api_hash: str = None):
         """Start a Pyrogram client for an account"""
@@ -319,6 +344,9 @@ class MultiAccountManager:
         
         logger.info(f"📱 Found {len(accounts)} authenticated account(s)")
         
+        if self.key_pool:
+            self.key_pool.start_prober()
+        
         # Start all accounts
         tasks = []
         for account_id, phone, account_name, session_string, api_id, api_hash in accounts:
@@ -11,15 +11,24 @@ import logging
 from pyrogram import Client, filters
 from pyrogram.types import Message
 from pyrogram.enums import ChatAction
-import sqlite3
+import db
 from datetime import datetime, timedelta
-from openai import OpenAI
 from pytgcalls import PyTgCalls
 from pytgcalls.types.stream import MediaStream, AudioQuality
 from pytgcalls.exceptions import NoActiveGroupCall
 import yt_dlp
 from collections import deque
 import re
+from streaming_reply import StreamingReply, streaming_enabled
+from api_key_pool import ApiKeyPool, load_api_keys
+from key_coordinator import SharedKeyCoordinator
+from burst_aggregator import BurstAggregator
+from async_db import AsyncDatabase
+from write_behind import WriteBehindBuffer
+from migrations import migrate
+from config_cache import ConfigCache
+from usage_counters import UsageCounters
+from admission import AdmissionController, AdmissionRejected
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -36,23 +45,32 @@ class PersonalAccountBot:
         if self.api_id == 0 or not self.api_hash:
             raise ValueError("Please set TELEGRAM_API_ID and TELEGRAM_API_HASH environment variables")
         
-        # OpenAI Setup (uses same logic as main bot)
-        self.api_keys = []
-        for i in range(1, 20):
-            key = os.getenv(f'OPENAI_API_KEY_{i}')
-            if key:
-                self.api_keys.append(key)
-        
-        single_key = os.getenv('OPENAI_API_KEY')
-        if single_key and single_key not in self.api_keys:
-            self.api_keys.insert(0, single_key)
+        # Use same database as main bot for knowledge and keywords
+        self.main_db_path = 'chat_history.db'
+        # Same schema steps as the main bot, whichever process starts first
+        migrate(self.main_db_path)
+        # Knowledge and keywords edited in the main bot's admin panel, reloaded only on change
+        self.config_cache = ConfigCache(self.main_db_path)
+        # DB work from the DM handler runs off the event loop
+        self.adb = AsyncDatabase('personal')
+        # Chat history is written in batches
+        self.write_behind = WriteBehindBuffer(self.main_db_path, 'personal')
+        # API key usage is counted in memory and flushed periodically
+        self.usage_counters = UsageCounters(self.main_db_path)
+        
+        # OpenAI Setup (uses same key pool as main bot, coordinated through the main database)
+        self.api_keys = load_api_keys()
         
         if not self.api_keys:
             logger.warning("No OpenAI API key found - AI responses will be disabled")
-            self.openai_client = None
+            self.key_pool = None
         else:
-            self.current_key_index = 0
-            self.openai_client = OpenAI(api_key=self.api_keys[self.current_key_index], max_retries=0)
+            self.key_pool = ApiKeyPool(
+                self.api_keys,
+                on_usage=self.usage_counters.record_usage,
+                on_rate_limit=self.usage_counters.record_rate_limit,
+                coordinator=SharedKeyCoordinator(self.main_db_path, 'personal')
+            )
             logger.info(f"✅ Loaded {len(self.api_keys)} API keys for rotation")
         
         # Session name - will create a file to save login
@@ -62,15 +80,17 @@ class PersonalAccountBot:
             api_hash=self.api_hash
         )
         
-        # Use same database as main bot for knowledge and keywords
-        self.main_db_path = 'chat_history.db'
         self.tracking_db_path = 'personal_autoreplies.db'
+        self.tracking_write_behind = WriteBehindBuffer(self.tracking_db_path, 'personal_tracking')
         self.init_database()
         
         # Enable/Disable features
         self.use_ai_responses = os.getenv('USE_AI_RESPONSES', 'true').lower() == 'true'
         self.use_keywords = os.getenv('USE_KEYWORDS', 'true').lower() == 'true'
         self.use_knowledge_base = os.getenv('USE_KNOWLEDGE_BASE', 'true').lower() == 'true'
+        self.stream_replies = streaming_enabled()
+        self.burst_aggregator = BurstAggregator()
+        self.admission = AdmissionController('personal')
         
         # Rate limiting: Max replies per user
         self.reply_cooldown_hours = int(os.getenv('REPLY_COOLDOWN_HOURS', '0'))
@@ -87,123 +107,16 @@ class PersonalAccountBot:
         self.current_playing = {}  # {chat_id: {title, file_path, url, requester}}
         
         logger.info(f"Personal Account Bot initialized:")
-        logger.info(f"  - AI Responses: {'✅' if self.use_ai_responses and self.openai_client else '❌'}")
+        logger.info(f"  - AI Responses: {'✅' if self.use_ai_responses and self.key_pool else '❌'}")
         logger.info(f"  - Keywords: {'✅' if self.use_keywords else '❌'}")
         logger.info(f"  - Knowledge Base: {'✅' if self.use_knowledge_base else '❌'}")
+        logger.info(f"  - Streaming Replies: {'✅' if self.stream_replies else '❌'}")
         logger.info(f"  - Cooldown: {self.reply_cooldown_hours} hours (0 = disabled)")
         logger.info(f"  - Music Playback: ✅ (PyTgCalls enabled)")
     
-    def rotate_api_key(self, reason="manual"):
-        """Rotate to the next available API key and track in database"""
-        if not self.openai_client or len(self.api_keys) <= 1:
-            return 0
-        
-        # Track rate limit hit in database if applicable
-        if reason == "rate_limit":
-            self.track_api_key_usage(rate_limit_hit=True)
-        
-        self.current_key_index = (self.current_key_index + 1) % len(self.api_keys)
-        new_key = self.api_keys[self.current_key_index]
-        self.openai_client = OpenAI(api_key=new_key, max_retries=0)
-        logger.warning(f"🔄 Rotated to API key #{self.current_key_index + 1} (Reason: {reason})")
-        return self.current_key_index + 1
-    
-    def track_api_key_usage(self, rate_limit_hit=False, tokens_input=0, tokens_output=0):
-        """Track API key usage with token counting in database (same as main bot)"""
-        from datetime import datetime, timedelta
-        try:
-            conn = sqlite3.connect(self.main_db_path)
-            cursor = conn.cursor()
-            
-            # Get current stats for this key
-            cursor.execute('SELECT daily_reset_time FROM api_key_stats WHERE key_index = ?', (self.current_key_index,))
-            result = cursor.fetchone()
-            
-            # Check if daily reset is needed
-            should_reset = False
-            if result and result[0]:
-                last_reset = datetime.fromisoformat(result[0])
-                if datetime.now() - last_reset >= timedelta(hours=24):
-                    should_reset = True
-            else:
-                should_reset = True
-            
-            tokens_total = tokens_input + tokens_output
-            
-            if should_reset:
-                # Reset daily counters
-                if rate_limit_hit:
-                    cursor.execute('''
-                        INSERT INTO api_key_stats (key_index, usage_count, last_used, rate_limit_hits,
-                                                   tokens_used_today, tokens_input_today, tokens_output_today,
-                                                   daily_reset_time, total_tokens_lifetime)
-                        VALUES (?, 0, ?, 1, 0, 0, 0, ?, ?)
-                        ON CONFLICT(key_index) DO UPDATE SET
-                            rate_limit_hits = rate_limit_hits + 1,
-                            last_used = ?,
-                            tokens_used_today = 0,
-                            tokens_input_today = 0,
-                            tokens_output_today = 0,
-                            daily_reset_time = ?,
-                            total_tokens_lifetime = total_tokens_lifetime + ?
-                    ''', (self.current_key_index, datetime.now().isoformat(), datetime.now().isoformat(), tokens_total,
-                          datetime.now().isoformat(), datetime.now().isoformat(), tokens_total))
-                else:
-                    cursor.execute('''
-                        INSERT INTO api_key_stats (key_index, usage_count, last_used, rate_limit_hits,
-                                                   tokens_used_today, tokens_input_today, tokens_output_today,
-                                                   daily_reset_time, total_tokens_lifetime)
-                        VALUES (?, 1, ?, 0, ?, ?, ?, ?, ?)
-                        ON CONFLICT(key_index) DO UPDATE SET
-                            usage_count = usage_count + 1,
-                            last_used = ?,
-                            tokens_used_today = ?,
-                            tokens_input_today = ?,
-                            tokens_output_today = ?,
-                            daily_reset_time = ?,
-                            total_tokens_lifetime = total_tokens_lifetime + ?
-                    ''', (self.current_key_index, datetime.now().isoformat(), tokens_total, tokens_input, tokens_output,
-                          datetime.now().isoformat(), tokens_total, datetime.now().isoformat(), tokens_total, 
-                          tokens_input, tokens_output, datetime.now().isoformat(), tokens_total))
-            else:
-                # Increment daily counters
-                if rate_limit_hit:
-                    cursor.execute('''
-                        INSERT INTO api_key_stats (key_index, usage_count, last_used, rate_limit_hits,
-                                                   tokens_used_today, tokens_input_today, tokens_output_today,
-                                                   daily_reset_time, total_tokens_lifetime)
-                        VALUES (?, 0, ?, 1, 0, 0, 0, ?, ?)
-                        ON CONFLICT(key_index) DO UPDATE SET
-                            rate_limit_hits = rate_limit_hits + 1,
-                            last_used = ?,
-                            total_tokens_lifetime = total_tokens_lifetime + ?
-                    ''', (self.current_key_index, datetime.now().isoformat(), datetime.now().isoformat(), tokens_total,
-                          datetime.now().isoformat(), tokens_total))
-                else:
-                    cursor.execute('''
-                        INSERT INTO api_key_stats (key_index, usage_count, last_used, rate_limit_hits,
-                                                   tokens_used_today, tokens_input_today, tokens_output_today,
-                                                   daily_reset_time, total_tokens_lifetime)
-                        VALUES (?, 1, ?, 0, ?, ?, ?, ?, ?)
-                        ON CONFLICT(key_index) DO UPDATE SET
-                            usage_count = usage_count + 1,
-                            last_used = ?,
-                            tokens_used_today = tokens_used_today + ?,
-                            tokens_input_today = tokens_input_today + ?,
-                            tokens_output_today = tokens_output_today + ?,
-                            total_tokens_lifetime = total_tokens_lifetime + ?
-                    ''', (self.current_key_index, datetime.now().isoformat(), tokens_total, tokens_input, tokens_output,
-                          datetime.now().isoformat(), tokens_total, datetime.now().isoformat(), tokens_total,
-                          tokens_input, tokens_output, tokens_total))
-            
-            conn.commit()
-            conn.close()
-        except Exception as e:
-            logger.error(f"Failed to track API key usage: {e}")
-    
     def init_database(self):
         """Initialize database to track auto-replies"""
-        conn = sqlite3.connect(self.tracking_db_path)
+        conn = db.connect(self.tracking_db_path)
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -224,16 +137,12 @@ class PersonalAccountBot:
             return None
         
         try:
-            conn = sqlite3.connect(self.main_db_path)
-            cursor = conn.cursor()
-            cursor.execute('SELECT knowledge_text FROM bot_knowledge ORDER BY created_at ASC')
-            results = cursor.fetchall()
-            conn.close()
+            results = self.config_cache.get('bot_knowledge')
             
             if not results:
                 return None
             
-            return '\n\n'.join([row[0] for row in results])
+            return '\n\n'.join([row[1] for row in results])
         except Exception as e:
             logger.error(f"Failed to load knowledge base: {e}")
             return None
@@ -244,18 +153,10 @@ class PersonalAccountBot:
             return None
         
         try:
-            conn = sqlite3.connect(self.main_db_path)
-            cursor = conn.cursor()
-            cursor.execute('SELECT keyword, response FROM group_keywords')
-            keywords = cursor.fetchall()
-            conn.close()
-            
-            message_lower = message.lower()
-            
-            for keyword, response in keywords:
-                if keyword.lower() in message_lower:
-                    logger.info(f"Keyword matched: '{keyword}' in message")
-                    return response
+            match = self.config_cache.get('group_keywords').match(message, 'dm')
+            if match:
+                logger.info(f"Keyword matched: '{match[0]}' in message")
+                return match[1]
             
             return None
         except Exception as e:
@@ -265,7 +166,7 @@ class PersonalAccountBot:
     def get_recent_history(self, user_id: int, limit: int = 3):
         """Get recent chat history with this user"""
         try:
-            conn = sqlite3.connect(self.main_db_path)
+            conn = db.connect(self.main_db_path)
             cursor = conn.cursor()
             
             cursor.execute('''
@@ -286,16 +187,10 @@ class PersonalAccountBot:
     def save_chat_history(self, user_id: int, username: str, message: str, response: str):
         """Save chat to main bot's database"""
         try:
-            conn = sqlite3.connect(self.main_db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
+            self.write_behind.execute('''
                 INSERT INTO chat_history (user_id, username, message, response, message_role, chat_type, chat_id)
                 VALUES (?, ?, ?, ?, 'user', 'dm', ?)
             ''', (user_id, username, message, response, user_id))
-            
-            conn.commit()
-            conn.close()
         except Exception as e:
             logger.error(f"Failed to save chat history: {e}")
     
@@ -304,7 +199,7 @@ class PersonalAccountBot:
         if self.reply_cooldown_hours == 0:
             return True  # Cooldown disabled
         
-        conn = sqlite3.connect(self.tracking_db_path)
+        conn = db.connect(self.tracking_db_path)
         cursor = conn.cursor()
         
         cursor.execute('SELECT last_reply_time FROM auto_replies WHERE user_id = ?', (user_id,))
@@ -325,19 +220,13 @@ class PersonalAccountBot:
         if self.reply_cooldown_hours == 0:
             return  # Don't track if cooldown disabled
         
-        conn = sqlite3.connect(self.tracking_db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
+        self.tracking_write_behind.execute('''
             INSERT INTO auto_replies (user_id, last_reply_time, reply_count)
             VALUES (?, ?, 1)
             ON CONFLICT(user_id) DO UPDATE SET
                 last_reply_time = ?,
                 reply_count = reply_count + 1
         ''', (user_id, datetime.now().isoformat(), datetime.now().isoformat()))
-        
-        conn.commit()
-        conn.close()
     
     async def handle_incoming_dm(self, client: Client, message: Message):
         """Handle incoming private messages with AI, keywords, and knowledge"""
@@ -362,13 +251,14 @@ class PersonalAccountBot:
         logger.info(f"📨 Received DM from {username} (ID: {user_id}): {user_message[:50]}")
         
         # Check rate limiting
-        if not self.should_auto_reply(user_id):
+        if not await self.adb.read(self.should_auto_reply, user_id, key=user_id):
             logger.info(f"⏳ Skipping reply for {username} (cooldown active)")
             return
         
+        admitted = False
         try:
             # Step 1: Check for keyword match (instant response)
-            keyword_response = self.check_keyword_match(user_message)
+            keyword_response = await self.adb.read(self.check_keyword_match, user_message)
             if keyword_response:
                 await message.reply_text(keyword_response)
                 self.record_auto_reply(user_id)
@@ -377,12 +267,32 @@ class PersonalAccountBot:
                 return
             
             # Step 2: Generate AI response (if enabled)
-            if self.use_ai_responses and self.openai_client:
+            if self.use_ai_responses and self.key_pool:
+                # "hi" / "bro" / "price?" in quick succession get one combined reply
+                burst_key = message.chat.id
+                burst = await self.burst_aggregator.collect(burst_key, user_message)
+                if burst is None:
+                    logger.info(f"📨 Message from {username} merged into a newer burst")
+                    return
+                user_message = burst.text
+                
+                # Too many AI replies pending - answer with the auto-reply message right away
+                try:
+                    await self.admission.acquire()
+                    admitted = True
+                except AdmissionRejected:
+                    if self.burst_aggregator.deliver(burst):
+                        await message.reply_text(self.auto_reply_message)
+                        self.record_auto_reply(user_id)
+                        self.burst_aggregator.finish(burst)
+                        logger.info(f"🚦 Sent busy auto-reply to {username}")
+                    return
+                
                 await client.send_chat_action(message.chat.id, ChatAction.TYPING)
                 
                 # Get conversation history
-                recent_history = self.get_recent_history(user_id, limit=3)
-                custom_knowledge = self.get_bot_knowledge()
+                recent_history = await self.adb.read(self.get_recent_history, user_id, limit=3, key=user_id)
+                custom_knowledge = await self.adb.read(self.get_bot_knowledge)
                 
                 # Build system prompt (same as main bot)
                 system_prompt = "Tum ek highly intelligent aur helpful AI assistant ho. Tumhe Hindi aur English dono languages mein expert tarike se baat karni aani hai."
@@ -413,69 +323,38 @@ class PersonalAccountBot:
                 
                 messages.append({"role": "user", "content": user_message})
                 
-                # Try API call with rotation
-                max_attempts = len(self.api_keys)
-                ai_response = None
+                # Streaming mode: first tokens go out as a new message, then it is edited in place
+                stream = None
+                if self.stream_replies:
+                    stream = StreamingReply(
+                        send_first=message.reply_text,
+                        edit=lambda sent, text: sent.edit_text(text)
+                    )
+                
+                # Least-loaded healthy key is picked per request, other keys are tried on 401/403/429
+                try:
+                    ai_response = await self.burst_aggregator.generate(burst, self.key_pool.chat_completion(
+                        messages,
+                        on_delta=stream.push if stream else None
+                    ))
+                except Exception:
+                    self.burst_aggregator.finish(burst)
+                    if stream:
+                        await stream.abort()
+                    raise
                 
-                for attempt in range(max_attempts):
-                    try:
-                        response = self.openai_client.chat.completions.create(
-                            model="gpt-4o-mini",
-                            messages=messages,
-                            max_tokens=500,
-                            temperature=0.7
-                        )
-                        ai_response = response.choices[0].message.content
-                        
-                        # Track successful API usage with token counts
-                        tokens_input = response.usage.prompt_tokens if response.usage else 0
-                        tokens_output = response.usage.completion_tokens if response.usage else 0
-                        self.track_api_key_usage(rate_limit_hit=False, tokens_input=tokens_input, tokens_output=tokens_output)
-                        logger.info(f"✅ Personal bot API call. Tokens: {tokens_input} in + {tokens_output} out = {tokens_input + tokens_output} total")
-                        break
-                        
-                    except Exception as api_error:
-                        error_str = str(api_error).lower()
-                        
-                        # Check for errors that need key rotation
-                        should_rotate = False
-                        rotation_reason = "error"
-                        
-                        if "429" in error_str or "rate limit" in error_str:
-                            should_rotate = True
-                            rotation_reason = "rate_limit"
-                            logger.warning(f"⚠️ Rate limit hit on API key #{self.current_key_index + 1}")
-                        
-                        elif "401" in error_str or "unauthorized" in error_str or "account_deactivated" in error_str:
-                            should_rotate = True
-                            rotation_reason = "account_deactivated"
-                            logger.warning(f"⚠️ API key #{self.current_key_index + 1} is deactivated/invalid")
-                        
-                        elif "403" in error_str or "forbidden" in error_str:
-                            should_rotate = True
-                            rotation_reason = "forbidden"
-                            logger.warning(f"⚠️ API key #{self.current_key_index + 1} access forbidden")
-                        
-                        elif "invalid_api_key" in error_str or "incorrect api key" in error_str:
-                            should_rotate = True
-                            rotation_reason = "invalid_key"
-                            logger.warning(f"⚠️ API key #{self.current_key_index + 1} is invalid")
-                        
-                        if should_rotate:
-                            if attempt < max_attempts - 1:
-                                self.rotate_api_key(reason=rotation_reason)
-                                logger.info(f"🔄 Retrying with next API key (Attempt {attempt + 2}/{max_attempts})...")
-                                continue
-                            else:
-                                logger.error("❌ All API keys exhausted!")
-                                raise Exception(f"All {max_attempts} API keys failed")
-                        else:
-                            # Unknown error - don't rotate, just fail
-                            logger.error(f"❌ Unexpected API error: {api_error}")
-                            raise api_error
+                if ai_response is None:
+                    # The user kept typing; the newer burst answers everything
+                    if stream:
+                        await stream.discard()
+                    return
                 
+                self.burst_aggregator.finish(burst)
                 if ai_response:
-                    await message.reply_text(ai_response)
+                    if stream:
+                        await stream.finish(ai_response)
+                    else:
+                        await message.reply_text(ai_response)
                     self.record_auto_reply(user_id)
                     self.save_chat_history(user_id, username, user_message, ai_response)
                     logger.info(f"✅ Sent AI response to {username}")
@@ -495,6 +374,9 @@ class PersonalAccountBot:
                 await message.reply_text("Sorry, I'm experiencing technical difficulties. Please try again later.")
             except:
                 pass
+        finally:
+            if admitted:
+                self.admission.release()
     
     # ========== MUSIC PLAYBACK METHODS ==========
     
@@ -829,6 +711,9 @@ class PersonalAccountBot:
         async def start_and_idle():
             await self.app.start()
             await self.call_py.start()
+            if self.key_pool:
+                self.key_pool.start_prober()
+            self.usage_counters.start()
             logger.info("✅ Personal account bot started successfully!")
             logger.info("✅ PyTgCalls music bot started successfully!")
             logger.info("🎵 Music commands: /play, /pause, /resume, /skip, /stop, /queue, /join, /leave")
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Token-Budgeted Prompt Builder
+Assembles the chat messages for a completion while keeping the input under
+PROMPT_TOKEN_BUDGET tokens. Sections are kept in priority order:
+
+1. fixed system text (persona, user info, super knowledge directives) - always kept
+2. regular knowledge entries, most relevant first - dropped from the least relevant end
+3. conversation history - oldest turns dropped first
+
+Tokens are counted with the model's tokenizer when tiktoken is installed,
+otherwise with a ~4 characters per token estimate.
+"""
+
+import os
+import logging
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+PROMPT_TOKEN_BUDGET = int(os.getenv('PROMPT_TOKEN_BUDGET', '6000'))
+
+# Chat format overhead: every message is wrapped in a few control tokens
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_REPLY = 3
+
+_encodings = {}
+
+
+def _encoding_for(model: str):
+    if tiktoken is None:
+        return None
+    if model not in _encodings:
+        try:
+            _encodings[model] = tiktoken.encoding_for_model(model)
+        except KeyError:
+            _encodings[model] = tiktoken.get_encoding('o200k_base')
+    return _encodings[model]
+
+
+def count_tokens(text: str, model: str = "gpt-4o-mini") -> int:
+    """Token count of text for the given model"""
+    if not text:
+        return 0
+    encoding = _encoding_for(model)
+    if encoding is None:
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text))
+
+
+class PromptBuilder:
+    """Builds budgeted message lists and logs where the tokens went"""
+
+    def __init__(self, model: str = "gpt-4o-mini", budget: int = PROMPT_TOKEN_BUDGET):
+        self.model = model
+        self.budget = budget
+
+    def count(self, text: str) -> int:
+        return count_tokens(text, self.model)
+
+    def build(self, system_parts: list, knowledge_entries: list, history: list, user_message: str,
+              knowledge_header: str = '', knowledge_footer: str = '', empty_knowledge: str = '',
+              label: str = 'prompt'):
+        """
+        system_parts: [(section_name, text)] always included, in order
+        knowledge_entries: formatted regular knowledge entries, most relevant first
+        history: [(user_message, bot_response)] oldest first
+        knowledge_header/footer wrap the kept entries; empty_knowledge is used when none are kept
+        """
+        section_tokens = {name: self.count(text) for name, text in system_parts}
+        user_tokens = self.count(user_message) + TOKENS_PER_MESSAGE
+        used = sum(section_tokens.values()) + TOKENS_PER_MESSAGE + user_tokens + TOKENS_PER_REPLY
+
+        # Regular knowledge outranks history, so it gets the remaining budget first
+        kept_entries = []
+        knowledge_tokens = 0
+        if knowledge_entries:
+            wrapper_tokens = self.count(knowledge_header) + self.count(knowledge_footer)
+            if used + wrapper_tokens < self.budget:
+                for entry in knowledge_entries:
+                    entry_tokens = self.count(entry)
+                    if used + wrapper_tokens + knowledge_tokens + entry_tokens > self.budget:
+                        continue
+                    kept_entries.append(entry)
+                    knowledge_tokens += entry_tokens
+            if kept_entries:
+                knowledge_tokens += wrapper_tokens
+        if not kept_entries and empty_knowledge:
+            knowledge_tokens = self.count(empty_knowledge)
+        used += knowledge_tokens
+
+        # Newest history turns first; whatever doesn't fit (the oldest) is dropped
+        kept_history = []
+        history_tokens = 0
+        for prev_msg, prev_resp in reversed(history):
+            turn_tokens = self.count(prev_msg) + self.count(prev_resp) + 2 * TOKENS_PER_MESSAGE
+            if used + history_tokens + turn_tokens > self.budget:
+                break
+            kept_history.insert(0, (prev_msg, prev_resp))
+            history_tokens += turn_tokens
+        used += history_tokens
+
+        system_prompt = ''.join(text for _, text in system_parts)
+        if kept_entries:
+            system_prompt += knowledge_header + ''.join(kept_entries) + knowledge_footer
+        elif empty_knowledge:
+            system_prompt += empty_knowledge
+
+        messages = [{"role": "system", "content": system_prompt}]
+        for prev_msg, prev_resp in kept_history:
+            messages.append({"role": "user", "content": prev_msg})
+            messages.append({"role": "assistant", "content": prev_resp})
+        messages.append({"role": "user", "content": user_message})
+
+        sections = ', '.join(f"{name}={tokens}" for name, tokens in section_tokens.items())
+        logger.info(
+            f"📏 {label} tokens: {sections}, knowledge={knowledge_tokens} "
+            f"({len(kept_entries)}/{len(knowledge_entries)} entries), history={history_tokens} "
+            f"({len(kept_history)}/{len(history)} turns), user={user_tokens}, total={used}/{self.budget}"
+        )
+        return messages
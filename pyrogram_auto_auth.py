@@ -7,7 +7,7 @@ Handles OTP collection and session creation via Telegram bot
 import os
 import logging
 import asyncio
-import sqlite3
+import db
 from pyrogram import Client
 from pyrogram.errors import SessionPasswordNeeded, PhoneCodeInvalid, PhoneCodeExpired
 
@@ -23,7 +23,7 @@ class PyrogramAuthenticator:
     
     def update_account_session(self, account_id: int, session_string: str | None = None, is_authenticated: int = 1, error_message: str | None = None):
         """Update account with session string and auth status"""
-        conn = sqlite3.connect(self.db_path)
+        conn = db.connect(self.db_path)
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+AI Response Cache
+Repeated questions ("price kya hai", "how to buy") are answered from memory instead
+of re-sending the whole knowledge prompt to OpenAI.
+
+Entries are keyed on the normalized question, the bot scope and the knowledge
+version. The version is a counter in config_versions that SQLite triggers bump
+whenever bot_knowledge, account_knowledge or group_keywords change, so edits from
+the admin panel (or any other process) invalidate cached answers automatically.
+"""
+
+import os
+import re
+import time
+import sqlite3
+import db
+import hashlib
+import logging
+import unicodedata
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+RESPONSE_CACHE_ENABLED = os.getenv('RESPONSE_CACHE_ENABLED', 'true').lower() == 'true'
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', '1000'))
+RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', '3600'))
+
+# Tables whose changes must invalidate cached answers
+VERSIONED_TABLES = ('bot_knowledge', 'account_knowledge', 'group_keywords')
+
+FIRST_NAME_PLACEHOLDER = '{first_name}'
+USERNAME_PLACEHOLDER = '{username}'
+
+
+def ensure_version_triggers(cursor):
+    """Create config_versions and the triggers that bump it (schema migration 2)"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS config_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    for table in VERSIONED_TABLES:
+        cursor.execute('INSERT OR IGNORE INTO config_versions (name, version) VALUES (?, 0)', (table,))
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS trg_{table}_{event.lower()}_version
+                AFTER {event} ON {table}
+                BEGIN
+                    UPDATE config_versions SET version = version + 1 WHERE name = '{table}';
+                END
+            ''')
+
+
+def knowledge_version(db_path: str):
+    """Combined version stamp of all cached-answer inputs (None if the table is missing)"""
+    try:
+        conn = db.connect(db_path)
+        try:
+            row = conn.execute('SELECT COUNT(*), COALESCE(SUM(version), 0) FROM config_versions').fetchone()
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        logger.warning(f"⚠️ Could not read knowledge version: {e}")
+        return None
+    if not row or row[0] < len(VERSIONED_TABLES):
+        return None
+    return row[1]
+
+
+def normalize_question(text: str, bot_username: str = None) -> str:
+    """Lowercase, strip mentions/punctuation and collapse whitespace so trivially different questions match"""
+    text = unicodedata.normalize('NFKC', text).casefold()
+    if bot_username:
+        text = text.replace(f"@{bot_username.casefold()}", ' ')
+    text = re.sub(r'[^\w\s]', ' ', text)
+    return ' '.join(text.split())
+
+
+def _replace_word(text: str, word: str, replacement: str) -> str:
+    # Any length: a short first name ("Al", "Jo") left in the answer would be served to other users
+    if not word:
+        return text
+    return re.sub(rf'(?<!\w){re.escape(word)}(?!\w)', lambda _: replacement, text)
+
+
+class ResponseCache:
+    """In-memory TTL + LRU cache of AI answers for context-free questions"""
+
+    def __init__(self, max_entries: int = RESPONSE_CACHE_SIZE, ttl: float = RESPONSE_CACHE_TTL,
+                 enabled: bool = RESPONSE_CACHE_ENABLED):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.enabled = enabled and max_entries > 0
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def make_key(self, scope: str, version, question: str):
+        """Cache key for a normalized question (None when caching is off or version is unknown)"""
+        if not self.enabled or version is None or not question:
+            return None
+        return hashlib.sha256(f"{scope}\x00{version}\x00{question}".encode()).hexdigest()
+
+    def get(self, key, first_name: str = None, username: str = None):
+        """Cached answer personalised for this user, or None"""
+        if key is None:
+            return None
+        entry = self._entries.get(key)
+        if entry is None or time.monotonic() - entry[1] > self.ttl:
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        response = entry[0].replace(FIRST_NAME_PLACEHOLDER, first_name or '')
+        return response.replace(USERNAME_PLACEHOLDER, username or '')
+
+    def put(self, key, response: str, first_name: str = None, username: str = None):
+        """Store an answer with the asking user's name swapped for placeholders"""
+        if key is None or not response:
+            return
+        template = _replace_word(response, username, USERNAME_PLACEHOLDER)
+        template = _replace_word(template, first_name, FIRST_NAME_PLACEHOLDER)
+        self._entries[key] = (template, time.monotonic())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': (self.hits / total * 100) if total else 0.0
+        }
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Single-Flight Request Coalescing
+When several identical AI requests are in flight at once (e.g. a whole group asking
+the same thing right after an announcement), only the first one calls OpenAI; the
+others wait for it and get the same result. Streamed deltas are fanned out to the
+callers that are still waiting, so a caller that gave up stops receiving them.
+"""
+
+import json
+import asyncio
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def prompt_fingerprint(messages: list, **params) -> str:
+    """Stable hash of the full prompt plus generation parameters"""
+    payload = json.dumps({'messages': messages, 'params': params}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class SingleFlight:
+    """Deduplicates concurrent calls that share a key"""
+
+    def __init__(self):
+        self._in_flight = {}
+        self._waiters = {}
+        self._listeners = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    async def run(self, key: str, factory, on_delta=None):
+        """Await factory(on_delta) once per key; concurrent callers with the same key share its result
+
+        factory gets a fan-out callback (or None if the first caller does not stream) that
+        forwards each delta to every caller still waiting with an on_delta; a caller that
+        gives up is detached, so deltas never reach a reply it already discarded.
+        """
+        task = self._in_flight.get(key)
+        if task is not None:
+            self.coalesced += 1
+            logger.info(f"🔗 Joined identical in-flight AI request ({self.coalesced} saved so far)")
+        else:
+            self.calls += 1
+            listeners = []
+            task = asyncio.ensure_future(factory(self._fan_out(listeners) if on_delta else None))
+            self._in_flight[key] = task
+            self._listeners[task] = listeners
+            task.add_done_callback(lambda done: self._finished(key, done))
+        listeners = self._listeners[task]
+        if on_delta:
+            listeners.append(on_delta)
+        # shield: one caller giving up must not cancel the request for everyone else,
+        # but once every caller has given up the request itself is cancelled
+        self._waiters[task] = self._waiters.get(task, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.done() and self._waiters.get(task) == 1:
+                task.cancel()
+            raise
+        finally:
+            if on_delta in listeners:
+                listeners.remove(on_delta)
+            self._waiters[task] -= 1
+            if not self._waiters[task]:
+                del self._waiters[task]
+
+    @staticmethod
+    def _fan_out(listeners):
+        async def on_delta(text: str):
+            for listener in list(listeners):
+                if listener not in listeners:
+                    continue
+                try:
+                    await listener(text)
+                except Exception as e:
+                    # One broken reply must not abort the completion for everyone
+                    if listener in listeners:
+                        listeners.remove(listener)
+                    logger.warning(f"⚠️ Dropped streaming listener after error: {e}")
+        return on_delta
+
+    def _finished(self, key: str, task):
+        self._in_flight.pop(key, None)
+        self._listeners.pop(task, None)
+        # Mark the error as retrieved even if every waiting caller was cancelled
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self):
+        return {
+            'calls': self.calls,
+            'coalesced': self.coalesced,
+            'in_flight': len(self._in_flight)
+        }
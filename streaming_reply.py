@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Streaming Reply Helper
+Shows an AI reply while it is still being generated: the first tokens are sent as a
+new message and the same message is then edited as more text arrives.
+Works with both python-telegram-bot (edit_message_text) and Pyrogram (edit_text).
+"""
+
+import os
+import time
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Telegram allows roughly one edit per second per chat in DMs and ~20 messages
+# per minute in groups, so groups get a slower default edit cadence.
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '1.0'))
+STREAM_EDIT_INTERVAL_GROUP = float(os.getenv('STREAM_EDIT_INTERVAL_GROUP', '3.0'))
+STREAM_CURSOR = ' ▌'
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+
+def streaming_enabled():
+    """Check the STREAM_REPLIES switch (off by default)"""
+    return os.getenv('STREAM_REPLIES', 'false').lower() == 'true'
+
+
+def flood_wait_seconds(error):
+    """Return how long Telegram asked us to back off, or None if error is not a flood wait"""
+    # python-telegram-bot: RetryAfter.retry_after, Pyrogram: FloodWait.value
+    wait = getattr(error, 'retry_after', None)
+    if wait is None and type(error).__name__ == 'FloodWait':
+        wait = getattr(error, 'value', None)
+    if wait is None:
+        return None
+    if hasattr(wait, 'total_seconds'):
+        wait = wait.total_seconds()
+    return float(wait)
+
+
+class StreamingReply:
+    """Throttled progressive edits of a single Telegram message"""
+
+    def __init__(self, send_first, edit, is_group: bool = False):
+        """
+        send_first: async callable(text) -> sent message object
+        edit: async callable(sent_message, text) -> None
+        """
+        self.send_first = send_first
+        self.edit = edit
+        self.interval = STREAM_EDIT_INTERVAL_GROUP if is_group else STREAM_EDIT_INTERVAL
+        self.sent_message = None
+        self.latest_text = ""
+        self.shown_text = ""
+        self.next_edit_at = 0.0
+        self._task = None
+
+    async def push(self, text: str):
+        """Record the text generated so far; edits happen in the background"""
+        self.latest_text = text
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush())
+
+    async def _flush(self):
+        try:
+            delay = self.next_edit_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            text = self.latest_text
+            if not text.strip() or text == self.shown_text:
+                return
+            await self._show(text + STREAM_CURSOR)
+            self.shown_text = text
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"⚠️ Streaming edit failed: {e}")
+
+    async def _show(self, text: str):
+        text = text[:TELEGRAM_MESSAGE_LIMIT]
+        try:
+            if self.sent_message is None:
+                self.sent_message = await self.send_first(text)
+            else:
+                await self.edit(self.sent_message, text)
+            self.next_edit_at = time.monotonic() + self.interval
+        except Exception as e:
+            wait = flood_wait_seconds(e)
+            if wait is None:
+                raise
+            # Respect Telegram's flood control and let the next edit carry the newer text
+            logger.warning(f"⏳ Telegram asked to slow down streaming edits for {wait:.0f}s")
+            self.next_edit_at = time.monotonic() + wait
+
+    async def finish(self, final_text: str):
+        """Replace the in-progress message with the final reply (sends it if nothing was shown yet)"""
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+        delay = self.next_edit_at - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        final_text = final_text[:TELEGRAM_MESSAGE_LIMIT]
+        if self.sent_message is None:
+            self.sent_message = await self.send_first(final_text)
+        else:
+            try:
+                await self.edit(self.sent_message, final_text)
+            except Exception as e:
+                wait = flood_wait_seconds(e)
+                if wait is None:
+                    raise
+                await asyncio.sleep(wait)
+                await self.edit(self.sent_message, final_text)
+        return self.sent_message
+
+    async def abort(self):
+        """Stop pending edits, e.g. when the completion failed mid-stream"""
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+
+    async def discard(self):
+        """Stop edits and delete the partial message, e.g. when a newer reply replaces it"""
+        await self.abort()
+        if self.sent_message is not None:
+            try:
+                await self.sent_message.delete()
+            except Exception as e:
+                logger.warning(f"⚠️ Could not delete superseded streaming message: {e}")
+            self.sent_message = None
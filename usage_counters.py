@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+In-Memory API Key Usage Counters
+Completions and 429s only bump counters in process memory. A background task
+writes the accumulated deltas to api_key_stats every USAGE_FLUSH_INTERVAL seconds
+with one upsert per key; the daily token window is reset inside that statement
+(julianday) instead of reading and parsing daily_reset_time in Python first.
+
+Counters are also kept in USAGE_BUCKET_SECONDS time buckets for the last hour,
+so the admin screen can show live request rates next to the persisted totals.
+"""
+
+import os
+import time
+import atexit
+import asyncio
+import sqlite3
+import logging
+import threading
+import db
+
+logger = logging.getLogger(__name__)
+
+USAGE_FLUSH_INTERVAL = float(os.getenv('USAGE_FLUSH_INTERVAL', '10'))
+USAGE_BUCKET_SECONDS = int(os.getenv('USAGE_BUCKET_SECONDS', '60'))
+USAGE_BUCKET_RETENTION = 3600
+
+# Counter slots: requests, rate limit hits, input tokens, output tokens
+REQUESTS, RATE_LIMITS, TOKENS_IN, TOKENS_OUT = range(4)
+
+FLUSH_SQL = '''
+    INSERT INTO api_key_stats (key_index, usage_count, last_used, rate_limit_hits,
+                               tokens_used_today, tokens_input_today, tokens_output_today,
+                               daily_reset_time, total_tokens_lifetime)
+    VALUES (?, ?, CURRENT_TIMESTAMP, ?, ?, ?, ?, CURRENT_TIMESTAMP, ?)
+    ON CONFLICT(key_index) DO UPDATE SET
+        usage_count = COALESCE(usage_count, 0) + excluded.usage_count,
+        last_used = CURRENT_TIMESTAMP,
+        rate_limit_hits = COALESCE(rate_limit_hits, 0) + excluded.rate_limit_hits,
+        tokens_used_today = CASE
+            WHEN daily_reset_time IS NULL OR julianday('now') - julianday(daily_reset_time) >= 1
+            THEN excluded.tokens_used_today
+            ELSE COALESCE(tokens_used_today, 0) + excluded.tokens_used_today END,
+        tokens_input_today = CASE
+            WHEN daily_reset_time IS NULL OR julianday('now') - julianday(daily_reset_time) >= 1
+            THEN excluded.tokens_input_today
+            ELSE COALESCE(tokens_input_today, 0) + excluded.tokens_input_today END,
+        tokens_output_today = CASE
+            WHEN daily_reset_time IS NULL OR julianday('now') - julianday(daily_reset_time) >= 1
+            THEN excluded.tokens_output_today
+            ELSE COALESCE(tokens_output_today, 0) + excluded.tokens_output_today END,
+        daily_reset_time = CASE
+            WHEN daily_reset_time IS NULL OR julianday('now') - julianday(daily_reset_time) >= 1
+            THEN CURRENT_TIMESTAMP
+            ELSE daily_reset_time END,
+        total_tokens_lifetime = COALESCE(total_tokens_lifetime, 0) + excluded.total_tokens_lifetime
+'''
+
+
+class UsageCounters:
+    """Per-key usage counters flushed to api_key_stats in the background"""
+
+    def __init__(self, db_path: str, flush_interval: float = USAGE_FLUSH_INTERVAL,
+                 bucket_seconds: int = USAGE_BUCKET_SECONDS):
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+        self.bucket_seconds = bucket_seconds
+        self._lock = threading.Lock()
+        self._pending = {}      # key_index -> counters not yet written
+        self._buckets = {}      # bucket start -> {key_index: counters}
+        self._task = None
+        atexit.register(self.flush)
+
+    def _add(self, key_index: int, delta: list):
+        bucket = int(time.time()) // self.bucket_seconds * self.bucket_seconds
+        with self._lock:
+            for counters in (self._pending.setdefault(key_index, [0, 0, 0, 0]),
+                             self._buckets.setdefault(bucket, {}).setdefault(key_index, [0, 0, 0, 0])):
+                for slot, value in enumerate(delta):
+                    counters[slot] += value
+
+    def record_usage(self, key_index: int, tokens_input: int = 0, tokens_output: int = 0):
+        """A completion finished on this key (use as ApiKeyPool on_usage)"""
+        self._add(key_index, [1, 0, tokens_input, tokens_output])
+
+    def record_rate_limit(self, key_index: int):
+        """This key returned 429 (use as ApiKeyPool on_rate_limit)"""
+        self._add(key_index, [0, 1, 0, 0])
+
+    def pending(self, key_index: int):
+        """Counters recorded since the last flush: [requests, rate_limits, tokens_in, tokens_out]"""
+        with self._lock:
+            return list(self._pending.get(key_index, [0, 0, 0, 0]))
+
+    def pending_keys(self):
+        """Keys with counters recorded since the last flush"""
+        with self._lock:
+            return list(self._pending)
+
+    def recent(self, key_index: int, seconds: int = 300):
+        """Counters of the last `seconds` (bucket granularity)"""
+        since = time.time() - seconds
+        totals = [0, 0, 0, 0]
+        with self._lock:
+            for bucket, per_key in self._buckets.items():
+                if bucket + self.bucket_seconds > since and key_index in per_key:
+                    totals = [a + b for a, b in zip(totals, per_key[key_index])]
+        return totals
+
+    def flush(self):
+        """Write all pending counters, one statement per key; returns the number of keys written"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            cutoff = time.time() - USAGE_BUCKET_RETENTION
+            for bucket in [b for b in self._buckets if b < cutoff]:
+                del self._buckets[bucket]
+        if not pending:
+            return 0
+
+        rows = [(key_index, c[REQUESTS], c[RATE_LIMITS], c[TOKENS_IN] + c[TOKENS_OUT],
+                 c[TOKENS_IN], c[TOKENS_OUT], c[TOKENS_IN] + c[TOKENS_OUT])
+                for key_index, c in pending.items()]
+        conn = db.connect(self.db_path)
+        try:
+            conn.executemany(FLUSH_SQL, rows)
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.warning(f"⚠️ Could not flush API key usage, will retry: {e}")
+            self._merge_back(pending)
+            return 0
+        finally:
+            conn.close()
+        return len(rows)
+
+    def _merge_back(self, pending):
+        with self._lock:
+            for key_index, counters in pending.items():
+                current = self._pending.setdefault(key_index, [0, 0, 0, 0])
+                for slot, value in enumerate(counters):
+                    current[slot] += value
+
+    def start(self):
+        """Start the periodic flush on the running event loop"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        return self._task
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await asyncio.to_thread(self.flush)
+            except Exception as e:
+                logger.error(f"❌ API key usage flush failed: {e}")
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+Write-Behind Buffer
+Per-message bookkeeping (user/group tracking, chat history, reply counters) used
+to be one committed transaction - one fsync - per statement. These writes are now
+queued in memory and a background thread writes them in a single transaction
+every WRITE_BEHIND_INTERVAL_MS milliseconds, or as soon as WRITE_BEHIND_MAX_ROWS
+are queued.
+
+On graceful shutdown (close() / interpreter exit) everything queued is flushed;
+a crash loses at most one interval of bookkeeping.
+"""
+
+import os
+import atexit
+import sqlite3
+import logging
+import threading
+from itertools import groupby
+import db
+
+logger = logging.getLogger(__name__)
+
+WRITE_BEHIND_INTERVAL_MS = int(os.getenv('WRITE_BEHIND_INTERVAL_MS', '250'))
+WRITE_BEHIND_MAX_ROWS = int(os.getenv('WRITE_BEHIND_MAX_ROWS', '200'))
+# Queued writes kept while the database stays locked, before the oldest are dropped
+WRITE_BEHIND_MAX_BACKLOG = int(os.getenv('WRITE_BEHIND_MAX_BACKLOG', '20000'))
+
+
+class WriteBehindBuffer:
+    """Batches fire-and-forget writes to one database into periodic transactions"""
+
+    def __init__(self, db_path: str, name: str = 'db', interval_ms: int = WRITE_BEHIND_INTERVAL_MS,
+                 max_rows: int = WRITE_BEHIND_MAX_ROWS):
+        self.db_path = db_path
+        self.name = name
+        self.interval = interval_ms / 1000
+        self.max_rows = max_rows
+        self._ops = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self.flushes = 0
+        self.rows_written = 0
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._run, name=f"{name}-write-behind", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def execute(self, sql: str, params=()):
+        """Queue one statement"""
+        self._add((sql, tuple(params)))
+
+    def call(self, fn, *args):
+        """Queue fn(cursor, *args) for writes that need to read before they write"""
+        self._add((fn, args))
+
+    def _add(self, op):
+        if self._closed:
+            # Late writes during shutdown are written right away
+            self._write([op])
+            return
+        with self._lock:
+            self._ops.append(op)
+            full = len(self._ops) >= self.max_rows
+        if full:
+            self._wake.set()
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"❌ [{self.name}] Write-behind flush failed: {e}")
+
+    def flush(self):
+        """Write everything queued so far in one transaction; returns the number of writes"""
+        with self._flush_lock:
+            with self._lock:
+                ops, self._ops = self._ops, []
+            if not ops:
+                return 0
+            if not self._write(ops):
+                self._requeue(ops)
+                return 0
+            self.flushes += 1
+            self.rows_written += len(ops)
+            return len(ops)
+
+    def _write(self, ops):
+        conn = db.connect(self.db_path)
+        try:
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+            except sqlite3.OperationalError as e:
+                logger.warning(f"⚠️ [{self.name}] Database busy, keeping {len(ops)} writes queued: {e}")
+                return False
+            cursor = conn.cursor()
+            try:
+                # Consecutive identical statements go out as one executemany
+                for target, group in groupby(ops, key=lambda op: op[0]):
+                    group = list(group)
+                    if not self._run_savepoint(cursor, lambda: self._apply(cursor, target, group)):
+                        # One bad row must not take the other rows of the batch with it
+                        failed = sum(1 for op in group
+                                     if not self._run_savepoint(cursor, lambda op=op: self._apply(cursor, op[0], [op])))
+                        if failed:
+                            self.dropped += failed
+                            logger.error(f"❌ [{self.name}] Dropped {failed} of {len(group)} buffered writes")
+                conn.commit()
+            except sqlite3.Error as e:
+                conn.rollback()
+                logger.warning(f"⚠️ [{self.name}] Write-behind commit failed, keeping {len(ops)} writes queued: {e}")
+                return False
+            return True
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _apply(cursor, target, group):
+        if callable(target):
+            for _, args in group:
+                target(cursor, *args)
+        else:
+            cursor.executemany(target, [params for _, params in group])
+
+    def _run_savepoint(self, cursor, write) -> bool:
+        """Run write() inside a savepoint; on any error undo just that part and return False"""
+        cursor.execute('SAVEPOINT write_behind')
+        try:
+            write()
+        except Exception as e:
+            cursor.execute('ROLLBACK TO write_behind')
+            cursor.execute('RELEASE write_behind')
+            logger.warning(f"⚠️ [{self.name}] Buffered write failed: {e}")
+            return False
+        cursor.execute('RELEASE write_behind')
+        return True
+
+    def _requeue(self, ops):
+        with self._lock:
+            self._ops[:0] = ops
+            overflow = len(self._ops) - WRITE_BEHIND_MAX_BACKLOG
+            if overflow > 0:
+                del self._ops[:overflow]
+                logger.error(f"❌ [{self.name}] Write-behind backlog full, dropped {overflow} oldest writes")
+
+    @property
+    def pending(self):
+        return len(self._ops)
+
+    def close(self):
+        """Stop the background thread and flush what is left (safe to call twice)"""
+        if self._closed:
+            return
+        self._closed = True
+        self._wake.set()
+        self._thread.join(timeout=5)
+        for _ in range(3):
+            self.flush()
+            if not self._ops:
+                break
+        if self._ops:
+            logger.error(f"❌ [{self.name}] {len(self._ops)} buffered writes could not be saved at shutdown")
+
+    def stats(self):
+        return {
+            'pending': self.pending,
+            'flushes': self.flushes,
+            'rows_written': self.rows_written,
+            'dropped': self.dropped
+        }